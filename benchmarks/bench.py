@@ -0,0 +1,464 @@
+"""
+Hermetic benchmarks for the backporter pipeline.
+
+Every scenario in scenarios.yaml builds a synthetic upstream repo and a
+dist-git repo with a source tarball, puts the stub `docker` and `rhpkg` from
+stubs/ first on PATH (and serves the stub Engine API, stubs/engine.py, to
+scenarios with container_backend: api), runs `backporter create` (or `batch`) with --report
+and collects the wall time of the run and of each stage. No network access,
+docker daemon or rhpkg is needed.
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --baseline baseline.json --threshold 0.2
+
+With --baseline, the run fails if any scenario or stage got slower than the
+baseline by more than the threshold (and by more than --min-delta seconds).
+"""
+import copy
+import gzip
+import hashlib
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import typing
+import click
+import yaml
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, "stubs")
+DEFAULT_SCENARIOS = os.path.join(BENCH_DIR, "scenarios.yaml")
+
+DISTGIT_REPO = "rpms/frr"
+BRANCH = "rhel-9"
+TARBALL_PREFIX = "frr-9.1"
+
+SHA_PATTERN = re.compile(r"[0-9a-f]{40}")
+
+
+def git(*args: str, cwd: str) -> str:
+    proc = subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    )
+    return proc.stdout.strip()
+
+
+def init_repo(path: str):
+    os.makedirs(path)
+    git("init", "-q", "-b", "main", cwd=path)
+    git("config", "user.email", "bench@example.com", cwd=path)
+    git("config", "user.name", "bench", cwd=path)
+
+
+def make_upstream(path: str, files: int, file_lines: int, depth: int) -> typing.List[str]:
+    """
+    Creates an upstream repo with `files` C files and `depth` commits, each
+    touching a few of them. Returns the commit SHAs, newest first.
+    """
+    init_repo(path)
+    git("config", "uploadpack.allowReachableSHA1InWant", "true", cwd=path)
+    git("config", "uploadpack.allowFilter", "true", cwd=path)
+    os.makedirs(os.path.join(path, "lib"))
+    for i in range(files):
+        with open(os.path.join(path, "lib", f"file{i}.c"), "w", encoding="utf-8") as f:
+            f.writelines(f"int file{i}_line{n}(void) {{ return {n}; }}\n" for n in range(file_lines))
+    with open(os.path.join(path, "bootstrap.sh"), "w", encoding="utf-8") as f:
+        f.write("#!/bin/sh\ntouch configure\n")
+    os.chmod(os.path.join(path, "bootstrap.sh"), 0o755)
+    git("add", "-A", cwd=path)
+    git("commit", "-q", "-m", "initial import", cwd=path)
+
+    for c in range(depth):
+        for i in (c % files, (c * 7) % files):
+            with open(os.path.join(path, "lib", f"file{i}.c"), "a", encoding="utf-8") as f:
+                f.write(f"int file{i}_fix{c}(void) {{ return -{c}; }}\n")
+        git("commit", "-q", "-am", f"fix {c}", cwd=path)
+    return git("rev-list", "HEAD", cwd=path).splitlines()
+
+
+def diverge(archive: bytes) -> bytes:
+    """
+    Rewrites every source file in a tar archive so that no upstream patch
+    applies to it, not even through a 3-way merge.
+    """
+    out = io.BytesIO()
+    with tarfile.open(fileobj=io.BytesIO(archive)) as src, tarfile.open(
+        fileobj=out, mode="w"
+    ) as dest:
+        for member in src.getmembers():
+            data = src.extractfile(member).read() if member.isfile() else None
+            if data is not None and member.name.endswith(".c"):
+                data = b"".join(b"/* downstream */ " + line for line in data.splitlines(True))
+                member.size = len(data)
+            dest.addfile(member, io.BytesIO(data) if data is not None else None)
+    return out.getvalue()
+
+
+def branch_names(count: int) -> typing.List[str]:
+    return [BRANCH] + [f"{BRANCH}.{i}" for i in range(1, count)]
+
+
+def make_distgit(
+    root: str, upstream_path: str, base: str, diverged: bool, branches: typing.List[str]
+):
+    """
+    Creates the dist-git repo and the lookaside tarball of the upstream tree
+    at base, as served by the stub rhpkg. A diverged tarball makes every
+    patch go through FixMorph instead of the fast path.
+    """
+    lookaside = os.path.join(root, "lookaside")
+    os.makedirs(lookaside)
+    tarball = f"{TARBALL_PREFIX}.tar.gz"
+    archive = subprocess.run(
+        ["git", "archive", f"--prefix={TARBALL_PREFIX}/", base],
+        cwd=upstream_path,
+        check=True,
+        capture_output=True,
+    ).stdout
+    if diverged:
+        archive = diverge(archive)
+    with gzip.open(os.path.join(lookaside, tarball), "wb") as f:
+        f.write(archive)
+    with open(os.path.join(lookaside, tarball), "rb") as f:
+        checksum = hashlib.sha512(f.read()).hexdigest()
+
+    path = os.path.join(root, DISTGIT_REPO)
+    init_repo(path)
+    with open(os.path.join(path, "frr.spec"), "w", encoding="utf-8") as f:
+        f.write("Name: frr\nVersion: 9.1\n")
+    with open(os.path.join(path, "sources"), "w", encoding="utf-8") as f:
+        f.write(f"SHA512 ({tarball}) = {checksum}\n")
+    git("add", "-A", cwd=path)
+    git("commit", "-q", "-m", "frr 9.1", cwd=path)
+    for branch in branches:
+        git("branch", branch, cwd=path)
+
+
+def load_scenarios(path: str, only: typing.Tuple[str, ...]) -> typing.List[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        raw = yaml.safe_load(f)
+    scenarios = []
+    for entry in raw["scenarios"]:
+        scenario = copy.deepcopy(raw.get("defaults", {}))
+        latency = {**scenario.get("latency", {}), **entry.get("latency", {})}
+        scenario.update(entry, latency=latency)
+        if not only or scenario["name"] in only:
+            scenarios.append(scenario)
+    unknown = set(only) - {s["name"] for s in scenarios}
+    if unknown:
+        raise click.BadParameter(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return scenarios
+
+
+def stage_times(report_path: str) -> typing.Dict[str, float]:
+    """
+    Sums the wall time per stage in a --report file, folding commit SHAs out
+    of batch stage names so runs of different fixtures compare, along with
+    the time containers spent queued for the scheduler.
+    """
+    times: typing.Dict[str, float] = {}
+    with open(report_path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["type"] == "run" and record.get("scheduler"):
+                times["scheduler-wait"] = record["scheduler"]["wait_seconds"]
+            if record["type"] != "stage":
+                continue
+            name = SHA_PATTERN.sub("<commit>", record["name"])
+            times[name] = times.get(name, 0.0) + record["wall_seconds"]
+    return times
+
+
+class Fixture:
+    """
+    The synthetic repos, stub state and cache directory of one scenario.
+    """
+
+    def __init__(self, root: str, scenario: dict):
+        self.root = root
+        self.scenario = scenario
+        upstream_path = os.path.join(root, "upstream")
+        self.commits = make_upstream(
+            upstream_path, scenario["files"], scenario["file_lines"], scenario["depth"]
+        )
+        self.branches = branch_names(scenario["branches"])
+        make_distgit(
+            os.path.join(root, "distgit"),
+            upstream_path,
+            self.commits[scenario["series"]],
+            scenario["diverged"],
+            self.branches,
+        )
+        self.engine_socket = None
+        if scenario["config"].get("container_backend") == "api":
+            self.engine_socket = os.path.join(root, "engine.sock")
+            scenario = copy.deepcopy(scenario)
+            scenario["config"]["docker_host"] = f"unix://{self.engine_socket}"
+        self.config_path = os.path.join(root, "config.yaml")
+        with open(self.config_path, "w", encoding="utf-8") as f:
+            yaml.dump(
+                {
+                    "fixmorph_base_image": None,
+                    "upstream_url": f"file://{upstream_path}",
+                    "distgit_repo": DISTGIT_REPO,
+                    "cache_dir": os.path.join(root, "cache"),
+                    "run_mode": scenario["run_mode"],
+                    "upstream_fetch": scenario["upstream_fetch"],
+                    **scenario["config"],
+                },
+                f,
+            )
+
+    def env(self) -> typing.Dict[str, str]:
+        latency = self.scenario["latency"]
+        return {
+            **os.environ,
+            "PATH": STUBS_DIR + os.pathsep + os.environ.get("PATH", ""),
+            "PYTHONPATH": REPO_ROOT,
+            "BENCH_STATE": os.path.join(self.root, "state"),
+            "BENCH_DISTGIT_ROOT": os.path.join(self.root, "distgit"),
+            "BENCH_OUTPUT_LINES": str(self.scenario["output_lines"]),
+            "BENCH_DOCKER_BUILD_SECONDS": str(latency["docker_build"]),
+            "BENCH_DOCKER_RUN_SECONDS": str(latency["docker_run"]),
+            "BENCH_BOOTSTRAP_SECONDS": str(latency["bootstrap"]),
+            "BENCH_RHPKG_SOURCES_SECONDS": str(latency["rhpkg_sources"]),
+            "BENCH_RHPKG_PREP_SECONDS": str(latency["rhpkg_prep"]),
+        }
+
+    def cli(self) -> typing.List[str]:
+        return [
+            sys.executable,
+            "-c",
+            "from src.commands.main import cli; cli()",
+            "--config",
+            self.config_path,
+        ]
+
+    def command(self, report_path: str, run: int) -> typing.List[str]:
+        cli = self.cli()
+        if self.scenario["command"] == "batch":
+            manifest = os.path.join(self.root, "manifest.yaml")
+            with open(manifest, "w", encoding="utf-8") as f:
+                yaml.dump(
+                    {
+                        "commits": self.commits[: self.scenario["commits"]],
+                        "branches": self.branches,
+                    },
+                    f,
+                )
+            cli += [
+                "batch",
+                manifest,
+                "--output-dir",
+                os.path.join(self.root, f"results-{run}"),
+            ]
+        else:
+            series = self.scenario["series"]
+            commit = self.commits[0] if series == 1 else f"{self.commits[series]}..{self.commits[0]}"
+            cli += ["create", commit]
+            for branch in self.branches:
+                cli += ["--branch", branch]
+        return cli + ["--quiet", "--report", report_path] + [
+            str(a) for a in self.scenario["args"]
+        ]
+
+    def start_engine(self) -> typing.Optional[subprocess.Popen]:
+        """
+        Starts the stub Engine API for the run and waits for its socket.
+        """
+        if not self.engine_socket:
+            return None
+        engine = subprocess.Popen(
+            [sys.executable, os.path.join(STUBS_DIR, "engine.py"), self.engine_socket],
+            env=self.env(),
+        )
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.engine_socket):
+            if engine.poll() is not None or time.monotonic() > deadline:
+                engine.kill()
+                raise RuntimeError("the stub Engine API didn't start")
+            time.sleep(0.05)
+        return engine
+
+    def invoke(self, command: typing.List[str]) -> float:
+        """
+        Runs a backporter command against the fixture and returns its wall
+        time.
+        """
+        engine = self.start_engine()
+        try:
+            start = time.monotonic()
+            proc = subprocess.run(
+                command,
+                cwd=self.root,
+                env=self.env(),
+                capture_output=True,
+                text=True,
+            )
+            wall = time.monotonic() - start
+        finally:
+            if engine:
+                engine.terminate()
+                engine.wait()
+                os.remove(self.engine_socket)
+        if proc.returncode != 0:
+            raise RuntimeError(
+                f"scenario '{self.scenario['name']}' failed:\n{proc.stdout}\n{proc.stderr}"
+            )
+        return wall
+
+    def prewarm(self):
+        """
+        Runs `backporter warm` for the scenario's branches, untimed.
+        """
+        command = self.cli() + ["warm", "--quiet"]
+        for branch in self.branches:
+            command += ["--branch", branch]
+        self.invoke(command)
+
+    def run(self, run: int) -> typing.Dict[str, float]:
+        report_path = os.path.join(self.root, f"report-{run}.jsonl")
+        wall = self.invoke(self.command(report_path, run))
+        return {"wall": wall, **stage_times(report_path)}
+
+
+def run_scenario(scenario: dict, repeat: int, keep: bool) -> typing.Dict[str, typing.Any]:
+    """
+    Runs a scenario `repeat` times, each on fresh caches, and returns the
+    median of every metric.
+    """
+    samples: typing.List[typing.Dict[str, float]] = []
+    for n in range(repeat):
+        root = tempfile.mkdtemp(prefix=f"backporter-bench-{scenario['name']}-")
+        try:
+            fixture = Fixture(root, scenario)
+            if scenario["prewarm"]:
+                fixture.prewarm()
+            if scenario["warm"]:
+                fixture.run(run=-1)
+            samples.append(fixture.run(run=n))
+        finally:
+            if keep:
+                click.secho(f"  kept {root}")
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+    metrics = sorted({m for sample in samples for m in sample})
+    return {
+        "metrics": {
+            m: round(statistics.median(s[m] for s in samples if m in s), 3) for m in metrics
+        },
+        "samples": samples,
+    }
+
+
+def compare(
+    results: dict, baseline: dict, threshold: float, min_delta: float
+) -> typing.List[str]:
+    """
+    Returns a line for every metric that got slower than the baseline by more
+    than threshold (relative) and min_delta (absolute seconds).
+    """
+    regressions = []
+    for name, scenario in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for metric, value in scenario["metrics"].items():
+            old = base["metrics"].get(metric)
+            if old is None:
+                continue
+            if value > old * (1 + threshold) and value - old > min_delta:
+                regressions.append(f"{name} {metric}: {old:.2f}s -> {value:.2f}s")
+    return regressions
+
+
+def format_results(results: dict, baseline: typing.Optional[dict]) -> str:
+    rows = [("SCENARIO", "METRIC", "SECONDS", "BASELINE")]
+    for name, scenario in results["scenarios"].items():
+        base = (baseline or {}).get("scenarios", {}).get(name, {}).get("metrics", {})
+        for metric, value in scenario["metrics"].items():
+            old = base.get(metric)
+            rows.append((name, metric, f"{value:.2f}", "-" if old is None else f"{old:.2f}"))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+@click.command()
+@click.option(
+    "--scenarios",
+    "scenarios_path",
+    type=click.Path(exists=True, dir_okay=False),
+    default=DEFAULT_SCENARIOS,
+    show_default=True,
+    help="YAML file with the scenarios to run.",
+)
+@click.option("--only", multiple=True, help="Run only the named scenario (repeatable).")
+@click.option("--repeat", type=click.IntRange(min=1), default=1, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the results as JSON here.")
+@click.option(
+    "--baseline",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Results JSON of an earlier run to compare against.",
+)
+@click.option("--threshold", type=float, default=0.2, show_default=True)
+@click.option("--min-delta", type=float, default=0.25, show_default=True)
+@click.option("--keep", is_flag=True, help="Keep each scenario's fixture directory.")
+def main(
+    scenarios_path: str,
+    only: typing.Tuple[str, ...],
+    repeat: int,
+    output: typing.Optional[str],
+    baseline: typing.Optional[str],
+    threshold: float,
+    min_delta: float,
+    keep: bool,
+):
+    """
+    Runs the benchmark scenarios and optionally compares them to a baseline.
+    """
+    results: typing.Dict[str, typing.Any] = {
+        "meta": {
+            "created": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+        },
+        "scenarios": {},
+    }
+    for scenario in load_scenarios(scenarios_path, only):
+        click.secho(f"Running {scenario['name']}")
+        results["scenarios"][scenario["name"]] = run_scenario(scenario, repeat, keep)
+
+    baseline_results = None
+    if baseline:
+        with open(baseline, "r", encoding="utf-8") as f:
+            baseline_results = json.load(f)
+    click.secho(format_results(results, baseline_results))
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline_results:
+        regressions = compare(results, baseline_results, threshold, min_delta)
+        for line in regressions:
+            click.secho(f"REGRESSION {line}", fg="red")
+        if regressions:
+            sys.exit(1)
+        click.secho("No regressions against the baseline", fg="green")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the Docker Engine API used by benchmarks/bench.py with
+container_backend: api. Serves the endpoints the backporter calls on the Unix
+socket given as its only argument and carries each one out with the stub
+`docker` CLI next to it, so both backends share one notion of images,
+containers and latency. Build contexts are read in full, and their sizes
+appended to $BENCH_STATE/context-bytes.
+"""
+import http.server
+import io
+import itertools
+import json
+import os
+import re
+import socketserver
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import urllib.parse
+
+
+STUB_DOCKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "docker")
+
+
+def docker(*args: str, **kwargs) -> subprocess.CompletedProcess:
+    return subprocess.run([STUB_DOCKER, *args], capture_output=True, **kwargs)
+
+
+class Container:
+    def __init__(self, name: str, body: dict):
+        self.name = name
+        self.body = body
+        self.proc = None
+        self.output = b""
+        self.done = False
+        self.cond = threading.Condition()
+
+    def argv(self):
+        args = ["run", "--name", self.name]
+        for env in self.body.get("Env") or []:
+            args += ["-e", env]
+        for bind in self.body.get("HostConfig", {}).get("Binds") or []:
+            args += ["-v", bind]
+        return args + [self.body["Image"], *(self.body.get("Cmd") or [])]
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [STUB_DOCKER, *self.argv()], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for chunk in iter(lambda: self.proc.stdout.read1(65536), b""):
+            with self.cond:
+                self.output += chunk
+                self.cond.notify_all()
+        self.proc.wait()
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+
+class Engine:
+    def __init__(self, state: str):
+        self.state = state
+        self.containers = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def container(self, ref: str) -> Container:
+        with self.lock:
+            for cid, container in self.containers.items():
+                if ref in (cid, container.name):
+                    return container
+        raise KeyError(ref)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, status: int, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = re.sub(r"^/v[0-9.]+", "", url.path)
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        return path, query
+
+    def _chunked_body(self):
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return
+            yield self.rfile.read(size)
+            self.rfile.readline()
+
+    def do_GET(self):
+        path, query = self._route()
+        engine = self.server.engine
+        match = re.fullmatch(r"/images/(.+)/json", path)
+        if match:
+            proc = docker("image", "inspect", "--format", "{{.Id}}", urllib.parse.unquote(match[1]))
+            if proc.returncode:
+                return self._json(404, {"message": proc.stderr.decode().strip()})
+            return self._json(200, {"Id": proc.stdout.decode().strip()})
+        match = re.fullmatch(r"/containers/([^/]+)/(logs|archive)", path)
+        if not match:
+            return self._json(404, {"message": f"no route for {path}"})
+        try:
+            container = engine.container(match[1])
+        except KeyError:
+            return self._json(404, {"message": f"no such container: {match[1]}"})
+        if match[2] == "archive":
+            with tempfile.TemporaryDirectory() as tmp:
+                dest = os.path.join(tmp, os.path.basename(query["path"]))
+                if docker("cp", f"{container.name}:{query['path']}", dest).returncode:
+                    return self._json(404, {"message": "no such file"})
+                data = io.BytesIO()
+                with tarfile.open(fileobj=data, mode="w") as archive:
+                    archive.add(dest, os.path.basename(dest))
+            body = data.getvalue()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-tar")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+        self.end_headers()
+        sent = 0
+        while True:
+            with container.cond:
+                while sent == len(container.output) and not container.done:
+                    container.cond.wait()
+                chunk = container.output[sent:]
+                done = container.done
+            if chunk:
+                self.wfile.write(b"\x01\0\0\0" + len(chunk).to_bytes(4, "big") + chunk)
+                sent += len(chunk)
+            elif done:
+                return
+
+    def do_POST(self):
+        path, query = self._route()
+        engine = self.server.engine
+        if path == "/build":
+            size = 0
+            with tempfile.TemporaryFile() as context:
+                for chunk in self._chunked_body():
+                    size += len(chunk)
+                    context.write(chunk)
+                context.seek(0)
+                with tarfile.open(fileobj=context, mode="r|") as archive:
+                    for _ in archive:
+                        pass
+            with open(os.path.join(engine.state, "context-bytes"), "a", encoding="utf-8") as f:
+                f.write(f"{query['t']} {size}\n")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            proc = subprocess.Popen(
+                [STUB_DOCKER, "build", ".", "-t", query["t"]],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+            for line in proc.stdout:
+                event = {"stream": line.decode("utf-8", errors="replace")}
+                self.wfile.write(json.dumps(event).encode("utf-8") + b"\r\n")
+            if proc.wait():
+                self.wfile.write(json.dumps({"error": "build failed"}).encode("utf-8") + b"\r\n")
+                return
+            image = docker("image", "inspect", "--format", "{{.Id}}", query["t"])
+            event = {"aux": {"ID": image.stdout.decode().strip()}}
+            self.wfile.write(json.dumps(event).encode("utf-8") + b"\r\n")
+            return
+        if path == "/containers/create":
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            cid = f"{next(engine.ids):064x}"
+            with engine.lock:
+                engine.containers[cid] = Container(query.get("name", cid[:12]), body)
+            return self._json(201, {"Id": cid})
+        match = re.fullmatch(r"/containers/([^/]+)/(start|wait|kill)", path)
+        if not match:
+            return self._json(404, {"message": f"no route for {path}"})
+        try:
+            container = engine.container(match[1])
+        except KeyError:
+            return self._json(404, {"message": f"no such container: {match[1]}"})
+        if match[2] == "start":
+            container.start()
+            self.send_response(204)
+            self.end_headers()
+        elif match[2] == "wait":
+            with container.cond:
+                while not container.done:
+                    container.cond.wait()
+            self._json(200, {"StatusCode": container.proc.returncode})
+        else:
+            if container.proc:
+                container.proc.kill()
+            self.send_response(204)
+            self.end_headers()
+
+    def do_DELETE(self):
+        path, _ = self._route()
+        match = re.fullmatch(r"/containers/([^/]+)", path)
+        engine = self.server.engine
+        with engine.lock:
+            for cid, container in list(engine.containers.items()):
+                if match and match[1] in (cid, container.name):
+                    del engine.containers[cid]
+        self.send_response(204)
+        self.end_headers()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main(socket_path: str):
+    state = os.environ["BENCH_STATE"]
+    os.makedirs(state, exist_ok=True)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = Server(socket_path, Handler)
+    server.engine = Engine(state)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
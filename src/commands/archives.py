@@ -0,0 +1,179 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import typing
+from . import pipeline
+
+
+# bytes fed to the decompressor per read of the archive
+CHUNK_SIZE = 1024 * 1024
+
+# how often an archive that is still being downloaded is checked for more data
+FOLLOW_INTERVAL = 0.05
+
+# decompressors by archive suffix, parallel ones first; the first one found on
+# PATH is used
+DECOMPRESSORS = {
+    ".tar.gz": (["pigz", "-dc"], ["gzip", "-dc"]),
+    ".tgz": (["pigz", "-dc"], ["gzip", "-dc"]),
+    ".tar.xz": (["xz", "-dc", "-T0"],),
+    ".txz": (["xz", "-dc", "-T0"],),
+    ".tar.bz2": (["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]),
+    ".tbz2": (["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]),
+    ".tar.zst": (["zstd", "-dc"],),
+    ".tar": (["cat"],),
+}
+
+# `SHA512 (name) = hash` lines, or `hash  name` in the older format
+SOURCES_LINE_PATTERN = re.compile(r"^(?:\w+ \((?P<name>[^)]+)\) = \w+|\w+\s+(?P<old_name>\S+))$")
+
+
+def archive_suffix(name: str) -> typing.Optional[str]:
+    matches = [s for s in DECOMPRESSORS if name.endswith(s)]
+    return max(matches, key=len) if matches else None
+
+
+def decompressor(path: str) -> typing.List[str]:
+    suffix = archive_suffix(path)
+    if suffix is None:
+        raise ValueError(f"{path} is not a supported archive")
+    for command in DECOMPRESSORS[suffix]:
+        if shutil.which(command[0]):
+            return command
+    names = ", ".join(c[0] for c in DECOMPRESSORS[suffix])
+    raise RuntimeError(f"cannot decompress {path}: none of {names} is installed")
+
+
+def sources_archives(distgit_path: str) -> typing.List[str]:
+    """
+    Returns the archives a dist-git checkout's `sources` file lists, in order.
+    """
+    sources_path = os.path.join(distgit_path, "sources")
+    if not os.path.isfile(sources_path):
+        return []
+    names = []
+    with open(sources_path, "r", encoding="utf-8") as f:
+        for line in f:
+            match = SOURCES_LINE_PATTERN.match(line.strip())
+            if not match:
+                continue
+            name = match.group("name") or match.group("old_name")
+            if archive_suffix(name):
+                names.append(name)
+    return names
+
+
+def find_archive(directory: str) -> typing.Optional[str]:
+    """
+    Returns the first supported archive in directory, by name.
+    """
+    for name in sorted(os.listdir(directory)):
+        if archive_suffix(name) and os.path.isfile(os.path.join(directory, name)):
+            return os.path.join(directory, name)
+    return None
+
+
+def wait_for(path: str, done: typing.Callable[[], bool]) -> bool:
+    """
+    Waits until path exists or done() returns True. Returns whether it exists.
+    """
+    while not os.path.exists(path) and not done():
+        pipeline.check_cancelled()
+        time.sleep(FOLLOW_INTERVAL)
+    return os.path.exists(path)
+
+
+def follow(path: str, sink: typing.BinaryIO, done: typing.Callable[[], bool]):
+    """
+    Copies path into sink as it grows, until done() returns True and all of
+    the file has been copied.
+    """
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if chunk:
+                sink.write(chunk)
+                continue
+            if done():
+                # anything appended between the last read and done()
+                rest = f.read()
+                if not rest:
+                    return
+                sink.write(rest)
+                continue
+            pipeline.check_cancelled()
+            time.sleep(FOLLOW_INTERVAL)
+
+
+def top_level_dir(members: typing.List[str]) -> str:
+    tops = set()
+    for name in members:
+        if name.startswith("./"):
+            name = name[2:]
+        top = name.split("/", 1)[0]
+        if top and top != ".":
+            tops.add(top)
+    if len(tops) != 1:
+        raise RuntimeError(
+            f"expected one top-level directory in the archive, found {len(tops)}"
+        )
+    return tops.pop()
+
+
+def extract(
+    path: str, dest: str, done: typing.Optional[typing.Callable[[], bool]] = None
+) -> str:
+    """
+    Streams the archive at path through its decompressor into tar in dest
+    and returns the path of its top-level directory, read from the member
+    list. With done, path may still be being written: it is followed until
+    done() returns True, so extraction overlaps the download.
+    """
+    with tempfile.TemporaryFile() as members, tempfile.TemporaryFile() as errors:
+        pipeline.check_cancelled()
+        decompress_proc = subprocess.Popen(
+            decompressor(path), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=errors
+        )
+        tar_proc = subprocess.Popen(
+            ["tar", "-xvf", "-"],
+            stdin=decompress_proc.stdout,
+            stdout=members,
+            stderr=errors,
+            cwd=dest,
+        )
+        decompress_proc.stdout.close()
+        procs = (decompress_proc, tar_proc)
+        for proc in procs:
+            pipeline.track(proc)
+        try:
+            try:
+                follow(path, decompress_proc.stdin, done or (lambda: True))
+            except BrokenPipeError:
+                # the decompressor or tar gave up; their exit codes say why
+                pass
+            except BaseException:
+                for proc in procs:
+                    proc.kill()
+                raise
+            finally:
+                try:
+                    decompress_proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+                for proc in procs:
+                    pipeline.reap(proc)
+        finally:
+            for proc in procs:
+                pipeline.untrack(proc)
+        pipeline.check_cancelled()
+        if any(proc.returncode != 0 for proc in procs):
+            errors.seek(0)
+            raise RuntimeError(
+                f"failed to extract {path}: {errors.read().decode('utf-8', errors='replace')}"
+            )
+        members.seek(0)
+        names = members.read().decode("utf-8", errors="replace").splitlines()
+    return os.path.join(dest, top_level_dir(names))
@@ -0,0 +1,542 @@
+import collections
+import functools
+import os
+import re
+import shutil
+import tempfile
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import click
+import yaml
+from . import cache
+from . import config as config_module
+from . import downstream as downstream_module
+from . import fastpath as fastpath_module
+from . import fixmorph as fixmorph_module
+from . import history as history_module
+from . import logs
+from . import profiling
+from . import results as results_module
+from . import scheduler as scheduler_module
+from . import upstream as upstream_module
+from . import workspace as workspace_module
+
+
+@dataclass(frozen=True)
+class Pair:
+    commit_id: str
+    branch_name: str
+
+    @property
+    def name(self) -> str:
+        return re.sub(r"[^A-Za-z0-9._-]", "_", f"{self.commit_id}_{self.branch_name}")
+
+
+@dataclass
+class PairResult:
+    pair: Pair
+    status: str
+    exit_code: typing.Optional[int] = None
+    patch_path: typing.Optional[str] = None
+    error: typing.Optional[str] = None
+    cached: bool = False
+    ccache: typing.Optional[typing.Dict[str, typing.Any]] = None
+    # path -> how the fast path carried it over, for files FixMorph didn't see
+    fast_path: typing.Dict[str, str] = field(default_factory=dict)
+    timings: typing.Dict[str, float] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {
+            "commit": self.pair.commit_id,
+            "branch": self.pair.branch_name,
+            "status": self.status,
+            "exit_code": self.exit_code,
+            "patch": self.patch_path,
+            "error": self.error,
+            "cached": self.cached,
+            "ccache": self.ccache,
+            "fast_path": self.fast_path,
+            "timings": self.timings,
+        }
+
+
+def read_manifest(stream: typing.TextIO) -> typing.List[Pair]:
+    """
+    Reads commit/branch pairs from a YAML or JSON manifest. Accepts a list of
+    {commit, branch} entries, a mapping with such a list under `pairs`, or a
+    mapping with `commits` and `branches` lists meaning every combination.
+    """
+    raw = yaml.safe_load(stream)
+    if raw is None:
+        return []
+    if isinstance(raw, dict) and "pairs" not in raw:
+        return [
+            Pair(str(commit), str(branch))
+            for commit in raw.get("commits", [])
+            for branch in raw.get("branches", [])
+        ]
+    entries = raw["pairs"] if isinstance(raw, dict) else raw
+    pairs = []
+    for entry in entries:
+        if "commit" not in entry or "branch" not in entry:
+            raise click.BadParameter(
+                f"manifest entry {entry} needs both a 'commit' and a 'branch'"
+            )
+        pairs.append(Pair(str(entry["commit"]), str(entry["branch"])))
+    # keep the first occurrence of every pair
+    unique = dict.fromkeys((p.commit_id, p.branch_name) for p in pairs)
+    return [Pair(commit, branch) for commit, branch in unique]
+
+
+def _timed(
+    profiler: profiling.Profiler,
+    timings: typing.Dict[str, float],
+    key: str,
+    stage: str,
+    fn,
+    *args,
+):
+    """
+    Runs fn under profiler as stage, logging its output as that stage, and
+    stores its wall time in timings[key].
+    """
+    record = None
+    try:
+        with logs.stage(stage), profiler.measure(stage) as record:
+            return fn(*args)
+    finally:
+        if record:
+            timings[key] = round(record.wall_seconds, 3)
+
+
+def run_pair(
+    pair: Pair,
+    upstream_dir: str,
+    upstream_patch: str,
+    downstream_dir: str,
+    toolchain_image: str,
+    work_dir: str,
+    output_dir: str,
+    profiler: profiling.Profiler,
+    conf: config_module.BackporterConfig,
+    parallel: int = 1,
+) -> PairResult:
+    """
+    Carries upstream_patch over with the fast path where it can, and builds
+    and runs FixMorph for the rest, from already prepared trees. Its
+    containers are sized for `parallel` pairs running at once and wait for
+    the scheduler to admit them.
+    """
+    run_mode = conf.run_mode
+    scheduler = scheduler_module.for_config(conf)
+    cost = scheduler.job_cost(parallel)
+    result_dir = os.path.join(output_dir, pair.name)
+    os.makedirs(result_dir, exist_ok=True)
+    log_path = os.path.join(result_dir, "fixmorph.log")
+    with open(os.path.join(result_dir, "upstream.patch"), "w", encoding="utf-8") as f:
+        f.write(upstream_patch)
+
+    result = PairResult(pair, status="failed")
+    context_dir = os.path.join(work_dir, "pairs", pair.name)
+    os.makedirs(context_dir)
+    try:
+        fast = fastpath_module.apply(
+            upstream_dir,
+            downstream_dir,
+            upstream_patch,
+            os.path.join(context_dir, "fastpath"),
+        )
+        result.fast_path = fast.methods
+        if not fast.remaining:
+            click.secho(
+                f"[{pair.name}] upstream.patch carried over without FixMorph", fg="green"
+            )
+            result.patch_path = os.path.join(result_dir, "patch.diff")
+            with open(result.patch_path, "w", encoding="utf-8") as f:
+                f.write(fast.patch)
+            result.exit_code = 0
+            result.status = "ok"
+            return result
+
+        # A and B only add files when built, so they can share the bootstrapped
+        # upstream; C is rewritten by FixMorph and needs its own copy
+        cache.link_tree(upstream_dir, os.path.join(context_dir, "upstream"))
+        if run_mode == "mount":
+            cache.copy_tree(downstream_dir, os.path.join(context_dir, "downstream"))
+        else:
+            cache.link_tree(downstream_dir, os.path.join(context_dir, "downstream"))
+        if run_mode == "mount":
+            click.secho(f"[{pair.name}] running FixMorph with mounted sources")
+            trees = {
+                "a": os.path.join(context_dir, "upstream"),
+                "b": os.path.join(context_dir, "patched"),
+                "c": os.path.join(context_dir, "downstream"),
+            }
+            workspace_module.create_patched_tree(trees["a"], fast.remaining, trees["b"])
+            with scheduler.slot(cost, name=pair.name) as granted:
+                rc, patch_path = _timed(
+                    profiler, result.timings, "fixmorph", f"{pair.name}:fixmorph",
+                    fixmorph_module.run_mounted,
+                    toolchain_image, trees, context_dir, result_dir, log_path,
+                    granted.cpus,
+                    fixmorph_module.build_cache_args(conf)
+                    + scheduler_module.limit_args(granted),
+                )
+        else:
+            fixmorph_module.assemble_context(context_dir, fast.remaining)
+
+            # the batch's work dir tells concurrent batches of the same pair apart
+            tag = f"fixmorph-frr:{pair.name.lower()}-{os.path.basename(work_dir).lower()}"
+            click.secho(f"[{pair.name}] building image {tag}")
+            # docker build takes no resource limits with BuildKit; it only
+            # bootstraps, so it's admitted at a bootstrap's cost
+            with scheduler.slot(
+                scheduler_module.BOOTSTRAP_COST, scheduler_module.PRIORITY_BUILD, pair.name
+            ):
+                rc = _timed(
+                    profiler, result.timings, "build", f"{pair.name}:build",
+                    fixmorph_module.build_image,
+                    context_dir, tag, toolchain_image, log_path, cost.cpus,
+                )
+            if rc != 0:
+                result.exit_code = rc
+                result.error = "docker build failed"
+                return result
+
+            click.secho(f"[{pair.name}] running FixMorph")
+            with scheduler.slot(cost, name=pair.name) as granted:
+                rc, patch_path = _timed(
+                    profiler, result.timings, "fixmorph", f"{pair.name}:fixmorph",
+                    fixmorph_module.run_image, tag, result_dir, log_path,
+                    fixmorph_module.build_cache_args(conf)
+                    + scheduler_module.limit_args(granted),
+                )
+        result.exit_code = rc
+        result.ccache = fixmorph_module.ccache_stats(
+            os.path.join(result_dir, fixmorph_module.CCACHE_STATS_LOG)
+        )
+        if rc == 0 and patch_path:
+            result.status = "ok"
+            result.patch_path = fastpath_module.write_patch(
+                os.path.join(result_dir, "patch.diff"), patch_path, fast.patch
+            )
+        elif rc == 0:
+            result.status = "no-patch"
+        else:
+            result.error = "FixMorph exited with an error"
+        return result
+    except Exception as e:
+        result.error = str(e)
+        return result
+    finally:
+        shutil.rmtree(context_dir, ignore_errors=True)
+        with open(os.path.join(result_dir, "result.yaml"), "w", encoding="utf-8") as f:
+            yaml.dump(result.to_dict(), f)
+
+
+def outcome(result: PairResult) -> str:
+    """
+    Returns how a pair got its patch, as recorded in the history.
+    """
+    if result.status != "ok":
+        return history_module.FAILED
+    if result.cached:
+        return history_module.STORED
+    if "fixmorph" not in result.timings:
+        return history_module.FAST_PATH
+    return history_module.FIXMORPH
+
+
+def by_estimate(
+    conf: config_module.BackporterConfig, pairs: typing.List[Pair]
+) -> typing.List[Pair]:
+    """
+    Orders pairs shortest expected backport first, from the run history. The
+    pairs of a branch stay together, ordered by the branch's shortest one, so
+    they follow each other through the compiler cache while it's warm with
+    that branch's objects. Without any history the order is kept.
+    """
+    seconds = {
+        pair: history_module.expected_seconds(conf, pair.branch_name, pair.commit_id) or 0.0
+        for pair in pairs
+    }
+    first = {}
+    for pair in sorted(pairs, key=seconds.get):
+        first.setdefault(pair.branch_name, seconds[pair])
+    return sorted(pairs, key=lambda p: (first[p.branch_name], p.branch_name, seconds[p]))
+
+
+def reuse_result(
+    pair: Pair, stored: results_module.StoredResult, upstream_patch: str, output_dir: str
+) -> PairResult:
+    """
+    Fills the pair's result directory from a stored FixMorph result.
+    """
+    result_dir = os.path.join(output_dir, pair.name)
+    os.makedirs(result_dir, exist_ok=True)
+    with open(os.path.join(result_dir, "upstream.patch"), "w", encoding="utf-8") as f:
+        f.write(upstream_patch)
+    result = PairResult(pair, status="ok", exit_code=stored.exit_code, cached=True)
+    result.patch_path = shutil.copy(
+        stored.patch_path, os.path.join(result_dir, "patch.diff")
+    )
+    with open(os.path.join(result_dir, "result.yaml"), "w", encoding="utf-8") as f:
+        yaml.dump(result.to_dict(), f)
+    return result
+
+
+def run_batch(
+    conf: config_module.BackporterConfig,
+    pairs: typing.List[Pair],
+    output_dir: str,
+    jobs: int,
+    profiler: typing.Optional[profiling.Profiler] = None,
+    no_cache: bool = False,
+    refresh: bool = False,
+    kind: str = "batch",
+) -> typing.List[PairResult]:
+    """
+    Prepares each distinct upstream commit and downstream branch once, ensures
+    the toolchain image once, then fans the pairs out over `jobs` workers,
+    shortest expected first. Pairs with a stored FixMorph result reuse it
+    unless no_cache or refresh is set, and fresh results are stored unless
+    no_cache is set. Every pair is recorded in the run history as `kind`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    commits = list(dict.fromkeys(p.commit_id for p in pairs))
+    branches = list(dict.fromkeys(p.branch_name for p in pairs))
+    # how many pairs build on each branch's tree
+    branch_pairs = collections.Counter(p.branch_name for p in pairs)
+    shared_timings: typing.Dict[str, float] = {}
+    profiler = profiler or profiling.Profiler()
+
+    with tempfile.TemporaryDirectory() as work_dir, ThreadPoolExecutor(
+        max_workers=max(1, jobs), initializer=logs.attach, initargs=(logs.active(),)
+    ) as pool:
+        def upstream_dir(commit_id: str) -> str:
+            return os.path.join(work_dir, "upstream", commit_id)
+
+        def downstream_dir(branch_name: str) -> str:
+            return os.path.join(work_dir, "downstream", branch_name)
+
+        upstream_futures = {
+            c: pool.submit(
+                _timed, profiler, shared_timings, f"upstream:{c}", f"upstream:{c}",
+                upstream_module.prepare_upstream, conf, c, upstream_dir(c),
+            )
+            for c in commits
+        }
+        downstream_futures = {
+            b: pool.submit(
+                _timed, profiler, shared_timings, f"downstream:{b}", f"downstream:{b}",
+                downstream_module.prepare_downstream,
+                conf, b, os.path.join(work_dir, "distgit", b), downstream_dir(b),
+                # bootstrapped in place in mount mode, or when shared in image mode
+                conf.run_mode == "mount" or branch_pairs[b] > 1,
+            )
+            for b in branches
+        }
+        toolchain_future = pool.submit(
+            _timed, profiler, shared_timings, "toolchain", "toolchain",
+            fixmorph_module.ensure_toolchain, conf, os.path.join(output_dir, "toolchain.log"),
+        )
+
+        errors: typing.Dict[str, str] = {}
+        patches: typing.Dict[str, str] = {}
+        for c, future in upstream_futures.items():
+            try:
+                patches[c] = future.result()
+            except Exception as e:
+                errors[f"upstream:{c}"] = str(e)
+        downstream_keys: typing.Dict[str, typing.Optional[str]] = {}
+        for b, future in downstream_futures.items():
+            try:
+                downstream_keys[b] = future.result()
+            except Exception as e:
+                errors[f"downstream:{b}"] = str(e)
+        toolchain_image = None
+        try:
+            toolchain_image = toolchain_future.result()
+        except Exception as e:
+            errors["toolchain"] = str(e)
+
+        store = results_module.ResultStore.from_config(conf)
+        keys: typing.Dict[Pair, str] = {}
+        stored: typing.Dict[Pair, results_module.StoredResult] = {}
+        if not no_cache and toolchain_image:
+            image_id = fixmorph_module.image_id(toolchain_image)
+            inputs_digest = fixmorph_module.run_inputs_digest(conf.run_mode)
+            shas = {
+                c: upstream_module.resolve_commit(upstream_dir(c), c) for c in patches
+            }
+            for pair in pairs:
+                # trees whose prep failed have no stable fingerprint
+                if pair.commit_id in shas and downstream_keys.get(pair.branch_name):
+                    keys[pair] = store.key(
+                        shas[pair.commit_id],
+                        downstream_keys[pair.branch_name],
+                        image_id,
+                        inputs_digest,
+                    )
+                    hit = None if refresh else store.get(keys[pair])
+                    if hit:
+                        stored[pair] = hit
+        pending = [p for p in pairs if p not in stored]
+        # the FixMorph runs meant to share the budget at once
+        parallel = max(1, min(jobs, len(pending)))
+
+        if toolchain_image:
+            # bootstrap every shared tree once instead of once per pair. In
+            # image mode, a tree only one pending pair uses just gets stored
+            # output restored and is left to its image build; one several
+            # pairs build on is bootstrapped here, so their builds skip it
+            bootstrap_store = workspace_module.BootstrapCache.from_config(conf)
+            bootstrap = functools.partial(
+                workspace_module.bootstrap_tree,
+                store=bootstrap_store,
+                scheduler=scheduler_module.for_config(conf),
+            )
+            restore = functools.partial(workspace_module.restore_bootstrap, bootstrap_store)
+            pending_commits = collections.Counter(p.commit_id for p in pending)
+            pending_branches = collections.Counter(p.branch_name for p in pending)
+            bootstrap_futures = {
+                key: pool.submit(
+                    _timed, profiler, shared_timings, f"bootstrap:{key}", f"bootstrap:{key}",
+                    bootstrap if conf.run_mode == "mount" or users > 1 else restore,
+                    toolchain_image, tree,
+                )
+                for key, tree, users in [
+                    (f"upstream:{c}", upstream_dir(c), pending_commits[c])
+                    for c in patches
+                    if pending_commits[c]
+                ]
+                + [
+                    (f"downstream:{b}", downstream_dir(b), pending_branches[b])
+                    for b in branches
+                    if f"downstream:{b}" not in errors and pending_branches[b]
+                ]
+            }
+            for key, future in bootstrap_futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[key] = str(e)
+
+        def run(pair: Pair) -> PairResult:
+            started = time.time()
+            result = run_prepared(pair)
+            failed_stage = None
+            if result.status == "failed" and not result.timings:
+                # its shared trees failed before it got to a stage of its own
+                failed_stage = "prepare"
+            history_module.record_run(
+                conf,
+                kind,
+                pair.branch_name,
+                pair.commit_id,
+                outcome(result),
+                started,
+                history_module.stage_records(result.timings),
+                wall_seconds=sum(result.timings.values()),
+                failed_stage=failed_stage,
+                ccache=result.ccache,
+            )
+            return result
+
+        def run_prepared(pair: Pair) -> PairResult:
+            failed = [
+                errors[key]
+                for key in (
+                    f"upstream:{pair.commit_id}",
+                    f"downstream:{pair.branch_name}",
+                    "toolchain",
+                )
+                if key in errors
+            ]
+            if failed:
+                return PairResult(pair, status="failed", error="; ".join(failed))
+            if pair in stored:
+                click.secho(f"[{pair.name}] reusing stored FixMorph result", fg="green")
+                result = reuse_result(
+                    pair, stored[pair], patches[pair.commit_id], output_dir
+                )
+                result.timings["upstream"] = shared_timings[f"upstream:{pair.commit_id}"]
+                result.timings["downstream"] = shared_timings[f"downstream:{pair.branch_name}"]
+                return result
+            result = run_pair(
+                pair,
+                upstream_dir(pair.commit_id),
+                patches[pair.commit_id],
+                downstream_dir(pair.branch_name),
+                toolchain_image,
+                work_dir,
+                output_dir,
+                profiler,
+                conf,
+                parallel,
+            )
+            result.timings["upstream"] = shared_timings[f"upstream:{pair.commit_id}"]
+            result.timings["downstream"] = shared_timings[f"downstream:{pair.branch_name}"]
+            if result.status == "ok" and pair in keys:
+                store.put(
+                    keys[pair],
+                    result.exit_code,
+                    result.patch_path,
+                    [os.path.join(output_dir, pair.name, "fixmorph.log")],
+                    {
+                        "commit": pair.commit_id,
+                        "branch": pair.branch_name,
+                        "run_mode": conf.run_mode,
+                    },
+                )
+            return result
+
+        # stored results first, they're only copied
+        order = [p for p in pairs if p in stored] + by_estimate(conf, pending)
+        finished = dict(zip(order, pool.map(run, order)))
+        results = [finished[p] for p in pairs]
+
+    with open(os.path.join(output_dir, "summary.yaml"), "w", encoding="utf-8") as f:
+        yaml.dump(
+            {
+                "shared_timings": shared_timings,
+                "scheduler": scheduler_module.for_config(conf).stats(),
+                "results": [r.to_dict() for r in results],
+            },
+            f,
+        )
+    return results
+
+
+def format_status(result: PairResult) -> str:
+    if result.cached:
+        return f"{result.status} (cached)"
+    if result.status == "ok" and result.fast_path and "fixmorph" not in result.timings:
+        return f"{result.status} (fast path)"
+    return result.status
+
+
+def format_summary(results: typing.List[PairResult]) -> str:
+    """
+    Renders the batch results as a plain-text table.
+    """
+    rows = [("COMMIT", "BRANCH", "STATUS", "EXIT", "BUILD+RUN (s)", "CCACHE", "PATCH")]
+    for r in results:
+        rows.append(
+            (
+                r.pair.commit_id,
+                r.pair.branch_name,
+                format_status(r),
+                "-" if r.exit_code is None else str(r.exit_code),
+                f"{r.timings.get('build', 0) + r.timings.get('fixmorph', 0):.1f}",
+                fixmorph_module.format_ccache(r.ccache),
+                r.patch_path or r.error or "-",
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]) - 1)]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)) + "  " + row[-1]
+        for row in rows
+    )
@@ -0,0 +1,150 @@
+import fcntl
+import os
+import shutil
+import time
+import typing
+from . import pipeline
+
+
+LAST_USED_MARKER = ".backporter-last-used"
+
+
+class FileLock:
+    """
+    Advisory lock backed by flock(2) on a file next to the thing being protected.
+    Use shared=True for readers and the default exclusive mode for writers.
+    """
+
+    def __init__(self, path: str, shared: bool = False, blocking: bool = True):
+        self.path = path
+        self.shared = shared
+        self.blocking = blocking
+        self._fd: typing.Optional[int] = None
+
+    def acquire(self) -> bool:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not self.blocking:
+            mode |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._fd, mode)
+        except BlockingIOError:
+            os.close(self._fd)
+            self._fd = None
+            return False
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def touch(entry: str):
+    """
+    Marks a cache entry as recently used so that eviction keeps it around.
+    """
+    marker = os.path.join(entry, LAST_USED_MARKER)
+    with open(marker, "a", encoding="utf-8"):
+        pass
+    os.utime(marker)
+
+
+def last_used(entry: str) -> float:
+    marker = os.path.join(entry, LAST_USED_MARKER)
+    try:
+        return os.path.getmtime(marker)
+    except OSError:
+        return os.path.getmtime(entry)
+
+
+def dir_size(path: str) -> int:
+    """
+    Returns the on-disk size of a directory tree in bytes. Hardlinked files are
+    only counted once.
+    """
+    seen = set()
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def evict(
+    entries: typing.List[str],
+    max_size: int,
+    grace_seconds: float = 0,
+    lock_for: typing.Optional[typing.Callable[[str], str]] = None,
+) -> typing.List[str]:
+    """
+    Removes the least recently used entries until the combined size fits in
+    max_size. Entries used within grace_seconds, or whose lock is currently held
+    by another process, are never removed. Returns the removed paths.
+    """
+    sized = [(last_used(e), dir_size(e), e) for e in entries if os.path.isdir(e)]
+    total = sum(size for _, size, _ in sized)
+    removed = []
+    now = time.time()
+    for used, size, entry in sorted(sized):
+        if total <= max_size:
+            break
+        if now - used < grace_seconds:
+            continue
+        lock = None
+        if lock_for:
+            lock = FileLock(lock_for(entry), blocking=False)
+            if not lock.acquire():
+                continue
+        try:
+            shutil.rmtree(entry, ignore_errors=True)
+        finally:
+            if lock:
+                lock.release()
+        total -= size
+        removed.append(entry)
+    return removed
+
+
+def link_tree(src: str, dst: str):
+    """
+    Materialises a cached tree at dst without copying file contents: reflinks
+    where the filesystem supports them, otherwise a hardlink farm. Cached files
+    are shared with the materialised tree, so anything that rewrites a file in
+    place must replace it instead (as git, patch and make do).
+    """
+    reflink_proc = pipeline.run_command(
+        ["cp", "-a", "--reflink=always", src, dst], capture_output=True
+    )
+    if reflink_proc.returncode == 0:
+        return
+    shutil.rmtree(dst, ignore_errors=True)
+    shutil.copytree(src, dst, symlinks=True, copy_function=os.link)
+
+
+def copy_tree(src: str, dst: str):
+    """
+    Makes an independent copy of src at dst, sharing extents through reflinks
+    where the filesystem supports them. Use this instead of link_tree for
+    trees that will be built or modified in place.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    pipeline.run_command(
+        ["cp", "-a", "--reflink=auto", src, dst], check=True, capture_output=True
+    )
@@ -1,5 +1,6 @@
+import os
 import typing
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 import click
 import yaml
@@ -7,12 +8,89 @@ import yaml
 
 DEFAULT_CONFIG = "config.yaml"
 DEFAULT_FIXMORPH_BASE_IMAGE = "quay.io/cve-gen-ai/et-fixmorph:latest"
+DEFAULT_CACHE_DIR = "~/.cache/backporter"
+DEFAULT_MIRROR_MAX_SIZE = 20 * 1024 * 1024 * 1024
+DEFAULT_DISTGIT_CACHE_MAX_SIZE = 20 * 1024 * 1024 * 1024
+DEFAULT_RESULT_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+DEFAULT_RESULT_CACHE_MAX_AGE_DAYS = 30
+# 0 gives each build an even share of max_cpus among the builds meant to run
+# at once (all of them for a single create)
+DEFAULT_BUILD_JOBS = 0
+# CPUs and memory (e.g. "48G") the containers of this process may use
+# together; 0 and empty detect the host's CPUs and 90% of its memory
+DEFAULT_MAX_CPUS = 0
+DEFAULT_MAX_MEMORY = ""
+# memory one FixMorph container is expected to need; empty estimates it from
+# the package and the build's job count
+DEFAULT_JOB_MEMORY = ""
+# docker volume holding the compiler cache shared by the A/B/C builds of
+# every run; empty keeps the cache inside each container
+DEFAULT_CCACHE_VOLUME = "backporter-ccache"
+DEFAULT_CCACHE_MAX_SIZE = "20G"
+# docker volume holding the autoconf config.cache files shared by the
+# configure runs of every tree and run; empty keeps them inside each container
+DEFAULT_CONFIGURE_CACHE_VOLUME = "backporter-configure-cache"
+DEFAULT_BOOTSTRAP_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+DEFAULT_COMPILE_DB_CACHE_MAX_SIZE = 512 * 1024 * 1024
+# dist-git branches `backporter warm` prepares when none are given
+DEFAULT_WARM_BRANCHES: typing.List[str] = []
+# finished runs kept in the run history that estimates and orders backports
+DEFAULT_HISTORY_MAX_RUNS = 10000
+# where `backporter serve` listens and `create --daemon` submits to: a Unix
+# socket path or http://127.0.0.1:PORT; empty is daemon.sock in the cache dir
+DEFAULT_DAEMON_ADDRESS = ""
+# backport jobs the daemon runs at once
+DEFAULT_DAEMON_WORKERS = 2
+# mirror: incremental bare mirror in the cache dir
+# shallow: fetch only the commit and its parent
+# partial: blobless clone with lazily fetched file contents
+UPSTREAM_FETCH_MODES = ("mirror", "shallow", "partial")
+DEFAULT_UPSTREAM_FETCH = "mirror"
+# image: bake the sources into a per-job image and run it
+# mount: run the toolchain image with the sources bind-mounted from the host
+RUN_MODES = ("image", "mount")
+DEFAULT_RUN_MODE = "image"
+# cli: spawn `docker` processes
+# api: talk to the Docker (or Podman) Engine API on docker_host
+CONTAINER_BACKENDS = ("cli", "api")
+DEFAULT_CONTAINER_BACKEND = "cli"
+# the Engine API address, e.g. unix:///run/podman/podman.sock; empty is
+# $DOCKER_HOST or the local Docker socket
+DEFAULT_DOCKER_HOST = ""
 
 @dataclass
 class BackporterConfig:
     fixmorph_base_image: typing.Optional[str]
     upstream_url: str
     distgit_repo: str
+    cache_dir: str = DEFAULT_CACHE_DIR
+    mirror_max_size: int = DEFAULT_MIRROR_MAX_SIZE
+    upstream_fetch: str = DEFAULT_UPSTREAM_FETCH
+    distgit_cache_max_size: int = DEFAULT_DISTGIT_CACHE_MAX_SIZE
+    run_mode: str = DEFAULT_RUN_MODE
+    container_backend: str = DEFAULT_CONTAINER_BACKEND
+    docker_host: str = DEFAULT_DOCKER_HOST
+    result_cache_max_size: int = DEFAULT_RESULT_CACHE_MAX_SIZE
+    result_cache_max_age_days: int = DEFAULT_RESULT_CACHE_MAX_AGE_DAYS
+    build_jobs: int = DEFAULT_BUILD_JOBS
+    max_cpus: int = DEFAULT_MAX_CPUS
+    max_memory: str = DEFAULT_MAX_MEMORY
+    job_memory: str = DEFAULT_JOB_MEMORY
+    daemon_address: str = DEFAULT_DAEMON_ADDRESS
+    daemon_workers: int = DEFAULT_DAEMON_WORKERS
+    ccache_volume: str = DEFAULT_CCACHE_VOLUME
+    ccache_max_size: str = DEFAULT_CCACHE_MAX_SIZE
+    configure_cache_volume: str = DEFAULT_CONFIGURE_CACHE_VOLUME
+    bootstrap_cache_max_size: int = DEFAULT_BOOTSTRAP_CACHE_MAX_SIZE
+    compile_db_cache_max_size: int = DEFAULT_COMPILE_DB_CACHE_MAX_SIZE
+    history_max_runs: int = DEFAULT_HISTORY_MAX_RUNS
+    warm_branches: typing.List[str] = field(default_factory=lambda: list(DEFAULT_WARM_BRANCHES))
+
+    def cache_path(self, *parts: str) -> str:
+        """
+        Returns a path inside the (user-expanded) cache directory.
+        """
+        return os.path.join(os.path.expanduser(self.cache_dir), *parts)
 
     def to_file(self, fp: str):
         """
@@ -32,11 +110,54 @@ def read_config(fp: str) -> BackporterConfig:
     """
     with open(fp, "r", encoding="utf-8") as infile:
         raw_config: dict = yaml.load(infile, Loader=yaml.FullLoader)
-    
+    return parse_config(raw_config)
+
+
+def parse_config(raw_config: dict) -> BackporterConfig:
+    """
+    Builds a BackporterConfig from the mapping of a config file, filling in
+    the defaults of missing settings.
+    """
     config = BackporterConfig(
         distgit_repo=raw_config["distgit_repo"],
         fixmorph_base_image=raw_config.get("fixmorph_base_image"),
         upstream_url=raw_config["upstream_url"],
+        cache_dir=raw_config.get("cache_dir", DEFAULT_CACHE_DIR),
+        mirror_max_size=int(raw_config.get("mirror_max_size", DEFAULT_MIRROR_MAX_SIZE)),
+        upstream_fetch=raw_config.get("upstream_fetch", DEFAULT_UPSTREAM_FETCH),
+        distgit_cache_max_size=int(
+            raw_config.get("distgit_cache_max_size", DEFAULT_DISTGIT_CACHE_MAX_SIZE)
+        ),
+        run_mode=raw_config.get("run_mode", DEFAULT_RUN_MODE),
+        container_backend=raw_config.get("container_backend", DEFAULT_CONTAINER_BACKEND),
+        docker_host=raw_config.get("docker_host", DEFAULT_DOCKER_HOST),
+        result_cache_max_size=int(
+            raw_config.get("result_cache_max_size", DEFAULT_RESULT_CACHE_MAX_SIZE)
+        ),
+        result_cache_max_age_days=int(
+            raw_config.get("result_cache_max_age_days", DEFAULT_RESULT_CACHE_MAX_AGE_DAYS)
+        ),
+        build_jobs=int(raw_config.get("build_jobs", DEFAULT_BUILD_JOBS)),
+        max_cpus=int(raw_config.get("max_cpus", DEFAULT_MAX_CPUS)),
+        max_memory=str(raw_config.get("max_memory", DEFAULT_MAX_MEMORY)),
+        job_memory=str(raw_config.get("job_memory", DEFAULT_JOB_MEMORY)),
+        daemon_address=raw_config.get("daemon_address", DEFAULT_DAEMON_ADDRESS),
+        daemon_workers=int(raw_config.get("daemon_workers", DEFAULT_DAEMON_WORKERS)),
+        ccache_volume=raw_config.get("ccache_volume", DEFAULT_CCACHE_VOLUME),
+        ccache_max_size=str(raw_config.get("ccache_max_size", DEFAULT_CCACHE_MAX_SIZE)),
+        configure_cache_volume=raw_config.get(
+            "configure_cache_volume", DEFAULT_CONFIGURE_CACHE_VOLUME
+        ),
+        bootstrap_cache_max_size=int(
+            raw_config.get("bootstrap_cache_max_size", DEFAULT_BOOTSTRAP_CACHE_MAX_SIZE)
+        ),
+        compile_db_cache_max_size=int(
+            raw_config.get("compile_db_cache_max_size", DEFAULT_COMPILE_DB_CACHE_MAX_SIZE)
+        ),
+        history_max_runs=int(raw_config.get("history_max_runs", DEFAULT_HISTORY_MAX_RUNS)),
+        warm_branches=[
+            str(branch) for branch in raw_config.get("warm_branches") or DEFAULT_WARM_BRANCHES
+        ],
     )
     return config
 
@@ -0,0 +1,636 @@
+import fnmatch
+import http.client
+import io
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tarfile
+import threading
+import typing
+import urllib.parse
+from . import config as config_module
+from . import logs
+from . import pipeline
+
+
+DEFAULT_DOCKER_HOST = "unix:///var/run/docker.sock"
+
+# the oldest Engine API with the platform parameter on container create;
+# Podman's Docker-compatible API serves it as well
+API_VERSION = "v1.41"
+
+PLATFORM = "linux/amd64"
+
+# bytes of a build context or container output handed on per read
+CHUNK_SIZE = 64 * 1024
+
+# docker run flags the API backend understands, by whether they take a value
+RUN_FLAGS = {
+    "--rm": False,
+    "--name": True,
+    "--platform": True,
+    "-e": True,
+    "-v": True,
+    "-w": True,
+    "--user": True,
+    "--cpus": True,
+    "--memory": True,
+    "--memory-swap": True,
+}
+
+# docker run's memory units, binary whether or not they're spelled KiB etc.
+MEMORY_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4, "p": 1024**5}
+
+
+def stream_process(
+    command: typing.List[str], cwd: typing.Optional[str] = None, log_path: typing.Optional[str] = None
+) -> int:
+    """
+    Runs command, handing its combined output to the active run log (and to
+    log_path when given), and returns its exit code.
+    """
+    pipeline.check_cancelled()
+    proc = subprocess.Popen(
+        command,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    pipeline.track(proc)
+    try:
+        logs.capture(proc.stdout, log_path)
+        proc.stdout.close()
+        rc = pipeline.reap(proc)
+        pipeline.check_cancelled()
+        return rc
+    except KeyboardInterrupt:
+        print("\nCtrl+C pressed, terminating subprocess...")
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            print("Subprocess did not terminate in time, killing it.")
+            proc.kill()
+        sys.exit(1)
+    finally:
+        pipeline.untrack(proc)
+
+
+def ignored(path: str, patterns: typing.Sequence[str]) -> bool:
+    """
+    Whether a context-relative path matches one of the .dockerignore
+    patterns used here: globs anchored at the context root, or starting
+    with **/ to match at any depth.
+    """
+    for pattern in patterns:
+        if pattern.startswith("**/"):
+            name = pattern[3:]
+            if fnmatch.fnmatchcase(path, name) or fnmatch.fnmatchcase(path, "*/" + name):
+                return True
+        elif fnmatch.fnmatchcase(path, pattern):
+            return True
+    return False
+
+
+def read_dockerignore(context_dir: str) -> typing.List[str]:
+    try:
+        with open(os.path.join(context_dir, ".dockerignore"), "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    except FileNotFoundError:
+        return []
+
+
+def context_files(
+    context_dir: str,
+    include: typing.Optional[typing.Sequence[str]] = None,
+    ignore: typing.Sequence[str] = (),
+) -> typing.Iterator[str]:
+    """
+    Yields the context-relative paths of a build context: the top-level
+    entries in include (everything when None) and what's below them, minus
+    the ignored paths. Ignored directories aren't descended into.
+    """
+    tops = include if include is not None else sorted(os.listdir(context_dir))
+    for top in tops:
+        if ignored(top, ignore) or not os.path.lexists(os.path.join(context_dir, top)):
+            continue
+        yield top
+        if os.path.islink(os.path.join(context_dir, top)):
+            continue
+        for root, dirs, names in os.walk(os.path.join(context_dir, top)):
+            rel_root = os.path.relpath(root, context_dir)
+            dirs[:] = sorted(d for d in dirs if not ignored(os.path.join(rel_root, d), ignore))
+            for name in sorted(dirs) + sorted(names):
+                path = os.path.join(rel_root, name)
+                if not ignored(path, ignore):
+                    yield path
+
+
+class CliEngine:
+    """
+    Drives containers through the `docker` CLI.
+    """
+
+    def image_exists(self, tag: str) -> bool:
+        proc = pipeline.run_command(["docker", "image", "inspect", tag], capture_output=True)
+        return proc.returncode == 0
+
+    def image_id(self, tag: str) -> str:
+        proc = pipeline.run_command(
+            ["docker", "image", "inspect", "--format", "{{.Id}}", tag],
+            check=True,
+            capture_output=True,
+        )
+        return proc.stdout.decode("utf-8").strip()
+
+    def build(
+        self,
+        context_dir: str,
+        tag: str,
+        build_args: typing.Dict[str, str],
+        dockerfile: typing.Optional[str] = None,
+        include: typing.Optional[typing.Sequence[str]] = None,
+        log_path: typing.Optional[str] = None,
+    ) -> int:
+        """
+        Builds context_dir (minus its .dockerignore) as tag. include is only
+        honoured by the API backend; the CLI always sends the whole directory.
+        """
+        command = ["docker", "build", context_dir, "--platform", PLATFORM]
+        if dockerfile:
+            command += ["-f", dockerfile]
+        command += ["-t", tag]
+        for key, value in build_args.items():
+            command += ["--build-arg", f"{key}={value}"]
+        return stream_process(command, cwd=context_dir, log_path=log_path)
+
+    def run(self, args: typing.Sequence[str], log_path: typing.Optional[str] = None) -> int:
+        """
+        Runs a container from `docker run` arguments and returns its exit code.
+        """
+        return stream_process(["docker", "run", *args], log_path=log_path)
+
+    def copy_from(self, container: str, path: str, dest: str) -> bool:
+        proc = pipeline.run_command(
+            ["docker", "cp", f"{container}:{path}", dest], capture_output=True
+        )
+        return proc.returncode == 0
+
+    def remove(self, container: str):
+        subprocess.run(["docker", "rm", "-f", container], capture_output=True)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: typing.Optional[float] = 60):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class EngineError(RuntimeError):
+    pass
+
+
+class _Container:
+    """
+    Stands in for a process in the pipeline's cancel scope, so cancelling a
+    stage kills its container instead of a CLI process.
+    """
+
+    def __init__(self, engine: "ApiEngine", container_id: str):
+        self.engine = engine
+        self.container_id = container_id
+
+    def terminate(self):
+        try:
+            self.engine.request("POST", f"/containers/{self.container_id}/kill")
+        except (EngineError, OSError):
+            pass
+
+    kill = terminate
+
+    def wait(self, timeout: typing.Optional[float] = None):
+        pass
+
+
+class _Build:
+    """
+    Stands in for a process in the cancel scope: dropping the connection
+    aborts the build on the engine's side.
+    """
+
+    def __init__(self, connection: http.client.HTTPConnection):
+        self.connection = connection
+
+    def terminate(self):
+        if self.connection.sock:
+            try:
+                self.connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    kill = terminate
+
+    def wait(self, timeout: typing.Optional[float] = None):
+        pass
+
+
+def parse_memory(flag: str, value: str) -> int:
+    """
+    Parses a docker run memory value such as 4294967296, 512m, 1.5g or 4GiB
+    into bytes, the way docker does; -1 (unlimited) is passed through.
+    """
+    if value.strip() == "-1":
+        return -1
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?) ?([kmgtp]?)i?b?\s*", value, re.I)
+    if not match:
+        raise ValueError(f"invalid {flag} value {value!r}, expected bytes or e.g. 512m or 4g")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()])
+
+
+def parse_run_args(args: typing.Sequence[str]) -> typing.Dict[str, typing.Any]:
+    """
+    Turns the `docker run` arguments this CLI builds into a container create
+    request: {name, remove, platform, body}. Flags outside RUN_FLAGS raise
+    ValueError rather than being silently dropped.
+    """
+    spec: typing.Dict[str, typing.Any] = {"name": None, "remove": False, "platform": None}
+    env: typing.List[str] = []
+    binds: typing.List[str] = []
+    host: typing.Dict[str, typing.Any] = {}
+    body: typing.Dict[str, typing.Any] = {}
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        flag = args[i]
+        if flag not in RUN_FLAGS:
+            raise ValueError(f"docker run flag {flag} is not supported by the API backend")
+        value = args[i + 1] if RUN_FLAGS[flag] else None
+        i += 2 if RUN_FLAGS[flag] else 1
+        if flag == "--rm":
+            spec["remove"] = True
+        elif flag == "--name":
+            spec["name"] = value
+        elif flag == "--platform":
+            spec["platform"] = value
+        elif flag == "-e":
+            env.append(value)
+        elif flag == "-v":
+            binds.append(value)
+        elif flag == "-w":
+            body["WorkingDir"] = value
+        elif flag == "--user":
+            body["User"] = value
+        elif flag == "--cpus":
+            host["NanoCpus"] = int(float(value) * 1e9)
+        elif flag == "--memory":
+            host["Memory"] = parse_memory(flag, value)
+        elif flag == "--memory-swap":
+            host["MemorySwap"] = parse_memory(flag, value)
+    if i >= len(args):
+        raise ValueError("docker run arguments name no image")
+    body.update(
+        Image=args[i],
+        Cmd=list(args[i + 1 :]) or None,
+        Env=env,
+        HostConfig=dict(host, Binds=binds),
+    )
+    spec["body"] = body
+    return spec
+
+
+class ApiEngine:
+    """
+    Drives containers through the Engine API on docker_host: builds get a
+    generated context tarball and report structured events, and files are
+    copied out of containers as archives of just the requested path.
+    """
+
+    def __init__(self, docker_host: str):
+        self.docker_host = docker_host
+        url = urllib.parse.urlsplit(docker_host)
+        if url.scheme == "unix":
+            self._path = url.path
+            self._netloc = None
+        elif url.scheme in ("tcp", "http"):
+            self._path = None
+            self._netloc = url.netloc
+        else:
+            raise ValueError(f"unsupported docker_host {docker_host}")
+
+    def connection(self, timeout: typing.Optional[float] = 60) -> http.client.HTTPConnection:
+        if self._path:
+            return UnixHTTPConnection(self._path, timeout=timeout)
+        return http.client.HTTPConnection(self._netloc, timeout=timeout)
+
+    def _url(self, path: str, query: typing.Optional[typing.Dict[str, typing.Any]] = None) -> str:
+        url = f"/{API_VERSION}{path}"
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        return url
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        query: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        body: typing.Optional[typing.Any] = None,
+    ) -> typing.Tuple[int, bytes]:
+        """
+        Sends a request and returns the status and body of a successful
+        response; error responses raise EngineError.
+        """
+        connection = self.connection()
+        try:
+            payload = None if body is None else json.dumps(body).encode("utf-8")
+            headers = {"Content-Type": "application/json"} if payload is not None else {}
+            connection.request(method, self._url(path, query), payload, headers)
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise EngineError(self._error_message(response.status, data))
+        return response.status, data
+
+    @staticmethod
+    def _error_message(status: int, data: bytes) -> str:
+        try:
+            return json.loads(data)["message"]
+        except (ValueError, KeyError, TypeError):
+            return f"engine returned {status}: {data.decode('utf-8', errors='replace')}"
+
+    def _inspect_image(self, tag: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        try:
+            _, data = self.request("GET", f"/images/{urllib.parse.quote(tag, safe='')}/json")
+        except EngineError:
+            return None
+        return json.loads(data)
+
+    def image_exists(self, tag: str) -> bool:
+        return self._inspect_image(tag) is not None
+
+    def image_id(self, tag: str) -> str:
+        image = self._inspect_image(tag)
+        if image is None:
+            raise RuntimeError(f"no such image: {tag}")
+        return image["Id"]
+
+    def _context_chunks(
+        self,
+        context_dir: str,
+        dockerfile: typing.Optional[str],
+        include: typing.Optional[typing.Sequence[str]],
+    ) -> typing.Iterator[bytes]:
+        """
+        Generates the build context as an uncompressed tar stream while it's
+        being sent: the included files of context_dir minus its
+        .dockerignore, plus a Dockerfile kept outside the context.
+        """
+        read_fd, write_fd = os.pipe()
+        errors: typing.List[BaseException] = []
+
+        def write():
+            try:
+                with os.fdopen(write_fd, "wb") as sink, tarfile.open(
+                    fileobj=sink, mode="w|", format=tarfile.PAX_FORMAT
+                ) as archive:
+                    if dockerfile:
+                        archive.add(dockerfile, "Dockerfile")
+                    for path in context_files(
+                        context_dir, include, read_dockerignore(context_dir)
+                    ):
+                        if dockerfile and path == "Dockerfile":
+                            continue
+                        archive.add(os.path.join(context_dir, path), path, recursive=False)
+            except BrokenPipeError:
+                pass
+            except BaseException as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        with os.fdopen(read_fd, "rb") as source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        writer.join()
+        if errors:
+            raise errors[0]
+
+    def _pump(self, events: typing.Iterator[bytes], log_path: typing.Optional[str]):
+        """
+        Hands text from events to the run log on this thread, as output
+        of the current stage.
+        """
+        read_fd, write_fd = os.pipe()
+
+        def write():
+            with os.fdopen(write_fd, "wb") as sink:
+                try:
+                    for data in events:
+                        sink.write(data)
+                        sink.flush()
+                except (OSError, http.client.HTTPException):
+                    pass
+
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        with os.fdopen(read_fd, "rb") as source:
+            logs.capture(source, log_path)
+        writer.join()
+
+    def build(
+        self,
+        context_dir: str,
+        tag: str,
+        build_args: typing.Dict[str, str],
+        dockerfile: typing.Optional[str] = None,
+        include: typing.Optional[typing.Sequence[str]] = None,
+        log_path: typing.Optional[str] = None,
+    ) -> int:
+        """
+        Streams a generated context to POST /build and logs its events.
+        Returns 0 once the engine reports the image id, 1 on an error event.
+        """
+        pipeline.check_cancelled()
+        connection = self.connection(timeout=None)
+        handle = _Build(connection)
+        pipeline.track(handle)
+        outcome = {"error": None, "id": None}
+        try:
+            connection.request(
+                "POST",
+                self._url(
+                    "/build",
+                    {
+                        "t": tag,
+                        "platform": PLATFORM,
+                        "buildargs": json.dumps(build_args),
+                        "rm": 1,
+                        "forcerm": 1,
+                    },
+                ),
+                self._context_chunks(context_dir, dockerfile, include),
+                {"Content-Type": "application/x-tar"},
+                encode_chunked=True,
+            )
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise EngineError(self._error_message(response.status, response.read()))
+
+            def events() -> typing.Iterator[bytes]:
+                for line in response:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    if event.get("error"):
+                        outcome["error"] = event["error"]
+                        yield f"ERROR: {event['error']}\n".encode("utf-8")
+                    elif event.get("stream"):
+                        yield event["stream"].encode("utf-8")
+                    elif event.get("status"):
+                        progress = f" {event['progress']}" if event.get("progress") else ""
+                        yield f"{event['status']}{progress}\n".encode("utf-8")
+                    elif isinstance(event.get("aux"), dict) and event["aux"].get("ID"):
+                        outcome["id"] = event["aux"]["ID"]
+
+            self._pump(events(), log_path)
+        except (OSError, http.client.HTTPException) as e:
+            pipeline.check_cancelled()
+            raise EngineError(f"build of {tag} failed: {e}") from e
+        finally:
+            pipeline.untrack(handle)
+            connection.close()
+        pipeline.check_cancelled()
+        return 0 if outcome["id"] and not outcome["error"] else 1
+
+    def _logs(self, container_id: str) -> typing.Iterator[bytes]:
+        """
+        Follows a container's output, undoing the stdout/stderr multiplexing
+        of containers without a TTY.
+        """
+        connection = self.connection(timeout=None)
+        try:
+            connection.request(
+                "GET",
+                self._url(
+                    f"/containers/{container_id}/logs",
+                    {"follow": 1, "stdout": 1, "stderr": 1},
+                ),
+            )
+            response = connection.getresponse()
+            if response.status >= 400:
+                return
+            while True:
+                header = response.read(8)
+                if len(header) < 8:
+                    return
+                size = int.from_bytes(header[4:8], "big")
+                while size:
+                    data = response.read(min(size, CHUNK_SIZE))
+                    if not data:
+                        return
+                    size -= len(data)
+                    yield data
+        finally:
+            connection.close()
+
+    def run(self, args: typing.Sequence[str], log_path: typing.Optional[str] = None) -> int:
+        """
+        Runs a container from `docker run` arguments (see parse_run_args)
+        and returns its exit code.
+        """
+        pipeline.check_cancelled()
+        spec = parse_run_args(args)
+        query = {k: spec[k] for k in ("name", "platform") if spec[k]}
+        _, data = self.request("POST", "/containers/create", query, spec["body"])
+        container_id = json.loads(data)["Id"]
+        handle = _Container(self, container_id)
+        pipeline.track(handle)
+        try:
+            self.request("POST", f"/containers/{container_id}/start")
+            self._pump(self._logs(container_id), log_path)
+            _, data = self.request("POST", f"/containers/{container_id}/wait")
+            rc = json.loads(data)["StatusCode"]
+        finally:
+            pipeline.untrack(handle)
+            if spec["remove"]:
+                self.remove(container_id)
+        pipeline.check_cancelled()
+        return rc
+
+    def copy_from(self, container: str, path: str, dest: str) -> bool:
+        """
+        Copies the file at path out of container to dest through an archive
+        of just that path.
+        """
+        try:
+            _, data = self.request("GET", f"/containers/{container}/archive", {"path": path})
+        except EngineError:
+            return False
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r") as archive:
+            member = next((m for m in archive.getmembers() if m.isfile()), None)
+            if member is None:
+                return False
+            source = archive.extractfile(member)
+            with open(dest, "wb") as f:
+                f.write(source.read())
+        return True
+
+    def remove(self, container: str):
+        try:
+            self.request("DELETE", f"/containers/{container}", {"force": 1})
+        except (EngineError, OSError):
+            pass
+
+
+Engine = typing.Union[CliEngine, ApiEngine]
+
+_engine: Engine = CliEngine()
+
+
+def _docker_host(conf: config_module.BackporterConfig) -> str:
+    return conf.docker_host or os.environ.get("DOCKER_HOST") or DEFAULT_DOCKER_HOST
+
+
+def from_config(conf: config_module.BackporterConfig) -> Engine:
+    if conf.container_backend == "cli":
+        return CliEngine()
+    if conf.container_backend == "api":
+        return ApiEngine(_docker_host(conf))
+    raise ValueError(
+        f"unknown container_backend '{conf.container_backend}', expected one of {config_module.CONTAINER_BACKENDS}"
+    )
+
+
+def use(conf: config_module.BackporterConfig):
+    """
+    Makes conf's container backend the one every container operation of
+    this process goes through.
+    """
+    global _engine
+    _engine = from_config(conf)
+
+
+def engine() -> Engine:
+    return _engine
+
+
+def describe(conf: config_module.BackporterConfig) -> str:
+    """
+    Names the container backend conf selects, e.g. "cli" or
+    "api at unix:///var/run/docker.sock".
+    """
+    if conf.container_backend == "api":
+        return f"api at {_docker_host(conf)}"
+    return conf.container_backend
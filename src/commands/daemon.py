@@ -0,0 +1,594 @@
+import dataclasses
+import hmac
+import http.client
+import http.server
+import ipaddress
+import itertools
+import json
+import os
+import queue
+import secrets
+import socketserver
+import threading
+import time
+import typing
+import urllib.parse
+from dataclasses import dataclass, field
+import click
+from . import config as config_module
+from . import containers
+from . import fixmorph as fixmorph_module
+from . import history as history_module
+from . import runs as runs_module
+from . import scheduler as scheduler_module
+from . import series as series_module
+
+
+# default socket, in the cache dir
+DAEMON_SOCKET = "daemon.sock"
+
+# a TCP daemon's token, in the cache dir; a socket's sits next to it
+DAEMON_TOKEN = "daemon-{port}.token"
+TOKEN_SUFFIX = ".token"
+
+# the settings a job may choose for itself; images, paths, URLs and the
+# container backend are the daemon's
+JOB_SETTINGS = ("run_mode", "upstream_fetch", "build_jobs", "job_memory")
+
+# job statuses; a finished job's log doesn't grow any more
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+FINISHED = (DONE, FAILED)
+
+# how often a client following a job asks for more of its log
+FOLLOW_INTERVAL = 0.5
+
+# most bytes of a run log sent per request
+LOG_CHUNK_SIZE = 1024 * 1024
+
+
+def address(conf: config_module.BackporterConfig) -> str:
+    return conf.daemon_address or conf.cache_path(DAEMON_SOCKET)
+
+
+def token_path(addr: str, cache_dir: str) -> str:
+    """
+    Returns the file holding the token of the daemon at addr.
+    """
+    tcp = _tcp_address(addr)
+    if tcp:
+        return os.path.join(os.path.expanduser(cache_dir), DAEMON_TOKEN.format(port=tcp[1]))
+    return addr + TOKEN_SUFFIX
+
+
+def write_token(path: str) -> str:
+    """
+    Writes a new random token to path, readable only by the daemon's user,
+    and returns it.
+    """
+    token = secrets.token_hex(32)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+    return token
+
+
+def _loopback(host: str) -> bool:
+    try:
+        return host == "localhost" or ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _tcp_address(addr: str) -> typing.Optional[typing.Tuple[str, int]]:
+    """
+    Returns (host, port) for an http:// address, or None for a socket path.
+    Only loopback hosts are accepted: jobs run docker as the daemon's user.
+    """
+    if not addr.startswith("http://"):
+        return None
+    url = urllib.parse.urlsplit(addr)
+    host = url.hostname or "127.0.0.1"
+    if not _loopback(host) or not url.port:
+        raise ValueError(f"daemon address {addr} must be http://<loopback host>:<port>")
+    return host, url.port
+
+
+def job_config(
+    conf: config_module.BackporterConfig, settings: typing.Dict[str, typing.Any]
+) -> config_module.BackporterConfig:
+    """
+    Returns conf with a job's own settings applied; only JOB_SETTINGS may be
+    among them.
+    """
+    refused = sorted(set(settings) - set(JOB_SETTINGS))
+    if refused:
+        raise ValueError(
+            f"{', '.join(refused)} can't be set per job, the daemon's config decides;"
+            f" a job may only set {', '.join(JOB_SETTINGS)}"
+        )
+    settings = dict(settings)
+    for name, values in (
+        ("run_mode", config_module.RUN_MODES),
+        ("upstream_fetch", config_module.UPSTREAM_FETCH_MODES),
+    ):
+        if name in settings and settings[name] not in values:
+            raise ValueError(f"unknown {name} '{settings[name]}', expected one of {values}")
+    if "build_jobs" in settings:
+        settings["build_jobs"] = int(settings["build_jobs"])
+    if settings.get("job_memory"):
+        scheduler_module.parse_size(settings["job_memory"])
+        settings["job_memory"] = str(settings["job_memory"])
+    return dataclasses.replace(conf, **settings)
+
+
+def estimate(
+    conf: config_module.BackporterConfig, commit_spec: str, branches: typing.Sequence[str]
+) -> float:
+    """
+    Returns the expected wall time of a job from the run history, or 0 when
+    there's none. Branches run in parallel, so the slowest one counts; a
+    series counts its tip once per listed commit.
+    """
+    commit = series_module.tip(commit_spec) if series_module.is_series(commit_spec) else commit_spec
+    commits = len(commit_spec.split(series_module.LIST_SEPARATOR))
+    return commits * max(
+        (history_module.expected_seconds(conf, branch, commit) or 0.0 for branch in branches),
+        default=0.0,
+    )
+
+
+@dataclass
+class Job:
+    """
+    A backport submitted to the daemon: one run directory, executed by a
+    worker once it reaches the front of the queue.
+    """
+
+    run: runs_module.RunDir
+    conf: config_module.BackporterConfig
+    options: typing.Dict[str, typing.Any] = field(default_factory=dict)
+    priority: int = 0
+    # expected wall time from the run history, 0 without any
+    estimate: float = 0.0
+    status: str = QUEUED
+    error: typing.Optional[str] = None
+    submitted: float = field(default_factory=time.time)
+    started: typing.Optional[float] = None
+    finished: typing.Optional[float] = None
+
+    @property
+    def id(self) -> str:
+        return self.run.id
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self.run.log_dir, "run.log")
+
+    def patches(self) -> typing.Dict[str, str]:
+        """
+        Returns the patch path of every branch that got one.
+        """
+        manifest = self.run.read_manifest()
+        if "results" in manifest:
+            return {
+                branch: result["patch"]
+                for branch, result in manifest["results"].items()
+                if result.get("patch")
+            }
+        return {manifest["branch"]: manifest["patch"]} if manifest.get("patch") else {}
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        manifest = self.run.read_manifest()
+        return {
+            "id": self.id,
+            "status": self.status,
+            "commit": manifest["commit"],
+            "branches": manifest.get("branches", [manifest["branch"]]),
+            "run": self.run.path,
+            "priority": self.priority,
+            "estimate": self.estimate,
+            "error": self.error,
+            "failed_stage": manifest.get("failed_stage"),
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "patches": self.patches() if self.status == DONE else {},
+        }
+
+
+class Daemon:
+    """
+    Runs submitted backports on a pool of worker threads, lowest priority
+    value first, then shortest expected first by the run history, then in
+    submission order. Jobs share the process: its
+    scheduler budget, its container backend, the toolchain image it keeps
+    built, and the caches and mirrors of its config. A job only chooses
+    JOB_SETTINGS.
+    """
+
+    def __init__(
+        self,
+        conf: config_module.BackporterConfig,
+        execute: typing.Callable[..., None],
+        workers: int,
+    ):
+        self.conf = conf
+        self.execute = execute
+        self.workers = workers
+        self.jobs: typing.Dict[str, Job] = {}
+        self._queue: "queue.PriorityQueue[typing.Tuple[float, float, int, typing.Optional[str]]]" = (
+            queue.PriorityQueue()
+        )
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+        self._threads: typing.List[threading.Thread] = []
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        # have the toolchain image ready before the first job asks for it
+        threading.Thread(target=self._warm, daemon=True).start()
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put((float("inf"), 0.0, next(self._tickets), None))
+        for thread in self._threads:
+            thread.join()
+
+    def _warm(self):
+        try:
+            fixmorph_module.ensure_toolchain(self.conf)
+        except Exception as e:
+            click.secho(f"Could not prepare the toolchain image: {e}", fg="yellow")
+
+    def submit(
+        self,
+        commit_id: str,
+        branches: typing.Sequence[str],
+        settings: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        options: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        priority: int = 0,
+    ) -> Job:
+        """
+        Creates the job's run directory and queues it. settings override the
+        daemon's config for this job, see job_config.
+        """
+        if not branches:
+            raise ValueError("a job needs at least one branch")
+        if len(branches) > 1 and series_module.is_series(commit_id):
+            raise ValueError("a commit series can only be backported to one branch at a time")
+        conf = job_config(self.conf, settings or {})
+        run = runs_module.start_run(conf, commit_id, branches, runs_module.QUEUED)
+        job = Job(run, conf, dict(options or {}), priority, estimate(conf, commit_id, branches))
+        with self._lock:
+            self.jobs[job.id] = job
+        click.secho(f"Queued job {job.id}")
+        self._queue.put((priority, job.estimate, next(self._tickets), job.id))
+        return job
+
+    def list_jobs(self) -> typing.List[Job]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def job(self, job_id: str) -> Job:
+        with self._lock:
+            if job_id not in self.jobs:
+                raise KeyError(job_id)
+            return self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            _, _, _, job_id = self._queue.get()
+            if job_id is None:
+                return
+            job = self.job(job_id)
+            job.status = RUNNING
+            job.started = time.time()
+            click.secho(f"Running job {job.id}")
+            try:
+                self.execute(
+                    job.conf,
+                    job.run,
+                    profile=False,
+                    report=os.path.join(job.run.path, "report.jsonl"),
+                    trace=None,
+                    quiet=True,
+                    tail=0,
+                    log_dir=None,
+                    **job.options,
+                )
+                job.status = DONE
+            except (Exception, SystemExit) as e:
+                job.status = FAILED
+                job.error = str(e) or type(e).__name__
+                # a job that failed before its run recorded an outcome
+                if job.run.read_manifest().get("status") not in runs_module.FINISHED:
+                    job.run.update_manifest(status="failed")
+            job.finished = time.time()
+            click.secho(
+                f"Job {job.id} {job.status}", fg="green" if job.status == DONE else "red"
+            )
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    The daemon's HTTP API:
+
+    Every request needs the daemon's token as `Authorization: Bearer <token>`
+    and a loopback Host, so other users and web pages can't reach it.
+
+    - POST /jobs: submit a JSON {commit, branches, settings?, no_cache?,
+      refresh?, priority?}, settings being JOB_SETTINGS
+    - GET /jobs: every job of this daemon
+    - GET /jobs/<id>: one job
+    - GET /jobs/<id>/log?offset=N: run.log from byte N; the X-Log-Offset
+      header is where to continue, X-Job-Status the job's status
+    - GET /jobs/<id>/patch?branch=B: the generated patch
+    """
+
+    server: "typing.Any"
+
+    def address_string(self) -> str:
+        # Unix socket peers have no address
+        return str(self.client_address[0]) if self.client_address else "local"
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def _send(
+        self,
+        status: int,
+        body: bytes,
+        content_type: str = "application/json",
+        headers: typing.Optional[typing.Dict[str, str]] = None,
+    ):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        # the client may already be gone after an empty response
+        if body:
+            self.wfile.write(body)
+
+    def _send_json(self, status: int, value: typing.Any):
+        self._send(status, json.dumps(value).encode("utf-8"))
+
+    def _error(self, status: int, message: str):
+        self._send_json(status, {"error": message})
+
+    def _route(self) -> typing.Tuple[typing.List[str], typing.Dict[str, str]]:
+        url = urllib.parse.urlsplit(self.path)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        return [p for p in url.path.split("/") if p], query
+
+    def _authorized(self) -> bool:
+        """
+        Checks the request's Host and token, answering with an error when either
+        is wrong.
+        """
+        host = urllib.parse.urlsplit("//" + self.headers.get("Host", "")).hostname
+        if not host or not _loopback(host):
+            self._error(403, f"requests must be for a loopback host, not {host}")
+            return False
+        scheme, _, token = self.headers.get("Authorization", "").partition(" ")
+        if scheme != "Bearer" or not hmac.compare_digest(token.encode(), self.server.token.encode()):
+            self._error(401, "missing or wrong daemon token")
+            return False
+        return True
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        parts, _ = self._route()
+        if parts != ["jobs"]:
+            return self._error(404, f"no such endpoint {self.path}")
+        if self.headers.get_content_type() != "application/json":
+            return self._error(415, "jobs must be submitted as application/json")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            job = self.server.daemon.submit(
+                str(request["commit"]),
+                [str(b) for b in request.get("branches", [])],
+                dict(request.get("settings") or {}),
+                {
+                    "no_cache": bool(request.get("no_cache", False)),
+                    "refresh": bool(request.get("refresh", False)),
+                },
+                int(request.get("priority", 0)),
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            return self._error(400, f"invalid job: {e}")
+        self._send_json(201, job.to_dict())
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        parts, query = self._route()
+        daemon = self.server.daemon
+        if parts == ["jobs"]:
+            return self._send_json(200, [job.to_dict() for job in daemon.list_jobs()])
+        if len(parts) < 2 or parts[0] != "jobs":
+            return self._error(404, f"no such endpoint {self.path}")
+        try:
+            job = daemon.job(parts[1])
+        except KeyError:
+            return self._error(404, f"no job {parts[1]}")
+        if len(parts) == 2:
+            return self._send_json(200, job.to_dict())
+        if parts[2:] == ["log"]:
+            return self._send_log(job, int(query.get("offset", 0)))
+        if parts[2:] == ["patch"]:
+            patches = job.patches()
+            branch = query.get("branch") or (next(iter(patches)) if len(patches) == 1 else None)
+            if branch not in patches:
+                return self._error(404, f"job {job.id} has no patch for branch {branch}")
+            with open(patches[branch], "rb") as f:
+                return self._send(200, f.read(), "text/x-diff")
+        self._error(404, f"no such endpoint {self.path}")
+
+    def _send_log(self, job: Job, offset: int):
+        # read the status first, so a finished job's log is complete
+        status = job.status
+        chunk = b""
+        try:
+            with open(job.log_path, "rb") as f:
+                f.seek(offset)
+                chunk = f.read(LOG_CHUNK_SIZE)
+        except FileNotFoundError:
+            pass
+        self._send(
+            200,
+            chunk,
+            "application/octet-stream",
+            {"X-Log-Offset": str(offset + len(chunk)), "X-Job-Status": status},
+        )
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # a socket left behind by a daemon that didn't shut down cleanly
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        os.makedirs(os.path.dirname(self.server_address) or ".", exist_ok=True)
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(addr: str, daemon: Daemon, token: str) -> socketserver.BaseServer:
+    """
+    Returns a server for daemon at addr, answering requests with token.
+    """
+    tcp = _tcp_address(addr)
+    if tcp:
+        server = http.server.ThreadingHTTPServer(tcp, Handler)
+    else:
+        server = UnixHTTPServer(addr, Handler)
+    server.daemon = daemon
+    server.token = token
+    return server
+
+
+class Client:
+    """
+    Talks to a running `backporter serve` at addr, with the token it wrote
+    to token_file.
+    """
+
+    def __init__(self, addr: str, token_file: str):
+        self.address = addr
+        self.token_file = token_file
+
+    def _token(self) -> str:
+        try:
+            with open(self.token_file, encoding="utf-8") as f:
+                return f.read().strip()
+        except FileNotFoundError as e:
+            raise RuntimeError(
+                f"no backporter daemon token at {self.token_file}; start a daemon with"
+                " `backporter serve`"
+            ) from e
+
+    def _request(
+        self, method: str, path: str, body: typing.Optional[typing.Any] = None
+    ) -> typing.Tuple[http.client.HTTPResponse, bytes]:
+        tcp = _tcp_address(self.address)
+        if tcp:
+            connection = http.client.HTTPConnection(*tcp, timeout=60)
+        else:
+            connection = containers.UnixHTTPConnection(self.address)
+        try:
+            payload = None if body is None else json.dumps(body).encode("utf-8")
+            headers = {"Authorization": f"Bearer {self._token()}"}
+            if payload:
+                headers["Content-Type"] = "application/json"
+            connection.request(method, path, payload, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (ConnectionRefusedError, FileNotFoundError) as e:
+            raise RuntimeError(
+                f"no backporter daemon at {self.address} ({e}); start one with `backporter serve`"
+            ) from e
+        finally:
+            connection.close()
+        if response.status >= 400:
+            try:
+                message = json.loads(data)["error"]
+            except (ValueError, KeyError, TypeError):
+                message = data.decode("utf-8", errors="replace")
+            raise RuntimeError(message)
+        return response, data
+
+    def submit(
+        self,
+        conf: config_module.BackporterConfig,
+        commit_id: str,
+        branches: typing.Sequence[str],
+        no_cache: bool = False,
+        refresh: bool = False,
+        priority: int = 0,
+    ) -> typing.Dict[str, typing.Any]:
+        _, data = self._request(
+            "POST",
+            "/jobs",
+            {
+                "commit": commit_id,
+                "branches": list(branches),
+                "settings": {name: getattr(conf, name) for name in JOB_SETTINGS},
+                "no_cache": no_cache,
+                "refresh": refresh,
+                "priority": priority,
+            },
+        )
+        return json.loads(data)
+
+    def jobs(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        return json.loads(self._request("GET", "/jobs")[1])
+
+    def job(self, job_id: str) -> typing.Dict[str, typing.Any]:
+        return json.loads(self._request("GET", f"/jobs/{job_id}")[1])
+
+    def log(self, job_id: str, offset: int = 0) -> typing.Tuple[bytes, int, str]:
+        """
+        Returns the job's log from offset, where to continue, and its status.
+        """
+        response, data = self._request("GET", f"/jobs/{job_id}/log?offset={offset}")
+        return data, int(response.getheader("X-Log-Offset")), response.getheader("X-Job-Status")
+
+    def patch(self, job_id: str, branch: typing.Optional[str] = None) -> str:
+        query = f"?branch={urllib.parse.quote(branch)}" if branch else ""
+        return self._request("GET", f"/jobs/{job_id}/patch{query}")[1].decode("utf-8")
+
+    def follow(
+        self, job_id: str, sink: typing.Optional[typing.Callable[[bytes], None]] = None
+    ) -> typing.Dict[str, typing.Any]:
+        """
+        Hands the job's log to sink as it grows until the job finishes, and
+        returns the finished job.
+        """
+        offset = 0
+        while True:
+            data, offset, status = self.log(job_id, offset)
+            if data and sink:
+                sink(data)
+            if status in FINISHED and len(data) < LOG_CHUNK_SIZE:
+                return self.job(job_id)
+            if not data:
+                time.sleep(FOLLOW_INTERVAL)
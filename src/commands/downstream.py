@@ -0,0 +1,270 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import typing
+import click
+import yaml
+from . import archives as archives_module
+from . import cache
+from . import config as config_module
+from . import pipeline
+
+
+class DistGitCache:
+    """
+    Prepped downstream source trees keyed by (dist-git repo, branch commit,
+    sources checksums). The branch commit pins the spec and patch set, and the
+    sources file pins the tarballs, so together they determine the output of
+    `rhpkg sources` + `rhpkg prep`.
+    """
+
+    def __init__(self, root: str, max_size: int):
+        self.root = root
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, conf: config_module.BackporterConfig) -> "DistGitCache":
+        return cls(conf.cache_path("distgit"), conf.distgit_cache_max_size)
+
+    @staticmethod
+    def key(distgit_repo: str, distgit_path: str) -> str:
+        head_proc = pipeline.run_command(
+            ["git", "-C", distgit_path, "rev-parse", "HEAD"],
+            check=True,
+            capture_output=True,
+        )
+        sources_path = os.path.join(distgit_path, "sources")
+        sources = b""
+        if os.path.isfile(sources_path):
+            with open(sources_path, "rb") as f:
+                sources = f.read()
+        digest = hashlib.sha256()
+        for part in (distgit_repo.encode("utf-8"), head_proc.stdout.strip(), sources):
+            digest.update(part)
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def lock(self, key: str) -> cache.FileLock:
+        return cache.FileLock(self.entry_path(key) + ".lock")
+
+    def get(self, key: str, dest: str, writable: bool = False) -> bool:
+        """
+        Materialises the cached tree for key at dest. Returns False on a miss.
+        Pass writable=True when dest will be modified in place.
+        """
+        # a concurrent put replaces the entry under the exclusive lock
+        with cache.FileLock(self.entry_path(key) + ".lock", shared=True):
+            return self.get_locked(key, dest, writable)
+
+    def get_locked(self, key: str, dest: str, writable: bool = False) -> bool:
+        """
+        Same as get, for callers that already hold self.lock(key).
+        """
+        tree = os.path.join(self.entry_path(key), "tree")
+        if not os.path.isdir(tree):
+            return False
+        if writable:
+            cache.copy_tree(tree, dest)
+        else:
+            cache.link_tree(tree, dest)
+        cache.touch(self.entry_path(key))
+        return True
+
+    def put(self, key: str, src_dir: str, meta: typing.Dict[str, str]):
+        """
+        Moves a freshly prepped tree into the cache. Callers hold self.lock(key).
+        """
+        entry = self.entry_path(key)
+        staging = entry + ".tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        shutil.move(src_dir, os.path.join(staging, "tree"))
+        with open(os.path.join(staging, "meta.yaml"), "w", encoding="utf-8") as f:
+            yaml.dump(meta, f)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(staging, entry)
+        cache.touch(entry)
+
+    def entries(self) -> typing.List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            os.path.join(self.root, name)
+            for name in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, name)) and not name.endswith(".tmp")
+        ]
+
+    def gc(self) -> typing.List[str]:
+        """
+        Evicts least recently used trees until the cache fits in max_size.
+        """
+        return cache.evict(
+            self.entries(), self.max_size, lock_for=lambda e: e + ".lock"
+        )
+
+
+def clone_distgit(
+    conf: config_module.BackporterConfig, branch_name: str, downstream_path: str
+):
+    """
+    Clones the dist-git repo into downstream_path and switches to branch_name.
+    """
+    click.secho(f"Cloning dist-git repo '{conf.distgit_repo}'")
+    downstream_clone_proc = pipeline.run_command(
+        [
+            "rhpkg",
+            "clone",
+            "--anonymous",
+            conf.distgit_repo,
+            downstream_path,
+        ],
+        capture_output=True,
+    )
+    # ensure the clone was successful
+    if downstream_clone_proc.returncode != 0:
+        click.secho(
+            f"Error cloning dist-git repo '{conf.distgit_repo}': {downstream_clone_proc.stderr}",
+            fg="red",
+        )
+        raise RuntimeError(
+            f"Error cloning dist-git repo '{conf.distgit_repo}': {downstream_clone_proc.stderr}"
+        )
+
+    # switch to desired branch-name
+    switch_proc = pipeline.run_command(
+        ["git", "-C", downstream_path, "switch", branch_name],
+        capture_output=True,
+    )
+    if switch_proc.returncode != 0:
+        click.secho(
+            f"failed to switch to branch '{branch_name}': {switch_proc.stderr}",
+            fg="red",
+        )
+        raise ValueError(f"could not switch to branch {branch_name}")
+
+
+def fetch_and_prep(
+    conf: config_module.BackporterConfig, downstream_path: str
+) -> typing.Tuple[str, bool]:
+    """
+    Downloads and extracts the sources of a dist-git checkout and runs
+    `rhpkg prep` over them. Returns the source directory and whether prep
+    succeeded.
+    """
+    # start extracting the first listed archive as soon as its download
+    # appears, instead of after `rhpkg sources` finished every file
+    archives = archives_module.sources_archives(downstream_path)
+    source_dir = None
+    with tempfile.TemporaryFile() as sources_output:
+        pipeline.check_cancelled()
+        sources_proc = subprocess.Popen(
+            ["rhpkg", "sources"],
+            cwd=downstream_path,
+            stdout=sources_output,
+            stderr=subprocess.STDOUT,
+        )
+        pipeline.track(sources_proc)
+
+        def downloaded() -> bool:
+            return sources_proc.poll() is not None
+
+        try:
+            if archives:
+                archive_path = os.path.join(downstream_path, archives[0])
+                if archives_module.wait_for(archive_path, downloaded):
+                    try:
+                        source_dir = archives_module.extract(
+                            archive_path, downstream_path, done=downloaded
+                        )
+                    except RuntimeError as e:
+                        # e.g. the download restarted; extract the final file below
+                        click.secho(f"streamed extraction failed, retrying: {e}", fg="yellow")
+            rc = pipeline.reap(sources_proc)
+        finally:
+            pipeline.untrack(sources_proc)
+        pipeline.check_cancelled()
+        if rc != 0:
+            sources_output.seek(0)
+            click.secho(
+                f"failed extracting sources from '{downstream_path}': {sources_output.read()}",
+                fg="red",
+            )
+            raise RuntimeError(f"could not extract sources from {conf.distgit_repo}")
+
+    if source_dir is None:
+        archive_path = (
+            os.path.join(downstream_path, archives[0])
+            if archives
+            else archives_module.find_archive(downstream_path)
+        )
+        if not archive_path or not os.path.isfile(archive_path):
+            click.secho(f"could not find source archive in '{downstream_path}'", fg="red")
+            raise RuntimeError(f"failed to locate source archive in '{downstream_path}'")
+        source_dir = archives_module.extract(archive_path, downstream_path)
+
+    # prepare the downstream source
+    click.secho("prepping the downstream source", fg="green")
+    prep_proc = pipeline.run_command(
+        ["rhpkg", "prep"], cwd=downstream_path, capture_output=True
+    )
+    if prep_proc.returncode != 0:
+        click.secho(f"Error preparing the downstream source in {downstream_path}", fg="red")
+        if prep_proc.stderr:
+            click.secho(
+                f"Error preparing the downstream source: {prep_proc.stderr}",
+                fg="red",
+            )
+        if prep_proc.stdout:
+            click.secho(
+                f"Error preparing the downstream source: {prep_proc.stdout}",
+                fg="red",
+            )
+
+    return source_dir, prep_proc.returncode == 0
+
+
+def prepare_downstream(
+    conf: config_module.BackporterConfig,
+    branch_name: str,
+    downstream_path: str,
+    dest: str,
+    writable: bool = False,
+) -> typing.Optional[str]:
+    """
+    Produces the prepped downstream source tree for branch_name at dest,
+    reusing a cached tree when the dist-git inputs haven't changed. Pass
+    writable=True when dest will be built in place. Returns the tree's cache
+    key, or None when `rhpkg prep` failed and the tree isn't reproducible.
+    """
+    clone_distgit(conf, branch_name, downstream_path)
+
+    store = DistGitCache.from_config(conf)
+    key = store.key(conf.distgit_repo, downstream_path)
+    if store.get(key, dest, writable):
+        click.secho(f"Using cached downstream source tree {key[:12]}", fg="green")
+        return key
+
+    with store.lock(key):
+        # another run may have prepped the same tree while we waited
+        if store.get_locked(key, dest, writable):
+            click.secho(f"Using cached downstream source tree {key[:12]}", fg="green")
+            return key
+
+        source_dir, prepped = fetch_and_prep(conf, downstream_path)
+        if not prepped:
+            # don't cache a tree that `rhpkg prep` didn't finish
+            shutil.move(source_dir, dest)
+            return None
+
+        store.put(
+            key,
+            source_dir,
+            {"distgit_repo": conf.distgit_repo, "branch": branch_name},
+        )
+        store.get_locked(key, dest, writable)
+    return key
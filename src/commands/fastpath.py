@@ -0,0 +1,230 @@
+import difflib
+import os
+import shutil
+import typing
+from dataclasses import dataclass, field
+import click
+from . import pipeline
+
+
+# how each file of upstream.patch got onto the downstream tree, cheapest first
+CLEAN = "clean"
+THREE_WAY = "3way"
+FUZZY = "fuzzy"
+
+# git apply -C: the context lines that still have to match for a fuzzy hunk
+FUZZY_CONTEXT = 1
+
+
+@dataclass
+class FastPathResult:
+    # the part of the backport produced without FixMorph, against the downstream tree
+    patch: str = ""
+    # path -> CLEAN, THREE_WAY or FUZZY for the files in patch
+    methods: typing.Dict[str, str] = field(default_factory=dict)
+    # the sections of upstream.patch left for FixMorph
+    remaining: str = ""
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {"patch": self.patch, "methods": self.methods, "remaining": self.remaining}
+
+
+def split_patch(upstream_patch: str) -> typing.Tuple[str, typing.List[str]]:
+    """
+    Splits a git-style patch into whatever precedes the first file and one
+    section per file.
+    """
+    lines = upstream_patch.splitlines(keepends=True)
+    header: typing.List[str] = []
+    sections: typing.List[typing.List[str]] = []
+    for line in lines:
+        if line.startswith("diff --git "):
+            sections.append([])
+        (sections[-1] if sections else header).append(line)
+    return "".join(header), ["".join(s) for s in sections]
+
+
+def section_paths(section: str) -> typing.Tuple[typing.Optional[str], typing.Optional[str]]:
+    """
+    Returns the (old, new) path of a file section; None for a created or
+    deleted side.
+    """
+    old = new = None
+    lines = section.splitlines()
+    if lines and "--- " not in section:
+        # no content change, e.g. a mode change or binary file
+        paths = lines[0][len("diff --git a/") :].split(" b/", 1)
+        return paths[0], paths[-1]
+    for line in lines:
+        if line.startswith(("--- ", "+++ ")):
+            path = None if line[4:].startswith("/dev/null") else line[6:].split("\t")[0]
+            if line.startswith("--- "):
+                old = path
+            else:
+                new = path
+                break
+    return old, new
+
+
+def _fast_pathable(section: str) -> bool:
+    # renames, mode-only changes and binary files are left to FixMorph
+    if "\n--- " not in section or "GIT binary patch" in section:
+        return False
+    return not any(
+        line.startswith(("rename from ", "copy from ", "Binary files "))
+        for line in section.splitlines()
+    )
+
+
+def _git_apply(cwd: str, section: str, *args: str) -> bool:
+    patch_path = os.path.join(os.path.abspath(cwd), ".fastpath.patch")
+    with open(patch_path, "w", encoding="utf-8") as f:
+        f.write(section)
+    try:
+        # outside of any repository, so git apply works like patch(1) on cwd
+        env = dict(os.environ, GIT_CEILING_DIRECTORIES=os.path.dirname(os.path.abspath(cwd)))
+        proc = pipeline.run_command(
+            ["git", "apply", *args, patch_path], cwd=cwd, env=env, capture_output=True
+        )
+        return proc.returncode == 0
+    finally:
+        os.remove(patch_path)
+
+
+def _stage_file(src_root: str, path: str, dest_root: str):
+    src = os.path.join(src_root, path)
+    dest = os.path.join(dest_root, path)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.isfile(src):
+        shutil.copy2(src, dest)
+    elif os.path.lexists(dest):
+        os.remove(dest)
+
+
+def _read(path: str) -> typing.Optional[str]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _three_way(
+    upstream_dir: str, ours_dir: str, section: str, path: str, scratch_dir: str
+) -> bool:
+    """
+    Merges the change section makes to path between the upstream pre-image
+    (base), its post-image (theirs) and the downstream file (ours, in
+    ours_dir), in place of a `git apply --3way` that would need upstream's
+    blobs in a downstream repository.
+    """
+    base_dir = os.path.join(scratch_dir, "base")
+    theirs_dir = os.path.join(scratch_dir, "theirs")
+    for directory in (base_dir, theirs_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        _stage_file(upstream_dir, path, directory)
+    if not _git_apply(theirs_dir, section):
+        return False
+    proc = pipeline.run_command(
+        [
+            "git",
+            "merge-file",
+            "-p",
+            os.path.join(ours_dir, path),
+            os.path.join(base_dir, path),
+            os.path.join(theirs_dir, path),
+        ],
+        capture_output=True,
+    )
+    if proc.returncode != 0:
+        return False
+    with open(os.path.join(ours_dir, path), "wb") as f:
+        f.write(proc.stdout)
+    return True
+
+
+def _file_diff(path: str, before: typing.Optional[str], after: typing.Optional[str]) -> str:
+    old_name = f"a/{path}" if before is not None else "/dev/null"
+    new_name = f"b/{path}" if after is not None else "/dev/null"
+    diff = difflib.unified_diff(
+        (before or "").splitlines(keepends=True),
+        (after or "").splitlines(keepends=True),
+        old_name,
+        new_name,
+    )
+    text = "".join(
+        line if line.endswith("\n") else line + "\n\\ No newline at end of file\n"
+        for line in diff
+    )
+    return f"diff --git a/{path} b/{path}\n{text}" if text else ""
+
+
+def apply(
+    upstream_dir: str, downstream_dir: str, upstream_patch: str, scratch_dir: str
+) -> FastPathResult:
+    """
+    Carries each file of upstream_patch over to the downstream tree the
+    cheapest way that works: `git apply`, a 3-way merge against the
+    upstream pre-image, or `git apply` with less context. Neither tree is
+    modified; the files are worked on in scratch_dir. Files none of these
+    handle are returned as the remaining patch, for FixMorph.
+    """
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    ours_dir = os.path.join(scratch_dir, "ours")
+    os.makedirs(ours_dir)
+    header, sections = split_patch(upstream_patch)
+    result = FastPathResult()
+    remaining = []
+    diffs = []
+    try:
+        for section in sections:
+            old, new = section_paths(section)
+            path = new or old
+            if not path or not _fast_pathable(section):
+                remaining.append(section)
+                continue
+            _stage_file(downstream_dir, path, ours_dir)
+            try:
+                before = _read(os.path.join(ours_dir, path))
+                if _git_apply(ours_dir, section):
+                    method = CLEAN
+                elif old and new and before is not None and _three_way(
+                    upstream_dir, ours_dir, section, path, scratch_dir
+                ):
+                    method = THREE_WAY
+                elif _git_apply(
+                    ours_dir, section, f"-C{FUZZY_CONTEXT}", "--ignore-whitespace"
+                ):
+                    method = FUZZY
+                else:
+                    remaining.append(section)
+                    continue
+                diffs.append(_file_diff(path, before, _read(os.path.join(ours_dir, path))))
+            except UnicodeDecodeError:
+                remaining.append(section)
+                continue
+            result.methods[path] = method
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    result.patch = "".join(diffs)
+    result.remaining = header + "".join(remaining) if remaining else ""
+    for path, method in result.methods.items():
+        click.secho(f"{path}: applied ({method})", fg="green")
+    for section in remaining:
+        old, new = section_paths(section)
+        click.secho(f"{new or old}: left to FixMorph", fg="yellow")
+    return result
+
+
+def write_patch(dest: str, fixmorph_patch: str, fast_patch: str) -> str:
+    """
+    Writes the backport's patch to dest: the patch FixMorph generated at
+    fixmorph_patch, followed by the files the fast path carried over, which
+    FixMorph never saw. fixmorph_patch itself is left as it is. Returns dest.
+    """
+    with open(fixmorph_patch, "r", encoding="utf-8") as f:
+        patch = f.read()
+    with open(dest, "w", encoding="utf-8") as f:
+        f.write(patch + fast_patch)
+    return dest
@@ -0,0 +1,434 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import typing
+import uuid
+import click
+from . import cache
+from . import config as config_module
+from . import containers
+
+
+FRR_CONFIGURE = """./configure \
+    --prefix=/usr \
+    --includedir=\${prefix}/include \
+    --bindir=\${prefix}/bin \
+    --sbindir=\${prefix}/lib/frr \
+    --libdir=\${prefix}/lib/frr \
+    --libexecdir=\${prefix}/lib/frr \
+    --sysconfdir=/etc \
+    --localstatedir=/var \
+    --with-moduledir=\${prefix}/lib/frr/modules \
+    --enable-configfile-mask=0640 \
+    --enable-logfile-mask=0640 \
+    --enable-snmp=agentx \
+    --enable-multipath=64 \
+    --enable-user=frr \
+    --enable-group=frr \
+    --enable-vty-group=frrvty \
+    --with-pkg-git-version \
+    --with-pkg-extra-version=-MyOwnFRRVersion \
+	--with-crypto=openssl
+"""
+
+FRR_BUILD = "make"
+
+PKG_NAME = "frr"
+
+TOOLCHAIN_REPO = "fixmorph-frr-toolchain"
+
+# keeps the dist-git checkout (with its tarballs) and the upstream history
+# out of the per-job build context
+DOCKERIGNORE = """downstream-distgit
+upstream/.git
+**/.backporter-last-used
+"""
+
+# the top-level entries of a per-job build context the Dockerfile uses; the
+# API backend sends only these
+CONTEXT_FILES = ("Dockerfile", "run-demo.sh", "upstream.patch", "upstream", "downstream")
+
+# where run-demo.sh leaves the generated patch inside the container
+GENERATED_PATCH_PATH = "/FixMorph/generated.patch"
+
+# where the configure cache volume is mounted in the FixMorph container
+CONFIGURE_CACHE_MOUNT = "/configure-cache"
+
+# FixMorph's own patch in the output directory, kept apart from patch.diff,
+# which is put together from it and the fast path's files
+FIXMORPH_PATCH = "fixmorph.diff"
+
+# serialises toolchain image builds, in the cache dir
+TOOLCHAIN_LOCK = "toolchain.lock"
+
+# ccache's per-run statistics log, next to the patch in either run mode
+CCACHE_STATS_LOG = "ccache-stats.log"
+CCACHE_HIT_COUNTERS = ("direct_cache_hit", "preprocessed_cache_hit")
+CCACHE_MISS_COUNTERS = ("cache_miss",)
+
+
+def dockerfile_path() -> str:
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(current_dir, "dockerfiles", "Dockerfile.frr")
+
+
+def toolchain_dockerfile_path() -> str:
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(current_dir, "dockerfiles", "Dockerfile.frr-toolchain")
+
+
+def demo_script_path() -> str:
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(current_dir, "scripts", "run-demo.sh")
+
+
+def mounted_script_path() -> str:
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(current_dir, "scripts", "run-mounted.sh")
+
+
+def src_paths() -> typing.Dict[str, str]:
+    """
+    Where the A (upstream pre-image), B (upstream post-image) and C
+    (downstream) trees live inside the container.
+    """
+    return {tree: f"/dirs/{PKG_NAME}-{tree}" for tree in "abc"}
+
+
+def configure_command(cached: bool = False) -> str:
+    """
+    FRR_CONFIGURE, optionally with an autoconf cache file in
+    $CONFIGURE_CACHE_DIR named after the configure flags and a hash of the
+    tree's generated configure script. Trees with identical configure scripts
+    (A and B, unless the patch touches build files) and repeat runs share it,
+    so only the first configure run probes the toolchain.
+    """
+    command = FRR_CONFIGURE.strip()
+    if not cached:
+        return command
+    flags = hashlib.sha256(command.encode("utf-8")).hexdigest()[:16]
+    cache_dir = "${CONFIGURE_CACHE_DIR:-/tmp/configure-cache}"
+    # configure replaces an existing cache file with mv, so concurrent runs
+    # sharing it never see a partial file
+    cache_file = f'"{cache_dir}/{flags}-$(sha256sum configure | cut -c1-16).cache"'
+    configure = command.replace("./configure", f"./configure --cache-file={cache_file}", 1)
+    return f'mkdir -p "{cache_dir}" && {configure}'
+
+
+def make_command(jobs: int = 1) -> str:
+    return FRR_BUILD if jobs <= 1 else f"{FRR_BUILD} -j{jobs}"
+
+
+def repair_commands(
+    jobs: int = 1,
+    cached: bool = False,
+    targets: typing.Optional[typing.Sequence[str]] = None,
+) -> typing.Dict[str, str]:
+    """
+    The configure and build command FixMorph runs in each tree, keyed by
+    their repair.conf names. The build runs `jobs` compile jobs at once, and
+    `cached` has configure use the shared autoconf cache. With targets, A and
+    B only build those make targets; C is always built in full since that's
+    where FixMorph looks for the place to transplant the patch.
+    """
+    commands = {}
+    for tree in "abc":
+        build = make_command(jobs)
+        if targets and tree in "ab":
+            build = " ".join([build, *targets])
+        commands[f"config_command_{tree}"] = configure_command(cached)
+        commands[f"build_command_{tree}"] = build
+    return commands
+
+
+def write_repair_conf(
+    path: str, jobs: int = 1, targets: typing.Optional[typing.Sequence[str]] = None
+):
+    lines = [f"path_{tree}:{src}" for tree, src in src_paths().items()]
+    lines += [
+        f"{key}:{value}"
+        for key, value in repair_commands(jobs, cached=True, targets=targets).items()
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def read_dockerfile() -> str:
+    """
+    Reads and returns the contents of a Dockerfile used to compile
+    the projects.
+    """
+    with open(dockerfile_path(), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def read_demo_script() -> str:
+    """
+    Reads out the run-demo.sh file and returns it as a string.
+    """
+    with open(demo_script_path(), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def assemble_context(context_dir: str, upstream_patch: str):
+    """
+    Places the Dockerfile, .dockerignore, run-demo.sh and upstream.patch next
+    to the `upstream` and `downstream` trees already in context_dir.
+    """
+    shutil.copy(dockerfile_path(), os.path.join(context_dir, "Dockerfile"))
+    with open(os.path.join(context_dir, ".dockerignore"), "w", encoding="utf-8") as f:
+        f.write(DOCKERIGNORE)
+    shutil.copy(demo_script_path(), os.path.join(context_dir, "run-demo.sh"))
+    with open(os.path.join(context_dir, "upstream.patch"), "w", encoding="utf-8") as f:
+        f.write(upstream_patch)
+
+
+def toolchain_build_args(conf: config_module.BackporterConfig) -> typing.Dict[str, str]:
+    args = {
+        "GIT_EMAIL": "user@example.com",
+        "GIT_NAME": "user",
+    }
+    if conf.fixmorph_base_image:
+        args["FIXMORPH_IMAGE"] = conf.fixmorph_base_image
+    return args
+
+
+def toolchain_tag(conf: config_module.BackporterConfig) -> str:
+    """
+    Tags the toolchain image by a hash of its Dockerfile and build args, so it
+    is only rebuilt when the package's dependency stanza changes.
+    """
+    digest = hashlib.sha256()
+    with open(toolchain_dockerfile_path(), "rb") as f:
+        digest.update(f.read())
+    # hashed as the --build-arg flags they used to be passed as, so existing
+    # toolchain images keep their tags
+    for key, value in toolchain_build_args(conf).items():
+        for arg in ("--build-arg", f"{key}={value}"):
+            digest.update(b"\0" + arg.encode("utf-8"))
+    return f"{TOOLCHAIN_REPO}:{digest.hexdigest()[:16]}"
+
+
+def image_id(tag: str) -> str:
+    """
+    Returns the content-addressed id of a local image.
+    """
+    return containers.engine().image_id(tag)
+
+
+def run_inputs_digest(run_mode: str) -> str:
+    """
+    Hashes everything besides the trees and the toolchain that decides what a
+    FixMorph run produces: the repair.conf commands and the files that drive
+    the run in run_mode.
+    """
+    digest = hashlib.sha256(run_mode.encode("utf-8"))
+    # neither the job count nor the ccache and configure caches change what
+    # gets built, so they're left out
+    for key, value in sorted(repair_commands().items()):
+        digest.update(f"\0{key}={value}".encode("utf-8"))
+    if run_mode == "mount":
+        paths = [mounted_script_path()]
+    else:
+        paths = [dockerfile_path(), demo_script_path()]
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(b"\0" + f.read())
+    return digest.hexdigest()
+
+
+def image_exists(tag: str) -> bool:
+    return containers.engine().image_exists(tag)
+
+
+def ensure_toolchain(
+    conf: config_module.BackporterConfig, log_path: typing.Optional[str] = None
+) -> str:
+    """
+    Builds the toolchain image unless one for the current dependency stanza
+    already exists, and returns its tag. Concurrent callers, in this process
+    or another, wait for a single build.
+    """
+    tag = toolchain_tag(conf)
+    if image_exists(tag):
+        click.secho(f"Using toolchain image {tag}", fg="green")
+        return tag
+
+    with cache.FileLock(conf.cache_path(TOOLCHAIN_LOCK)):
+        # another caller may have built it while we waited
+        if image_exists(tag):
+            click.secho(f"Using toolchain image {tag}", fg="green")
+            return tag
+        click.secho(f"Building toolchain image {tag}")
+        # the toolchain doesn't COPY anything, so send it an empty context
+        with tempfile.TemporaryDirectory() as context_dir:
+            rc = containers.engine().build(
+                context_dir,
+                tag,
+                toolchain_build_args(conf),
+                dockerfile=toolchain_dockerfile_path(),
+                log_path=log_path,
+            )
+            if rc != 0:
+                raise RuntimeError(f"Error building the toolchain image {tag}")
+    return tag
+
+
+def build_args(toolchain_image: str, jobs: int = 1) -> typing.Dict[str, str]:
+    args = {
+        "TOOLCHAIN_IMAGE": toolchain_image,
+        "PKG_NAME": PKG_NAME,
+    }
+    for key, value in repair_commands(jobs, cached=True).items():
+        args[key.upper()] = value
+    return args
+
+
+def build_image(
+    context_dir: str,
+    tag: str,
+    toolchain_image: str,
+    log_path: typing.Optional[str] = None,
+    jobs: int = 1,
+) -> int:
+    return containers.engine().build(
+        context_dir,
+        tag,
+        build_args(toolchain_image, jobs),
+        include=CONTEXT_FILES,
+        log_path=log_path,
+    )
+
+
+def build_cache_args(
+    conf: config_module.BackporterConfig, stats: bool = True
+) -> typing.List[str]:
+    """
+    docker run arguments that mount the shared compiler and configure caches
+    and, with stats, have ccache log this run's hits and misses next to the
+    patch.
+    """
+    # configure probes the toolchain, so each toolchain gets its own caches
+    toolchain_key = toolchain_tag(conf).rsplit(":", 1)[-1]
+    args = [
+        "-e",
+        f"CCACHE_MAXSIZE={conf.ccache_max_size}",
+        "-e",
+        f"CONFIGURE_CACHE_DIR={CONFIGURE_CACHE_MOUNT}/{toolchain_key}",
+    ]
+    if stats:
+        # run_mounted's output mount, or the directory run_image copies out of
+        stats_dir = "/workspace/output" if conf.run_mode == "mount" else "/FixMorph"
+        args += ["-e", f"CCACHE_STATSLOG={stats_dir}/{CCACHE_STATS_LOG}"]
+    if conf.ccache_volume:
+        args += ["-v", f"{conf.ccache_volume}:/ccache"]
+    if conf.configure_cache_volume:
+        args += ["-v", f"{conf.configure_cache_volume}:{CONFIGURE_CACHE_MOUNT}"]
+    return args
+
+
+def ccache_stats(stats_log: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Sums a ccache statistics log into hits, misses and the hit rate, or
+    returns None when the run didn't leave one.
+    """
+    if not os.path.isfile(stats_log):
+        return None
+    hits = misses = 0
+    with open(stats_log, "r", encoding="utf-8") as f:
+        for line in f:
+            counter = line.strip()
+            if counter in CCACHE_HIT_COUNTERS:
+                hits += 1
+            elif counter in CCACHE_MISS_COUNTERS:
+                misses += 1
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 3) if total else None,
+    }
+
+
+def format_ccache(stats: typing.Optional[typing.Dict[str, typing.Any]]) -> str:
+    if not stats or stats["hit_rate"] is None:
+        return "-"
+    return f"{stats['hit_rate']:.0%} ({stats['hits']}/{stats['hits'] + stats['misses']})"
+
+
+def run_image(
+    tag: str,
+    output_dir: str,
+    log_path: typing.Optional[str] = None,
+    docker_args: typing.Sequence[str] = (),
+) -> typing.Tuple[int, typing.Optional[str]]:
+    """
+    Runs FixMorph in a container of tag and copies the generated patch (and
+    the ccache statistics log) to output_dir. Returns the exit code and the
+    patch path, if any.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    container = f"fixmorph-{uuid.uuid4().hex[:12]}"
+    engine = containers.engine()
+    try:
+        # inside the try: a run cancelled or failing after creating the
+        # container still removes it
+        rc = engine.run(["--name", container, *docker_args, tag], log_path=log_path)
+        engine.copy_from(
+            container,
+            f"/FixMorph/{CCACHE_STATS_LOG}",
+            os.path.join(output_dir, CCACHE_STATS_LOG),
+        )
+        patch_path = os.path.join(output_dir, FIXMORPH_PATCH)
+        if not engine.copy_from(container, GENERATED_PATCH_PATH, patch_path):
+            return rc, None
+        return rc, patch_path
+    finally:
+        engine.remove(container)
+
+
+def run_mounted(
+    toolchain_image: str,
+    trees: typing.Dict[str, str],
+    workspace_dir: str,
+    output_dir: str,
+    log_path: typing.Optional[str] = None,
+    jobs: int = 1,
+    docker_args: typing.Sequence[str] = (),
+    targets: typing.Optional[typing.Sequence[str]] = None,
+) -> typing.Tuple[int, typing.Optional[str]]:
+    """
+    Runs FixMorph in the toolchain image with the host's A/B/C trees (keyed
+    "a", "b", "c" in trees) and repair.conf bind-mounted, so no per-job image
+    is built. The patch is written straight to output_dir/FIXMORPH_PATCH. With
+    targets, only those are built in A and B (see repair_commands).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    repair_conf = os.path.join(workspace_dir, "repair.conf")
+    write_repair_conf(repair_conf, jobs, targets)
+
+    command = ["--rm", "--platform", containers.PLATFORM, *docker_args]
+    for tree, src in src_paths().items():
+        command += ["-e", f"SRC_PATH_{tree.upper()}={src}"]
+        command += ["-v", f"{os.path.abspath(trees[tree])}:{src}:rw,z"]
+    command += [
+        "-e",
+        f"HOST_UID={os.getuid()}",
+        "-e",
+        f"HOST_GID={os.getgid()}",
+        "-v",
+        f"{os.path.abspath(repair_conf)}:/workspace/repair.conf:ro,z",
+        "-v",
+        f"{mounted_script_path()}:/workspace/run.sh:ro,z",
+        "-v",
+        f"{os.path.abspath(output_dir)}:/workspace/output:rw,z",
+        toolchain_image,
+        "bash",
+        "/workspace/run.sh",
+    ]
+    rc = containers.engine().run(command, log_path=log_path)
+    patch_path = os.path.join(output_dir, FIXMORPH_PATCH)
+    if not os.path.isfile(patch_path):
+        return rc, None
+    return rc, patch_path
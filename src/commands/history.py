@@ -0,0 +1,427 @@
+import contextlib
+import os
+import sqlite3
+import statistics
+import time
+import typing
+from dataclasses import dataclass, field
+import click
+from . import config as config_module
+from . import profiling
+
+
+# how a finished backport got its patch
+FIXMORPH = "fixmorph"
+FAST_PATH = "fast-path"
+STORED = "stored"
+FAILED = "failed"
+
+# the newest runs an estimate is taken from
+ESTIMATE_SAMPLES = 20
+
+# how long a writer waits for another process's transaction
+BUSY_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT,
+    kind TEXT NOT NULL,
+    package TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    commit_sha TEXT NOT NULL,
+    run_mode TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    failed_stage TEXT,
+    started REAL NOT NULL,
+    wall_seconds REAL NOT NULL,
+    cpu_seconds REAL NOT NULL,
+    peak_rss_kb INTEGER NOT NULL,
+    ccache_hit_rate REAL
+);
+CREATE INDEX IF NOT EXISTS runs_pair ON runs (package, branch, commit_sha);
+CREATE TABLE IF NOT EXISTS stages (
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    wall_seconds REAL NOT NULL,
+    cpu_seconds REAL NOT NULL,
+    max_rss_kb INTEGER NOT NULL,
+    ok INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stages_run ON stages (run);
+"""
+
+
+def package(conf: config_module.BackporterConfig) -> str:
+    """
+    Names the package runs are recorded under: the dist-git repo's name.
+    """
+    name = conf.distgit_repo.rstrip("/").rsplit("/", 1)[-1]
+    return name[: -len(".git")] if name.endswith(".git") else name
+
+
+def outcome_of(results: typing.Dict[str, typing.Any]) -> str:
+    """
+    Returns how a finished create pipeline got its patch.
+    """
+    if "fixmorph" in results:
+        return FIXMORPH
+    fast_path = results.get("apply")
+    if fast_path and not fast_path["remaining"]:
+        return FAST_PATH
+    return STORED
+
+
+@dataclass
+class Estimate:
+    """
+    The expected wall time of a backport, the median of past runs like it;
+    basis says which runs those were ("on rhel-9").
+    """
+
+    seconds: float
+    samples: int
+    basis: str
+    stages: typing.Dict[str, float] = field(default_factory=dict)
+
+
+class History:
+    """
+    Every finished backport's outcome, stage timings and resource peaks per
+    (package, branch, commit), in an SQLite database. Runs are estimated and
+    ordered from it; `backporter stats` queries it. Only the newest max_runs
+    runs are kept.
+    """
+
+    def __init__(self, path: str, max_runs: int):
+        self.path = path
+        self.max_runs = max_runs
+
+    @classmethod
+    def from_config(cls, conf: config_module.BackporterConfig) -> "History":
+        return cls(conf.cache_path("history.sqlite3"), conf.history_max_runs)
+
+    @contextlib.contextmanager
+    def connect(self) -> typing.Iterator[sqlite3.Connection]:
+        """
+        Opens the database for one transaction, committed on success. Each
+        call gets its own connection, so batch workers can record at once.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        try:
+            db.execute("PRAGMA foreign_keys = ON")
+            db.executescript(SCHEMA)
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record(
+        self,
+        kind: str,
+        package: str,
+        branch: str,
+        commit: str,
+        run_mode: str,
+        outcome: str,
+        started: float,
+        wall_seconds: float,
+        stages: typing.Sequence[profiling.StageRecord],
+        run_id: typing.Optional[str] = None,
+        failed_stage: typing.Optional[str] = None,
+        ccache: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ):
+        """
+        Adds a finished run with the stages it ran, dropping the oldest runs
+        beyond max_runs.
+        """
+        cpu = [s.child_user_seconds + s.child_system_seconds for s in stages]
+        with self.connect() as db:
+            cursor = db.execute(
+                "INSERT INTO runs (run_id, kind, package, branch, commit_sha, run_mode,"
+                " outcome, failed_stage, started, wall_seconds, cpu_seconds, peak_rss_kb,"
+                " ccache_hit_rate) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    run_id,
+                    kind,
+                    package,
+                    branch,
+                    commit,
+                    run_mode,
+                    outcome,
+                    failed_stage,
+                    started,
+                    wall_seconds,
+                    sum(cpu),
+                    max((s.child_max_rss_kb for s in stages), default=0),
+                    ccache.get("hit_rate") if ccache else None,
+                ),
+            )
+            db.executemany(
+                "INSERT INTO stages (run, name, wall_seconds, cpu_seconds, max_rss_kb, ok)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (cursor.lastrowid, s.name, s.wall_seconds, c, s.child_max_rss_kb, s.ok)
+                    for s, c in zip(stages, cpu)
+                ],
+            )
+            if self.max_runs:
+                db.execute(
+                    "DELETE FROM runs WHERE id <= ?",
+                    (cursor.lastrowid - self.max_runs,),
+                )
+
+    def last_outcome(
+        self, package: str, branch: str, commit: str, run_mode: str
+    ) -> typing.Optional[str]:
+        """
+        Returns how the newest successful run of this backport got its patch.
+        """
+        with self.connect() as db:
+            row = db.execute(
+                "SELECT outcome FROM runs WHERE package = ? AND branch = ? AND commit_sha = ?"
+                " AND run_mode = ? AND outcome != ? ORDER BY id DESC LIMIT 1",
+                (package, branch, commit, run_mode, FAILED),
+            ).fetchone()
+        return row[0] if row else None
+
+    def estimate(
+        self,
+        package: str,
+        branch: str,
+        commit: str,
+        run_mode: str,
+        outcome: typing.Optional[str] = None,
+    ) -> typing.Optional[Estimate]:
+        """
+        Estimates a backport from the newest successful runs of the same
+        commit and branch, else of the branch, else of any branch of the
+        package, all in run_mode and with outcome if given. Returns None
+        without such runs.
+        """
+        scopes = [
+            ("branch = ? AND commit_sha = ?", (branch, commit), f"of {commit} on {branch}"),
+            ("branch = ?", (branch,), f"on {branch}"),
+            ("1", (), "on any branch"),
+        ]
+        where = "package = ? AND run_mode = ? AND outcome != ?"
+        params: typing.Tuple[typing.Any, ...] = (package, run_mode, FAILED)
+        if outcome:
+            where += " AND outcome = ?"
+            params += (outcome,)
+        with self.connect() as db:
+            for clause, scope_params, basis in scopes:
+                rows = db.execute(
+                    f"SELECT id, wall_seconds FROM runs WHERE {where} AND {clause}"
+                    " ORDER BY id DESC LIMIT ?",
+                    params + scope_params + (ESTIMATE_SAMPLES,),
+                ).fetchall()
+                if not rows:
+                    continue
+                ids = [row[0] for row in rows]
+                walls: typing.Dict[str, typing.List[float]] = {}
+                for name, wall in db.execute(
+                    "SELECT name, wall_seconds FROM stages WHERE ok AND run IN"
+                    f" ({','.join('?' * len(ids))})",
+                    ids,
+                ):
+                    walls.setdefault(name, []).append(wall)
+                return Estimate(
+                    seconds=statistics.median(row[1] for row in rows),
+                    samples=len(rows),
+                    basis=basis,
+                    stages={name: statistics.median(w) for name, w in walls.items()},
+                )
+        return None
+
+    @staticmethod
+    def _filter(
+        branch: typing.Optional[str], commit: typing.Optional[str], since: typing.Optional[float]
+    ) -> typing.Tuple[str, typing.List[typing.Any]]:
+        where, params = ["1"], []
+        for clause, value in (
+            ("runs.branch = ?", branch),
+            ("runs.commit_sha = ?", commit),
+            ("runs.started >= ?", since),
+        ):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        return " AND ".join(where), params
+
+    def stats(
+        self,
+        branch: typing.Optional[str] = None,
+        commit: typing.Optional[str] = None,
+        since: typing.Optional[float] = None,
+    ) -> typing.Tuple[typing.List[tuple], typing.List[tuple]]:
+        """
+        Aggregates the matching runs per (package, branch, run mode) and their
+        stages per name. Returns both lists of rows.
+        """
+        condition, params = self._filter(branch, commit, since)
+        with self.connect() as db:
+            runs = db.execute(
+                "SELECT package, branch, run_mode, COUNT(*),"
+                f" SUM(outcome = '{FIXMORPH}'), SUM(outcome = '{FAST_PATH}'),"
+                f" SUM(outcome = '{STORED}'), SUM(outcome = '{FAILED}'),"
+                " AVG(wall_seconds), MAX(wall_seconds), MAX(peak_rss_kb),"
+                " AVG(ccache_hit_rate)"
+                f" FROM runs WHERE {condition} GROUP BY package, branch, run_mode"
+                " ORDER BY package, branch, run_mode",
+                params,
+            ).fetchall()
+            stages = db.execute(
+                "SELECT stages.name, COUNT(*), AVG(stages.wall_seconds),"
+                " MAX(stages.wall_seconds), AVG(stages.cpu_seconds), MAX(stages.max_rss_kb),"
+                " SUM(NOT stages.ok)"
+                f" FROM stages JOIN runs ON stages.run = runs.id WHERE {condition}"
+                " GROUP BY stages.name ORDER BY SUM(stages.wall_seconds) DESC",
+                params,
+            ).fetchall()
+        return runs, stages
+
+    def recent(
+        self,
+        limit: int,
+        branch: typing.Optional[str] = None,
+        commit: typing.Optional[str] = None,
+        since: typing.Optional[float] = None,
+    ) -> typing.List[tuple]:
+        """
+        Returns the newest matching runs, newest first.
+        """
+        condition, params = self._filter(branch, commit, since)
+        with self.connect() as db:
+            return db.execute(
+                "SELECT started, kind, branch, commit_sha, outcome, failed_stage,"
+                f" wall_seconds, peak_rss_kb FROM runs WHERE {condition}"
+                " ORDER BY id DESC LIMIT ?",
+                params + [limit],
+            ).fetchall()
+
+
+def record_run(
+    conf: config_module.BackporterConfig,
+    kind: str,
+    branch: str,
+    commit: str,
+    outcome: str,
+    started: float,
+    stages: typing.Sequence[profiling.StageRecord],
+    wall_seconds: typing.Optional[float] = None,
+    **details,
+):
+    """
+    Records a finished run in conf's history. The backport stands either way,
+    so a database error is only reported.
+    """
+    try:
+        History.from_config(conf).record(
+            kind,
+            package(conf),
+            branch,
+            commit,
+            conf.run_mode,
+            outcome,
+            started,
+            time.time() - started if wall_seconds is None else wall_seconds,
+            stages,
+            **details,
+        )
+    except sqlite3.Error as e:
+        click.secho(f"Could not record the run in the history: {e}", fg="yellow")
+
+
+def expected_seconds(
+    conf: config_module.BackporterConfig, branch: str, commit: str
+) -> typing.Optional[float]:
+    """
+    Estimates a backport in conf's run mode as it went last time, for ordering
+    work. Returns None without a history to go by.
+    """
+    try:
+        history = History.from_config(conf)
+        name = package(conf)
+        found = history.estimate(
+            name,
+            branch,
+            commit,
+            conf.run_mode,
+            history.last_outcome(name, branch, commit, conf.run_mode),
+        )
+    except sqlite3.Error as e:
+        click.secho(f"Could not read the history: {e}", fg="yellow")
+        return None
+    return found.seconds if found else None
+
+
+def stage_records(timings: typing.Dict[str, float]) -> typing.List[profiling.StageRecord]:
+    """
+    Turns a batch pair's timings into stage records for record().
+    """
+    return [
+        profiling.StageRecord(name=name, start=0.0, wall_seconds=seconds)
+        for name, seconds in timings.items()
+    ]
+
+
+def _table(rows: typing.List[typing.Sequence[str]]) -> str:
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+def _seconds(value: typing.Optional[float]) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+def _megabytes(kb: typing.Optional[int]) -> str:
+    return "-" if not kb else f"{kb / 1024:.0f}"
+
+
+def format_stats(runs: typing.List[tuple], stages: typing.List[tuple]) -> str:
+    """
+    Renders History.stats() as two plain-text tables.
+    """
+    if not runs:
+        return "No runs recorded"
+    run_rows = [
+        ("PACKAGE", "BRANCH", "MODE", "RUNS", "FIXMORPH", "FAST PATH", "STORED", "FAILED",
+         "AVG (s)", "MAX (s)", "PEAK RSS (MB)", "CCACHE")
+    ]
+    for package, branch, mode, count, fixmorph, fast, stored, failed, avg, top, rss, rate in runs:
+        run_rows.append(
+            (
+                package, branch, mode, str(count), str(fixmorph), str(fast), str(stored),
+                str(failed), _seconds(avg), _seconds(top), _megabytes(rss),
+                "-" if rate is None else f"{rate:.0%}",
+            )
+        )
+    stage_rows = [("STAGE", "RUNS", "AVG (s)", "MAX (s)", "AVG CPU (s)", "PEAK RSS (MB)", "FAILED")]
+    for name, count, avg, top, cpu, rss, failed in stages:
+        stage_rows.append(
+            (name, str(count), _seconds(avg), _seconds(top), _seconds(cpu), _megabytes(rss),
+             str(failed))
+        )
+    return f"{_table(run_rows)}\n\n{_table(stage_rows)}"
+
+
+def format_recent(rows: typing.List[tuple]) -> str:
+    table = [("STARTED", "KIND", "BRANCH", "COMMIT", "OUTCOME", "WALL (s)", "PEAK RSS (MB)")]
+    for started, kind, branch, commit, outcome, failed_stage, wall, rss in rows:
+        table.append(
+            (
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(started)),
+                kind,
+                branch,
+                commit[:12],
+                f"{outcome} ({failed_stage})" if failed_stage else outcome,
+                _seconds(wall),
+                _megabytes(rss),
+            )
+        )
+    return _table(table)
@@ -0,0 +1,235 @@
+import collections
+import contextlib
+import os
+import re
+import sys
+import threading
+import time
+import typing
+import click
+
+
+# bytes read from a child's output per os.read call
+CHUNK_SIZE = 64 * 1024
+
+# how often the console is refreshed with the newest output
+CONSOLE_INTERVAL = 0.25
+
+# lines of output shown on the console per refresh; older ones are elided
+DEFAULT_TAIL_LINES = 20
+
+# lines of a failed stage's output repeated on the console
+FAILURE_TAIL_LINES = 20
+
+# the stage and run log of each thread; threads working for a run are handed
+# its log with attach
+_local = threading.local()
+
+
+def current_stage() -> str:
+    return getattr(_local, "stage", None) or "main"
+
+
+def active() -> typing.Optional["RunLog"]:
+    return getattr(_local, "run_log", None)
+
+
+def attach(run_log: typing.Optional["RunLog"]):
+    """
+    Sends this thread's output to run_log; used as the initializer of the
+    thread pools a run fans out on, so concurrent runs keep separate logs.
+    """
+    _local.run_log = run_log
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name)
+
+
+class Console:
+    """
+    Shows child output on the terminal from a single background thread, at
+    most `tail` lines per refresh, so a chatty build can't make the terminal
+    the bottleneck. Stage markers are never elided.
+    """
+
+    def __init__(self, tail: int, log_dir: str):
+        self.tail = tail
+        self.log_dir = log_dir
+        self._entries: typing.Deque[typing.Tuple[bool, str]] = collections.deque()
+        self._lines = 0
+        self._omitted = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def line(self, text: str):
+        with self._lock:
+            if self.tail <= 0:
+                self._omitted += 1
+                return
+            self._entries.append((False, text))
+            self._lines += 1
+            if self._lines > self.tail:
+                # drop the oldest output line, keeping markers in place
+                for i, (marker, _) in enumerate(self._entries):
+                    if not marker:
+                        del self._entries[i]
+                        break
+                self._lines -= 1
+                self._omitted += 1
+
+    def marker(self, text: str):
+        with self._lock:
+            self._entries.append((True, text))
+
+    def flush(self):
+        with self._lock:
+            entries = list(self._entries)
+            omitted = self._omitted
+            self._entries.clear()
+            self._lines = 0
+            self._omitted = 0
+        if omitted and self.tail > 0:
+            entries.insert(
+                0, (True, click.style(f"... {omitted} lines omitted, see {self.log_dir}", dim=True))
+            )
+        if entries:
+            # one write per refresh; click drops the styling when not on a tty
+            click.echo("\n".join(text for _, text in entries))
+
+    def _loop(self):
+        while not self._stopped.wait(CONSOLE_INTERVAL):
+            self.flush()
+
+
+class RunLog:
+    """
+    The logs of one run: run.log holds every stage's output, each line prefixed
+    with its stage, between start and finish markers; <stage>.log holds one
+    stage's raw output. Files are written unbuffered as output arrives.
+    """
+
+    def __init__(self, log_dir: str, tail: int = DEFAULT_TAIL_LINES):
+        self.log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        self.path = os.path.join(log_dir, "run.log")
+        self._file = open(self.path, "ab", buffering=0)
+        self._lock = threading.Lock()
+        self._recent: typing.Dict[str, typing.Deque[str]] = {}
+        self.console = Console(tail, log_dir)
+
+    def __enter__(self) -> "RunLog":
+        self._previous = active()
+        attach(self)
+        self.console.start()
+        return self
+
+    def __exit__(self, *exc):
+        attach(self._previous)
+        self.console.stop()
+        self._file.close()
+
+    def stage_path(self, stage: str) -> str:
+        return os.path.join(self.log_dir, _safe_name(stage) + ".log")
+
+    def write_lines(self, stage: str, lines: typing.List[bytes]):
+        prefix = f"[{stage}] ".encode("utf-8")
+        with self._lock:
+            self._file.write(b"".join(prefix + line + b"\n" for line in lines))
+            recent = self._recent.setdefault(
+                stage, collections.deque(maxlen=FAILURE_TAIL_LINES)
+            )
+            for line in lines:
+                text = line.decode("utf-8", errors="replace").rstrip("\r")
+                recent.append(text)
+                self.console.line(f"[{stage}] {text}")
+
+    def write_marker(self, text: str, **style):
+        stamp = time.strftime("%H:%M:%S")
+        with self._lock:
+            self._file.write(f"{text} [{stamp}]\n".encode("utf-8"))
+        self.console.marker(click.style(text, **style))
+
+    def recent(self, stage: str) -> typing.List[str]:
+        with self._lock:
+            return list(self._recent.get(stage, ()))
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Attributes output captured on this thread to stage `name` and, when a run
+    log is active, brackets it with start and finish markers.
+    """
+    previous = getattr(_local, "stage", None)
+    _local.stage = name
+    run_log = active()
+    start = time.monotonic()
+    if run_log:
+        run_log.write_marker(f"==> {name}", bold=True)
+    try:
+        yield
+    except BaseException as e:
+        if run_log and getattr(e, "cancelled", False):
+            run_log.write_marker(f"<== {name} cancelled", fg="yellow")
+        elif run_log:
+            elapsed = time.monotonic() - start
+            run_log.write_marker(f"<== {name} failed after {elapsed:.1f}s: {e}", fg="red")
+            for text in run_log.recent(name):
+                run_log.console.marker(click.style(f"[{name}] {text}", fg="red"))
+        raise
+    else:
+        if run_log:
+            elapsed = time.monotonic() - start
+            run_log.write_marker(f"<== {name} done in {elapsed:.1f}s", fg="green")
+    finally:
+        _local.stage = previous
+
+
+def capture(stream: typing.BinaryIO, log_path: typing.Optional[str] = None):
+    """
+    Reads stream in large chunks until EOF and hands the output to the active
+    run log (or the terminal when there is none), and to log_path if given.
+    """
+    name = current_stage()
+    run_log = active()
+    fd = stream.fileno()
+    files = []
+    if run_log:
+        files.append(open(run_log.stage_path(name), "ab", buffering=0))
+    if log_path:
+        files.append(open(log_path, "ab", buffering=0))
+    partial = b""
+    try:
+        while True:
+            chunk = os.read(fd, CHUNK_SIZE)
+            if not chunk:
+                break
+            for f in files:
+                f.write(chunk)
+            if run_log is None:
+                sys.stdout.write(chunk.decode("utf-8", errors="replace"))
+                continue
+            lines = (partial + chunk).split(b"\n")
+            partial = lines.pop()
+            if len(partial) > CHUNK_SIZE:
+                lines.append(partial)
+                partial = b""
+            if lines:
+                run_log.write_lines(name, lines)
+        if partial and run_log:
+            run_log.write_lines(name, [partial])
+    finally:
+        for f in files:
+            f.close()
+        if run_log is None:
+            sys.stdout.flush()
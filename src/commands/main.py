@@ -1,34 +1,34 @@
 import os
 import shutil
-import subprocess
 from . import config as config_module
+from . import batch as batch_module
+from . import cache as cache_module
+from . import containers as containers_module
+from . import daemon as daemon_module
+from . import downstream as downstream_module
+from . import fastpath as fastpath_module
+from . import fixmorph as fixmorph_module
+from . import history as history_module
+from . import logs
+from . import pipeline
+from . import planning as planning_module
+from . import profiling
+from . import results as results_module
+from . import runs as runs_module
+from . import scheduler as scheduler_module
+from . import series as series_module
+from . import slicing as slicing_module
+from . import upstream as upstream_module
+from . import warm as warm_module
+from . import workspace as workspace_module
 import click
 import logging
 import sys
 import yaml
 from os.path import exists, abspath
 import tempfile
-
-
-def read_dockerfile() -> str:
-    """
-    Reads and returns the contents of a Dockerfile used to compile
-    the projects.
-    """
-    current_dir = os.path.dirname(os.path.realpath(__file__))
-    dockerfile_path = os.path.join(current_dir, "dockerfiles", "Dockerfile.frr")
-    with open(dockerfile_path, "r", encoding="utf-8") as f:
-        return f.read()
-
-
-def read_demo_script() -> str:
-    """
-    Reads out the run-demo.sh file and returns it as a string.
-    """
-    current_dir = os.path.dirname(os.path.realpath(__file__))
-    script_path = os.path.join(current_dir, "scripts", "run-demo.sh")
-    with open(script_path, "r", encoding="utf-8") as f:
-        return f.read()
+import time
+import typing
 
 
 @click.group()
@@ -177,6 +177,40 @@ def view(ctx):
     click.secho(yaml.dump(conf.__dict__), fg="green")
 
 
+@cli.group()
+def cache():
+    pass
+
+
+@cache.command()
+@click.pass_context
+def gc(ctx):
+    """
+    Evicts least recently used cache entries until each store fits its size
+    limit, after dropping FixMorph results older than result_cache_max_age_days.
+    """
+    configfile = ctx.obj["config"]
+    if not exists(configfile):
+        click.secho(
+            f"Config file {configfile} does not exist. Please create one first.",
+            fg="red",
+        )
+        return
+
+    conf = config_module.read_config(configfile)
+    stores = [
+        upstream_module.MirrorStore.from_config(conf),
+        downstream_module.DistGitCache.from_config(conf),
+        results_module.ResultStore.from_config(conf),
+        workspace_module.BootstrapCache.from_config(conf),
+        slicing_module.CompileDbCache.from_config(conf),
+    ]
+    for store in stores:
+        for path in store.gc():
+            click.secho(f"Evicted {path}", fg="yellow")
+    click.secho("Caches are within their size limits", fg="green")
+
+
 # @cli.command(
 #     help="Checks to make sure that the current machine has everything it needs."
 # )
@@ -197,52 +231,801 @@ def view(ctx):
 #         return
 
 
-FRR_CONFIGURE = """./configure \
-    --prefix=/usr \
-    --includedir=\${prefix}/include \
-    --bindir=\${prefix}/bin \
-    --sbindir=\${prefix}/lib/frr \
-    --libdir=\${prefix}/lib/frr \
-    --libexecdir=\${prefix}/lib/frr \
-    --sysconfdir=/etc \
-    --localstatedir=/var \
-    --with-moduledir=\${prefix}/lib/frr/modules \
-    --enable-configfile-mask=0640 \
-    --enable-logfile-mask=0640 \
-    --enable-snmp=agentx \
-    --enable-multipath=64 \
-    --enable-user=frr \
-    --enable-group=frr \
-    --enable-vty-group=frrvty \
-    --with-pkg-git-version \
-    --with-pkg-extra-version=-MyOwnFRRVersion \
-	--with-crypto=openssl
-"""
-
-FRR_BUILD = "make"
-
-
-def Popen_stream(*args, **kwargs):
-    click.secho(f"Running command: '{args}'", fg="green")
-    click.secho(f"kwargs: '{kwargs}'", fg="green")
+def profiling_options(fn):
+    """
+    Adds the --profile, --report and --trace options to a backporting command.
+    """
+    fn = click.option(
+        "--trace",
+        type=click.Path(dir_okay=False),
+        help="Write a Chrome trace-event file of the run's stages to this path.",
+    )(fn)
+    fn = click.option(
+        "--report",
+        type=click.Path(dir_okay=False),
+        help="Write a JSONL report with per-stage timings and resource usage to this path.",
+    )(fn)
+    fn = click.option(
+        "--profile",
+        is_flag=True,
+        help="Print the stages ranked by wall time at the end of the run.",
+    )(fn)
+    return fn
+
+
+def cache_options(fn):
+    """
+    Adds the --no-cache and --refresh options to a backporting command.
+    """
+    fn = click.option(
+        "--refresh",
+        is_flag=True,
+        help="Run FixMorph even if a stored result exists, and store the new one.",
+    )(fn)
+    fn = click.option(
+        "--no-cache",
+        is_flag=True,
+        help="Neither reuse nor store FixMorph results.",
+    )(fn)
+    return fn
+
+
+def log_options(fn):
+    """
+    Adds the --quiet, --tail and --log-dir options to a backporting command.
+    """
+    fn = click.option(
+        "--log-dir",
+        type=click.Path(file_okay=False),
+        help="Directory for run.log and the per-stage logs of this run.",
+    )(fn)
+    fn = click.option(
+        "--tail",
+        type=click.IntRange(min=0),
+        default=logs.DEFAULT_TAIL_LINES,
+        show_default=True,
+        help="Show at most this many of the newest output lines per console refresh.",
+    )(fn)
+    fn = click.option(
+        "--quiet",
+        "-q",
+        is_flag=True,
+        help="Only show stage progress on the console; output still goes to the logs.",
+    )(fn)
+    return fn
+
+
+def open_run_log(log_dir: str, quiet: bool, tail: int) -> logs.RunLog:
+    click.secho(f"Logging to {log_dir}")
+    return logs.RunLog(log_dir, tail=0 if quiet else tail)
+
+
+def finish_profile(
+    profiler: profiling.Profiler,
+    profile: bool,
+    report: str | None,
+    trace: str | None,
+    **run_info,
+):
+    if report:
+        profiler.write_report(report, **run_info)
+    if trace:
+        profiler.write_trace(trace)
+    if profile:
+        click.secho(profiler.summary())
+
+
+# actual backporting commands
+def create_stages(
+    conf: config_module.BackporterConfig,
+    commit_id: str,
+    branch_name: str,
+    run: runs_module.RunDir,
+    store: results_module.ResultStore,
+    no_cache: bool,
+    refresh: bool,
+    step: typing.Optional[series_module.Step] = None,
+) -> typing.List[pipeline.Stage]:
+    """
+    Builds the stage graph of a create run working in run.work_dir. For a
+    step of a series, the trees prepared by earlier steps are carried on
+    instead of being prepared afresh.
+    """
+    work_dir = run.work_dir
+    output_dir = os.path.join(run.output_dir, step.name) if step else run.output_dir
+    upstream_path = os.path.join(work_dir, "upstream")
+    distgit_path = os.path.join(work_dir, "downstream-distgit")
+    downstream_dir = os.path.join(work_dir, "downstream")
+    patched_dir = os.path.join(work_dir, "patched")
+    # unique to the run and step, so concurrent runs of the same commit never
+    # overwrite each other's image, nor resume from one
+    tag = f"fixmorph-frr:{run.id}-{step.name}" if step else f"fixmorph-frr:{run.id}"
+    scheduler = scheduler_module.for_config(conf)
+    # decided up front since the image build bakes the job count in
+    cost = scheduler.job_cost()
+    bootstrap_store = workspace_module.BootstrapCache.from_config(conf)
+
+    def lookup(results):
+        # a tree whose prep failed has no stable fingerprint
+        if no_cache or results["downstream"] is None:
+            return None
+        key = store.key(
+            upstream_module.resolve_commit(upstream_path, commit_id),
+            results["downstream"],
+            fixmorph_module.image_id(results["toolchain"]),
+            fixmorph_module.run_inputs_digest(conf.run_mode),
+        )
+        stored = None if refresh else store.get(key)
+        if stored:
+            click.secho(f"Reusing stored FixMorph result {key[:12]}", fg="green")
+            return pipeline.Finish(stored)
+        return key
+
+    def fast_path(results):
+        result = fastpath_module.apply(
+            upstream_path,
+            downstream_dir,
+            results["upstream"],
+            os.path.join(work_dir, "fastpath"),
+        )
+        if not result.remaining:
+            click.secho("upstream.patch carried over without FixMorph", fg="green")
+            return pipeline.Finish(result.to_dict())
+        return result.to_dict()
+
+    def assemble(results):
+        # the image build skips ./bootstrap.sh in trees with stored output
+        for tree in (upstream_path, downstream_dir):
+            workspace_module.restore_bootstrap(bootstrap_store, results["toolchain"], tree)
+        # place the dockerfile, run-demo.sh and the patch next to the sources;
+        # FixMorph only gets the files the fast path couldn't carry over
+        fixmorph_module.assemble_context(work_dir, results["apply"]["remaining"])
+
+    def build(results):
+        # docker build takes no resource limits with BuildKit; it only
+        # bootstraps, so it's admitted at a bootstrap's cost
+        with scheduler.slot(
+            scheduler_module.BOOTSTRAP_COST, scheduler_module.PRIORITY_BUILD, "build"
+        ):
+            rc = fixmorph_module.build_image(
+                work_dir, tag, results["toolchain"], jobs=cost.cpus
+            )
+        if rc != 0:
+            raise RuntimeError("Error building the Docker image")
+        print("Docker image built successfully 🥳")
+        return tag
+
+    def run_image(results):
+        with scheduler.slot(cost, name="fixmorph") as granted:
+            rc, patch_path = fixmorph_module.run_image(
+                # the tag the build stage checkpointed
+                results["build"],
+                output_dir,
+                docker_args=fixmorph_module.build_cache_args(conf)
+                + scheduler_module.limit_args(granted),
+            )
+        if rc != 0 or not patch_path:
+            raise RuntimeError(f"FixMorph did not produce a patch (exit code {rc})")
+        return patch_path
+
+    def patched_tree(results):
+        workspace_module.create_patched_tree(
+            upstream_path, results["apply"]["remaining"], patched_dir
+        )
+
+    def slice_trees(results):
+        return slicing_module.plan(
+            conf,
+            results["toolchain"],
+            upstream_path,
+            results["apply"]["remaining"],
+            os.path.join(work_dir, "index"),
+        )
+
+    def run_mounted(results):
+        trees = {
+            "a": upstream_path,
+            "b": patched_dir,
+            "c": os.path.join(work_dir, "fixmorph-c"),
+        }
+
+        def attempt(targets):
+            # FixMorph rewrites C, so it gets a fresh copy and a retry starts clean
+            shutil.rmtree(trees["c"], ignore_errors=True)
+            cache_module.copy_tree(downstream_dir, trees["c"])
+            with scheduler.slot(cost, name="fixmorph") as granted:
+                return fixmorph_module.run_mounted(
+                    results["toolchain"],
+                    trees,
+                    work_dir,
+                    output_dir,
+                    jobs=granted.cpus,
+                    docker_args=fixmorph_module.build_cache_args(conf)
+                    + scheduler_module.limit_args(granted),
+                    targets=targets,
+                )
+
+        rc, patch_path = attempt(results["slice"])
+        if results["slice"] and (rc != 0 or not patch_path):
+            click.secho(
+                "FixMorph found no patch in the sliced trees, retrying with the full trees",
+                fg="yellow",
+            )
+            rc, patch_path = attempt(None)
+        if rc != 0 or not patch_path:
+            raise RuntimeError(f"FixMorph did not produce a patch (exit code {rc})")
+        return patch_path
+
+    # the upstream and downstream chains share nothing until the context is assembled
+    if step:
+        # run_series prepared both trees and applied the earlier steps' patches
+        stages = [
+            pipeline.Stage(
+                "upstream",
+                lambda results: series_module.advance_upstream(upstream_path, commit_id),
+                inputs=(commit_id,),
+                check=lambda result: series_module.at_parent(upstream_path, commit_id),
+            ),
+            pipeline.Stage(
+                "downstream",
+                lambda results: step.downstream_key,
+                inputs=(step.downstream_key,),
+            ),
+        ]
+    else:
+        stages = [
+            pipeline.Stage(
+                "upstream",
+                lambda results: upstream_module.prepare_upstream(
+                    conf, commit_id, upstream_path
+                ),
+                inputs=(conf.upstream_url, commit_id),
+                outputs=(upstream_path,),
+            ),
+            pipeline.Stage(
+                "downstream",
+                lambda results: downstream_module.prepare_downstream(
+                    conf,
+                    branch_name,
+                    distgit_path,
+                    downstream_dir,
+                    writable=conf.run_mode == "mount",
+                ),
+                inputs=(conf.distgit_repo, branch_name, conf.run_mode),
+                outputs=(distgit_path, downstream_dir),
+            ),
+        ]
+    stages += [
+        pipeline.Stage(
+            "toolchain",
+            lambda results: fixmorph_module.ensure_toolchain(conf),
+            inputs=(fixmorph_module.toolchain_tag(conf),),
+            check=fixmorph_module.image_exists,
+        ),
+        # ends the run early on a stored result; the stages below start
+        # speculatively and are cancelled if it hits
+        pipeline.Stage(
+            "lookup",
+            lookup,
+            deps=("upstream", "downstream", "toolchain"),
+            inputs=(no_cache, refresh),
+        ),
+        # also ends the run early when every file of the patch applies
+        pipeline.Stage("apply", fast_path, deps=("upstream", "downstream")),
+    ]
+    if conf.run_mode == "mount":
+        # A is bootstrapped before B is derived from it so B can share the output
+        stages += [
+            pipeline.Stage(
+                "bootstrap-upstream",
+                lambda results: workspace_module.bootstrap_tree(
+                    results["toolchain"],
+                    upstream_path,
+                    store=bootstrap_store,
+                    scheduler=scheduler,
+                ),
+                deps=("upstream", "toolchain"),
+            ),
+            pipeline.Stage(
+                "bootstrap-downstream",
+                lambda results: workspace_module.bootstrap_tree(
+                    results["toolchain"],
+                    downstream_dir,
+                    store=bootstrap_store,
+                    scheduler=scheduler,
+                ),
+                deps=("downstream", "toolchain"),
+            ),
+            pipeline.Stage(
+                "patched",
+                patched_tree,
+                deps=("apply", "bootstrap-upstream"),
+                outputs=(patched_dir,),
+            ),
+            pipeline.Stage(
+                "slice",
+                slice_trees,
+                deps=("apply", "bootstrap-upstream", "toolchain"),
+            ),
+            pipeline.Stage(
+                "fixmorph",
+                run_mounted,
+                deps=("patched", "slice", "bootstrap-downstream", "lookup"),
+                inputs=(fixmorph_module.run_inputs_digest(conf.run_mode),),
+                outputs=(os.path.join(work_dir, "fixmorph-c"), output_dir),
+            ),
+        ]
+    else:
+        stages += [
+            pipeline.Stage(
+                "context", assemble, deps=("apply", "toolchain")
+            ),
+            pipeline.Stage(
+                "build",
+                build,
+                deps=("context", "toolchain"),
+                inputs=(fixmorph_module.run_inputs_digest(conf.run_mode), tag),
+                check=fixmorph_module.image_exists,
+            ),
+            pipeline.Stage(
+                "fixmorph",
+                run_image,
+                deps=("build", "lookup"),
+                outputs=(output_dir,),
+            ),
+        ]
+    return stages
+
+
+def collect_patch(
+    conf: config_module.BackporterConfig,
+    results: typing.Dict[str, typing.Any],
+    output_dir: str,
+    log_dir: str,
+    store: results_module.ResultStore,
+    commit_id: str,
+    branch_name: str,
+) -> typing.Tuple[
+    str,
+    typing.Optional[typing.Dict[str, typing.Any]],
+    typing.Optional[typing.Dict[str, typing.Any]],
+]:
+    """
+    Puts together the patch of a finished create pipeline at
+    output_dir/patch.diff from whatever produced it (FixMorph, the fast
+    path or a stored result) and stores a new FixMorph result. Returns the
+    patch path, the ccache statistics and the fast path's result.
+    """
+    ccache = None
+    fast_path = results.get("apply")
+    if "fixmorph" in results:
+        # FixMorph only saw the files the fast path left over
+        patch_path = fastpath_module.write_patch(
+            os.path.join(output_dir, "patch.diff"),
+            results["fixmorph"],
+            fast_path["patch"] if fast_path else "",
+        )
+        ccache = fixmorph_module.ccache_stats(
+            os.path.join(output_dir, fixmorph_module.CCACHE_STATS_LOG)
+        )
+        if ccache:
+            click.secho(f"ccache hit rate: {fixmorph_module.format_ccache(ccache)}")
+        if results["lookup"]:
+            store.put(
+                results["lookup"],
+                0,
+                patch_path,
+                [os.path.join(log_dir, name) for name in ("run.log", "fixmorph.log")],
+                {"commit": commit_id, "branch": branch_name, "run_mode": conf.run_mode},
+            )
+    elif fast_path and not fast_path["remaining"]:
+        os.makedirs(output_dir, exist_ok=True)
+        patch_path = os.path.join(output_dir, "patch.diff")
+        with open(patch_path, "w", encoding="utf-8") as f:
+            f.write(fast_path["patch"])
+    else:
+        fast_path = None
+        stored = results["lookup"]
+        os.makedirs(output_dir, exist_ok=True)
+        patch_path = shutil.copy(
+            stored.patch_path, os.path.join(output_dir, "patch.diff")
+        )
+        click.secho(f"Logs of the original run are in {stored.log_dir}")
+    return patch_path, ccache, fast_path
+
+
+def run_create(
+    conf: config_module.BackporterConfig,
+    run: runs_module.RunDir,
+    no_cache: bool,
+    refresh: bool,
+    profile: bool,
+    report: str | None,
+    trace: str | None,
+    quiet: bool,
+    tail: int,
+    log_dir: str | None,
+) -> str:
+    """
+    Runs (or resumes) the create pipeline in run and returns the patch path.
+    A failed stage is recorded in the run and re-raised as a StageError.
+    """
+    manifest = run.read_manifest()
+    commit_id, branch_name = manifest["commit"], manifest["branch"]
+    store = results_module.ResultStore.from_config(conf)
+    stages = create_stages(conf, commit_id, branch_name, run, store, no_cache, refresh)
+    log_dir = log_dir or run.log_dir
+
+    click.secho(f"Run {run.id} in {run.path}")
+    run.update_manifest(status="running", failed_stage=None)
+    profiler = profiling.Profiler()
     try:
-        proc = subprocess.Popen(*args, **kwargs)
+        with open_run_log(log_dir, quiet, tail):
+            results = pipeline.run_stages(
+                stages,
+                profiler=profiler,
+                checkpoints=pipeline.Checkpoints(run.stages_dir),
+            )
+    except pipeline.StageError as e:
+        run.update_manifest(status="failed", failed_stage=e.stage)
+        history_module.record_run(
+            conf,
+            "create",
+            branch_name,
+            commit_id,
+            history_module.FAILED,
+            profiler.started,
+            profiler.records,
+            run_id=run.id,
+            failed_stage=e.stage,
+        )
+        click.secho(str(e), fg="red")
+        click.secho(f"Full log: {os.path.join(log_dir, 'run.log')}", fg="red")
+        click.secho(f"Continue with: backporter resume {run.id}", fg="red")
+        raise
+    except KeyboardInterrupt:
+        run.update_manifest(status="interrupted")
+        raise
+    finally:
+        finish_profile(
+            profiler,
+            profile,
+            report,
+            trace,
+            commit=commit_id,
+            branch=branch_name,
+            scheduler=scheduler_module.for_config(conf).stats(),
+        )
+
+    patch_path, ccache, fast_path = collect_patch(
+        conf, results, run.output_dir, log_dir, store, commit_id, branch_name
+    )
+    history_module.record_run(
+        conf,
+        "create",
+        branch_name,
+        commit_id,
+        history_module.outcome_of(results),
+        profiler.started,
+        profiler.records,
+        run_id=run.id,
+        ccache=ccache,
+    )
+    run.finish(
+        "done",
+        patch=patch_path,
+        ccache=ccache,
+        fast_path=fast_path["methods"] if fast_path else {},
+    )
+    return patch_path
 
-        for line in proc.stdout:
-            print(line.decode(), end="")
 
+def use_container_engine(conf: config_module.BackporterConfig):
+    """
+    Routes this process's container operations through conf's backend.
+    """
+    try:
+        containers_module.use(conf)
+    except ValueError as e:
+        click.secho(str(e), fg="red")
+        sys.exit(1)
+
+
+def print_patch(patch_path: str):
+    with open(patch_path, "r", encoding="utf-8") as f:
+        print(f.read())
+
+
+def run_multi_target(
+    conf: config_module.BackporterConfig,
+    run: runs_module.RunDir,
+    no_cache: bool,
+    refresh: bool,
+    profile: bool,
+    report: str | None,
+    trace: str | None,
+    quiet: bool,
+    tail: int,
+    log_dir: str | None,
+) -> bool:
+    """
+    Backports the run's commit to every one of its branches at once: the
+    upstream checkout, its patch and (in mount mode) the bootstrapped A tree
+    are prepared once and the branches' FixMorph runs fan out from them in
+    parallel. Returns whether every branch got a patch.
+    """
+    manifest = run.read_manifest()
+    commit_id, branches = manifest["commit"], manifest["branches"]
+    log_dir = log_dir or run.log_dir
+    click.secho(f"Run {run.id} in {run.path}")
+    pairs = [batch_module.Pair(commit_id, branch) for branch in branches]
+    profiler = profiling.Profiler()
+    try:
+        with open_run_log(log_dir, quiet, tail):
+            results = batch_module.run_batch(
+                conf, pairs, run.output_dir, len(pairs), profiler, no_cache, refresh, "create"
+            )
+    finally:
+        finish_profile(
+            profiler,
+            profile,
+            report,
+            trace,
+            commit=commit_id,
+            branches=len(branches),
+            scheduler=scheduler_module.for_config(conf).stats(),
+        )
+    click.secho(batch_module.format_summary(results))
+    click.secho(scheduler_module.for_config(conf).format_stats())
+    ok = all(result.status == "ok" for result in results)
+    run.finish(
+        "done" if ok else "failed",
+        results={r.pair.branch_name: r.to_dict() for r in results},
+    )
+    return ok
+
+
+def series_stages(
+    conf: config_module.BackporterConfig,
+    commit_spec: str,
+    branch_name: str,
+    run: runs_module.RunDir,
+) -> typing.List[pipeline.Stage]:
+    """
+    Builds the stage graph preparing the workspace every step of a series
+    run shares: one upstream clone, one prepped downstream tree and the
+    toolchain.
+    """
+    work_dir = run.work_dir
+    upstream_path = os.path.join(work_dir, "upstream")
+    distgit_path = os.path.join(work_dir, "downstream-distgit")
+    downstream_dir = os.path.join(work_dir, "downstream")
+
+    def downstream(results):
+        key = downstream_module.prepare_downstream(
+            conf,
+            branch_name,
+            distgit_path,
+            downstream_dir,
+            writable=conf.run_mode == "mount",
+        )
+        # a fresh tree holds none of the steps' patches
+        run.update_manifest(applied=0)
+        return key
+
+    return [
+        pipeline.Stage(
+            "upstream",
+            lambda results: series_module.prepare_upstream(conf, commit_spec, upstream_path),
+            inputs=(conf.upstream_url, commit_spec),
+            outputs=(upstream_path,),
+        ),
+        pipeline.Stage(
+            "downstream",
+            downstream,
+            inputs=(conf.distgit_repo, branch_name, conf.run_mode),
+            outputs=(distgit_path, downstream_dir),
+        ),
+        pipeline.Stage(
+            "toolchain",
+            lambda results: fixmorph_module.ensure_toolchain(conf),
+            inputs=(fixmorph_module.toolchain_tag(conf),),
+            check=fixmorph_module.image_exists,
+        ),
+    ]
+
+
+def run_series(
+    conf: config_module.BackporterConfig,
+    run: runs_module.RunDir,
+    no_cache: bool,
+    refresh: bool,
+    profile: bool,
+    report: str | None,
+    trace: str | None,
+    quiet: bool,
+    tail: int,
+    log_dir: str | None,
+) -> str:
+    """
+    Runs (or resumes) a series run and returns the path of its patch series.
+    The workspace is prepared once; each commit is then backported in order
+    onto the downstream tree holding the patches of the commits before it,
+    with the upstream checkout moved forward in place, so each step only
+    rewrites (and rebuilds) what its commit and the previous patch touched.
+    A failed stage is recorded in the run and re-raised as a StageError.
+    """
+    manifest = run.read_manifest()
+    commit_spec, branch_name = manifest["commit"], manifest["branch"]
+    store = results_module.ResultStore.from_config(conf)
+    log_dir = log_dir or run.log_dir
+    upstream_path = os.path.join(run.work_dir, "upstream")
+    downstream_dir = os.path.join(run.work_dir, "downstream")
+
+    click.secho(f"Run {run.id} in {run.path}")
+    run.update_manifest(status="running", failed_stage=None)
+    profiler = profiling.Profiler()
+    steps: typing.List[series_module.Step] = []
+    patches: typing.List[str] = []
+    stage = "prepare"
+    try:
+        with open_run_log(log_dir, quiet, tail):
+            prepared = pipeline.run_stages(
+                series_stages(conf, commit_spec, branch_name, run),
+                profiler=profiler,
+                checkpoints=pipeline.Checkpoints(os.path.join(run.stages_dir, "prepare")),
+            )
+            commits = prepared["upstream"]
+            run.update_manifest(commits=commits)
+            for index, commit_id in enumerate(commits):
+                step = series_module.Step(
+                    index, commit_id, series_module.downstream_key(prepared["downstream"], patches)
+                )
+                stage = step.name
+                step_patch = os.path.join(run.output_dir, step.name, "patch.diff")
+                applied = run.read_manifest().get("applied", 0)
+                click.secho(f"[{index + 1}/{len(commits)}] {commit_id}", bold=True)
+                # the step's own stages are recorded in the history
+                step_started, first_record = time.time(), len(profiler.records)
+                if index >= applied:
+                    results = pipeline.run_stages(
+                        create_stages(
+                            conf, commit_id, branch_name, run, store, no_cache, refresh, step
+                        ),
+                        profiler=profiler,
+                        checkpoints=pipeline.Checkpoints(
+                            os.path.join(run.stages_dir, step.name)
+                        ),
+                    )
+                    step_patch, ccache, _ = collect_patch(
+                        conf,
+                        results,
+                        os.path.join(run.output_dir, step.name),
+                        log_dir,
+                        store,
+                        commit_id,
+                        branch_name,
+                    )
+                    history_module.record_run(
+                        conf,
+                        "series",
+                        branch_name,
+                        commit_id,
+                        history_module.outcome_of(results),
+                        step_started,
+                        profiler.records[first_record:],
+                        run_id=f"{run.id}/{step.name}",
+                        ccache=ccache,
+                    )
+                with open(step_patch, "r", encoding="utf-8") as f:
+                    patch = f.read()
+                if index >= applied:
+                    try:
+                        series_module.apply_to_tree(downstream_dir, patch, step)
+                    except RuntimeError as e:
+                        raise pipeline.StageError("carry-over", e) from e
+                    run.update_manifest(applied=index + 1)
+                steps.append(step)
+                patches.append(patch)
+    except pipeline.StageError as e:
+        run.update_manifest(status="failed", failed_stage=f"{stage}/{e.stage}")
+        if stage != "prepare":
+            history_module.record_run(
+                conf,
+                "series",
+                branch_name,
+                commit_id,
+                history_module.FAILED,
+                step_started,
+                profiler.records[first_record:],
+                run_id=f"{run.id}/{stage}",
+                failed_stage=e.stage,
+            )
+        click.secho(str(e), fg="red")
+        click.secho(f"Full log: {os.path.join(log_dir, 'run.log')}", fg="red")
+        click.secho(f"Continue with: backporter resume {run.id}", fg="red")
+        raise
     except KeyboardInterrupt:
-        click.secho("\nCtrl+C pressed, terminating subprocess...", fg="orange")
-        proc.terminate()
-        try:
-            proc.wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            click.secho("Subprocess did not terminate in time, killing it...", fg="red")
-            proc.kill()
+        run.update_manifest(status="interrupted")
+        raise
+    finally:
+        finish_profile(
+            profiler,
+            profile,
+            report,
+            trace,
+            commit=commit_spec,
+            branch=branch_name,
+            commits=len(steps),
+            scheduler=scheduler_module.for_config(conf).stats(),
+        )
+
+    series_path = series_module.write_series(run.output_dir, upstream_path, steps, patches)
+    click.secho(f"Wrote {len(steps)} patches to {run.output_dir}", fg="green")
+    run.finish("done", patch=series_path)
+    return series_path
+
+
+def run_single_target(
+    conf: config_module.BackporterConfig, run: runs_module.RunDir, **options
+) -> str:
+    """
+    Runs a one-branch run of a single commit or a series and returns the
+    path of its patch.
+    """
+    if series_module.is_series(run.read_manifest()["commit"]):
+        return run_series(conf, run, **options)
+    return run_create(conf, run, **options)
+
+
+def execute_run(conf: config_module.BackporterConfig, run: runs_module.RunDir, **options):
+    """
+    Runs a fresh or unfinished run of any kind, raising when it fails.
+    """
+    if "branches" in run.read_manifest():
+        if not run_multi_target(conf, run, **options):
+            raise RuntimeError("some branches did not get a patch")
+    else:
+        run_single_target(conf, run, **options)
+
+
+def run_via_daemon(
+    conf: config_module.BackporterConfig,
+    commit_id: str,
+    branches: typing.Tuple[str, ...],
+    detach: bool,
+    no_cache: bool,
+    refresh: bool,
+    quiet: bool,
+    **_,
+):
+    """
+    Submits the backport to the daemon, then follows its log and prints the
+    patch unless detach is set.
+    """
+    address = daemon_module.address(conf)
+    client = daemon_module.Client(address, daemon_module.token_path(address, conf.cache_dir))
+    try:
+        job = client.submit(conf, commit_id, branches, no_cache, refresh)
+        click.secho(f"Submitted job {job['id']} to {client.address}")
+        if detach:
+            return
+        sink = None if quiet else lambda data: click.echo(data, nl=False)
+        job = client.follow(job["id"], sink)
+        patches = {branch: client.patch(job["id"], branch) for branch in job["patches"]}
+    except RuntimeError as e:
+        click.secho(str(e), fg="red")
+        sys.exit(1)
+    if job["status"] != daemon_module.DONE:
+        click.secho(f"Job {job['id']} failed: {job['error']}", fg="red")
+        click.secho(f"Run directory: {job['run']}", fg="red")
         sys.exit(1)
+    for branch, patch in patches.items():
+        if len(branches) > 1:
+            click.secho(f"==> {branch}", bold=True)
+        print(patch)
 
 
-# actual backporting commands
 @cli.command()
 @click.argument(
     "commit-id",
@@ -252,16 +1035,77 @@ def Popen_stream(*args, **kwargs):
 @click.argument(
     "branch-name",
     type=str,
+    required=False,
     # help="Git ref of the downstream branch we want to backport to (e.g. rhel-9)",
 )
+@click.option(
+    "--branch",
+    "-b",
+    "branches",
+    multiple=True,
+    help="Downstream branch to backport to; repeat it to backport to several "
+    "branches at once, sharing the upstream side between them.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue the newest unfinished run of this commit and branch, if any.",
+)
+@click.option(
+    "--daemon",
+    "use_daemon",
+    is_flag=True,
+    help="Submit the backport to `backporter serve` and follow it from there.",
+)
+@click.option(
+    "--detach",
+    is_flag=True,
+    help="With --daemon, return once the job is queued and print its id.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Only show which stages would be cache hits and the wall time the run "
+    "history expects; nothing is fetched, built or run.",
+)
+@cache_options
+@profiling_options
+@log_options
 @click.pass_context
-def create(ctx, commit_id: str, branch_name: str):
+def create(
+    ctx,
+    commit_id: str,
+    branch_name: str | None,
+    branches: typing.Tuple[str, ...],
+    resume: bool,
+    use_daemon: bool,
+    detach: bool,
+    dry_run: bool,
+    **options,
+):
     """
     The create command makes the following assumptions:
+
+    COMMIT_ID may also name a series, as BASE..TIP or SHA,SHA,...: its
+    commits are backported in order in one workspace, each onto the
+    downstream tree with the patches before it, into an ordered patch series.
     """
-    # configure variables
-    upstream_dirname = "upstream"
-    downstream_dirname = "downstream-distgit"
+    branches = tuple(dict.fromkeys(((branch_name,) if branch_name else ()) + branches))
+    if not branches:
+        raise click.UsageError("Give a downstream branch, as BRANCH_NAME or with --branch")
+    if len(branches) > 1 and series_module.is_series(commit_id):
+        raise click.UsageError("A commit series can only be backported to one branch at a time")
+    if len(branches) > 1 and resume:
+        raise click.UsageError("--resume only works for a single branch")
+    if use_daemon and resume:
+        raise click.UsageError("--resume can't be combined with --daemon")
+    if detach and not use_daemon:
+        raise click.UsageError("--detach only works with --daemon")
+    if dry_run and (use_daemon or resume):
+        raise click.UsageError("--dry-run can't be combined with --daemon or --resume")
+    if dry_run and series_module.is_series(commit_id):
+        raise click.UsageError("--dry-run only plans a single commit")
+
     configfile = ctx.obj["config"]
     if not exists(configfile):
         click.secho(
@@ -273,328 +1117,381 @@ def create(ctx, commit_id: str, branch_name: str):
     # load config
     conf = config_module.read_config(configfile)
 
-    # temp_dir = "./temp"
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # temp_dir = '/home/osilkin/Programming/fixmorph-cli/debug'
-        # get the working directory
-        pwd_proc = subprocess.run(["pwd"], capture_output=True, cwd="/home/osilkin")
-        click.secho(pwd_proc.stdout.decode("utf-8"))
-        # with open(os.path.join(temp_dir, "test-file"), "w", encoding="utf-8") as f:
-        upstream_path = os.path.join(temp_dir, upstream_dirname)
-        downstream_path = os.path.join(temp_dir, downstream_dirname)
-        # clone the two repos
-        click.secho(f"Cloning upstream repo '{conf.upstream_url}'")
-        upstream_clone_proc = subprocess.run(
-            ["git", "clone", conf.upstream_url, upstream_path],
-            capture_output=True,
-            cwd=temp_dir,
-        )
-        if upstream_clone_proc.returncode != 0:
-            print(upstream_clone_proc.stderr)
+    if use_daemon:
+        run_via_daemon(conf, commit_id, branches, detach, **options)
+        return
+    use_container_engine(conf)
 
-        # get the patch we want to backport from the upstream
-        checkout_proc = subprocess.run(
-            ["git", "-C", upstream_path, "checkout", commit_id],
-            check=True,
-        )
-        upstream_diff_proc = subprocess.run(
-            ["git", "-C", upstream_path, "diff", "HEAD~1"],
-            capture_output=True,
-            check=True,
-            cwd=temp_dir,
+    if dry_run:
+        history = history_module.History.from_config(conf)
+        for branch in branches:
+            plan = planning_module.plan_create(
+                conf, commit_id, branch, history, options["no_cache"], options["refresh"]
+            )
+            click.secho(planning_module.format_plan(plan))
+        return
+
+    if len(branches) > 1:
+        run = runs_module.start_run(conf, commit_id, branches)
+        if not run_multi_target(conf, run, **options):
+            sys.exit(1)
+        return
+
+    branch_name = branches[0]
+    run = runs_module.latest_unfinished(conf, commit_id, branch_name) if resume else None
+    if resume and not run:
+        click.secho("No unfinished run to resume, starting a new one", fg="yellow")
+    run = run or runs_module.new_run(conf, commit_id, branch_name)
+    try:
+        patch_path = run_single_target(conf, run, **options)
+    except pipeline.StageError:
+        sys.exit(1)
+    print_patch(patch_path)
+
+
+@cli.command()
+@click.argument("run-id", type=str)
+@cache_options
+@profiling_options
+@log_options
+@click.pass_context
+def resume(ctx, run_id: str, **options):
+    """
+    Continues a failed or interrupted create run from its first incomplete or
+    invalidated stage. The run id is printed when the run starts.
+    """
+    configfile = ctx.obj["config"]
+    if not exists(configfile):
+        click.secho(
+            f"Config file {configfile} does not exist. Please create one first.",
+            fg="red",
         )
+        return
+
+    conf = config_module.read_config(configfile)
+    use_container_engine(conf)
+    try:
+        run = runs_module.find_run(conf, run_id)
+    except ValueError as e:
+        click.secho(str(e), fg="red")
+        sys.exit(1)
+    if not os.path.isdir(run.work_dir):
+        click.secho(f"Run {run_id} already finished", fg="yellow")
+        return
+    if "branches" in run.read_manifest():
+        click.secho(f"Run {run_id} backported to several branches and can't be resumed", fg="red")
+        sys.exit(1)
+    try:
+        patch_path = run_single_target(conf, run, **options)
+    except pipeline.StageError:
+        sys.exit(1)
+    print_patch(patch_path)
 
-        if upstream_diff_proc.returncode != 0:
-            raise Exception("Error getting the diff from the upstream repo")
-        upstream_patch = upstream_diff_proc.stdout.decode("utf-8")
-        if not upstream_patch:
-            raise Exception("No patch found in the upstream repo")
-        upstream_patch_location = os.path.join(temp_dir, "upstream.patch")
-        with open(upstream_patch_location, "w", encoding="utf-8") as f:
-            f.write(upstream_patch)
-
-        # reset upstream repo to 1 commit before
-        subprocess.run(
-            ["git", "-C", upstream_path, "reset", "--hard", "HEAD~1"],
-            check=True,
-            capture_output=True,
-            cwd=temp_dir,
+
+@cli.command()
+@click.argument("manifest", type=click.File("r"), default="-")
+@click.option(
+    "--output-dir",
+    type=click.Path(),
+    default="backport-results",
+    show_default=True,
+    help="Directory that receives one result directory per commit/branch pair.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=2,
+    show_default=True,
+    help="Maximum number of preparation steps or FixMorph runs at once; "
+    "containers also wait for their share of max_cpus and max_memory.",
+)
+@cache_options
+@profiling_options
+@log_options
+@click.pass_context
+def batch(
+    ctx,
+    manifest,
+    output_dir: str,
+    jobs: int,
+    no_cache: bool,
+    refresh: bool,
+    profile: bool,
+    report: str | None,
+    trace: str | None,
+    quiet: bool,
+    tail: int,
+    log_dir: str | None,
+):
+    """
+    Backports every commit/branch pair listed in MANIFEST (YAML or JSON, or
+    '-' for stdin), sharing upstream fetches, downstream preps and the
+    toolchain image between pairs.
+    """
+    configfile = ctx.obj["config"]
+    if not exists(configfile):
+        click.secho(
+            f"Config file {configfile} does not exist. Please create one first.",
+            fg="red",
         )
+        return
+
+    conf = config_module.read_config(configfile)
+    use_container_engine(conf)
+    pairs = batch_module.read_manifest(manifest)
+    if not pairs:
+        click.secho("Manifest does not list any commit/branch pairs", fg="yellow")
+        return
 
-        # # write the patch out
-        # upstream_patch_file = "upstream-patch.patch"
-        # with open(os.path.join(temp_dir, upstream_patch_file), "w", encoding="utf-8") as f:
-        #     f.write(upstream_patch)
-
-        click.secho(f"Cloning dist-git repo '{conf.distgit_repo}'")
-        downstream_clone_proc = subprocess.run(
-            [
-                "rhpkg",
-                "clone",
-                "--anonymous",
-                conf.distgit_repo,
-                downstream_path,
-            ],
-            capture_output=True,
-            cwd=temp_dir,
+    profiler = profiling.Profiler()
+    with open_run_log(log_dir or os.path.join(output_dir, "logs"), quiet, tail):
+        results = batch_module.run_batch(
+            conf, pairs, output_dir, jobs, profiler, no_cache, refresh
         )
-        # ensure the clone was successful
-        if downstream_clone_proc.returncode != 0:
-            click.secho(
-                f"Error cloning dist-git repo '{conf.distgit_repo}': {downstream_clone_proc.stderr}",
-                fg="red",
-            )
-            raise RuntimeError(
-                f"Error cloning dist-git repo '{conf.distgit_repo}': {downstream_clone_proc.stderr}"
-            )
+    scheduler = scheduler_module.for_config(conf)
+    click.secho(batch_module.format_summary(results))
+    click.secho(scheduler.format_stats())
+    finish_profile(
+        profiler,
+        profile,
+        report or os.path.join(output_dir, "report.jsonl"),
+        trace,
+        pairs=len(pairs),
+        scheduler=scheduler.stats(),
+    )
+    if any(result.status != "ok" for result in results):
+        sys.exit(1)
+
 
-        # switch to desired branch-name
-        switch_proc = subprocess.run(
-            ["git", "-C", downstream_path, "switch", branch_name],
-            check=True,
-            capture_output=True,
-            cwd=temp_dir,
+@cli.command()
+@click.option(
+    "--branch",
+    "-b",
+    "branches",
+    multiple=True,
+    help="Dist-git branch to prepare; repeat it for several [default: warm_branches].",
+)
+@log_options
+@click.pass_context
+def warm(
+    ctx, branches: typing.Tuple[str, ...], quiet: bool, tail: int, log_dir: str | None
+):
+    """
+    Fetches upstream and preps the dist-git branches, the toolchain image and
+    the bootstrap, configure and compile caches ahead of time, so a later
+    create only does the work specific to its commit. Meant to run from cron
+    or a systemd timer; it's cheap when nothing changed.
+    """
+    configfile = ctx.obj["config"]
+    if not exists(configfile):
+        click.secho(
+            f"Config file {configfile} does not exist. Please create one first.",
+            fg="red",
         )
-        if switch_proc.returncode != 0:
-            # error
-            click.secho(
-                f"failed to switch to branch '{branch_name}': {switch_proc.stderr}",
-                color="red",
-            )
-            raise ValueError(f"could not switch to branch {branch_name}")
+        return
 
-        sources_proc = subprocess.run(
-            ["rhpkg", "sources"], cwd=downstream_path, check=True, capture_output=True
+    conf = config_module.read_config(configfile)
+    use_container_engine(conf)
+    branches = tuple(dict.fromkeys(branches or conf.warm_branches))
+    if not branches:
+        click.secho(
+            "No branches given and warm_branches is empty, only warming upstream and the toolchain",
+            fg="yellow",
         )
-        if sources_proc.returncode != 0:
-            click.secho(
-                f"failed extracting sources from '{downstream_path}': {sources_proc.stderr}",
-                color="red",
-            )
-            raise RuntimeError(f"could not extract sources from {conf.distgit_repo}")
+    log_dir = log_dir or conf.cache_path("logs", "warm")
+    os.makedirs(conf.cache_path(), exist_ok=True)
+    # next to the caches, so trees can be linked from them
+    with tempfile.TemporaryDirectory(prefix="warm-", dir=conf.cache_path()) as work_dir:
+        try:
+            with open_run_log(log_dir, quiet, tail):
+                results = pipeline.run_stages(
+                    warm_module.warm_stages(conf, branches, work_dir),
+                    max_workers=len(branches) + 2,
+                )
+        except pipeline.StageError as e:
+            click.secho(str(e), fg="red")
+            click.secho(f"Full log: {os.path.join(log_dir, 'run.log')}", fg="red")
+            sys.exit(1)
+    click.secho(warm_module.format_warmed(branches, results))
+    click.secho("Caches are warm", fg="green")
 
-        # find the sources tarball
-        source_tarball = None
-        for filename in os.listdir(downstream_path):
-            if filename.endswith(".tar.gz"):
-                source_tarball = filename
-                break
 
-        if not source_tarball:
-            click.secho(
-                f"could not find source tarball in '{downstream_path}'", color="red"
-            )
-            raise RuntimeError(
-                f"failed to locate source tarball in '{downstream_path}'"
-            )
+@cli.command()
+@click.option("--branch", "-b", type=str, help="Only runs onto this downstream branch.")
+@click.option("--commit", type=str, help="Only runs of this upstream commit, as it was given.")
+@click.option(
+    "--days", type=click.IntRange(min=1), help="Only runs started in the last this many days."
+)
+@click.option(
+    "--recent",
+    type=click.IntRange(min=0),
+    default=10,
+    show_default=True,
+    help="Also list this many of the newest runs.",
+)
+@click.pass_context
+def stats(ctx, branch: str | None, commit: str | None, days: int | None, recent: int):
+    """
+    Summarizes the run history: outcomes, wall times, resource peaks and
+    ccache hit rates per package, branch and run mode, and where the time
+    went by stage.
+    """
+    configfile = ctx.obj["config"]
+    if not exists(configfile):
+        click.secho(
+            f"Config file {configfile} does not exist. Please create one first.",
+            fg="red",
+        )
+        return
 
-        # extract tarball
-        tarball_path = os.path.join(downstream_path, source_tarball)
-        extract_tarball_proc = subprocess.run(
-            ["tar", "-xf", tarball_path],
-            check=True,
-            capture_output=True,
-            cwd=downstream_path,
+    conf = config_module.read_config(configfile)
+    history = history_module.History.from_config(conf)
+    since = time.time() - days * 86400 if days else None
+    runs, stages = history.stats(branch, commit, since)
+    click.secho(history_module.format_stats(runs, stages))
+    if runs and recent:
+        click.secho("")
+        click.secho(
+            history_module.format_recent(history.recent(recent, branch, commit, since))
         )
 
 
-        # prepare the downstream source
-        click.secho("prepping the downstream source", fg="green")
-        prep_proc = subprocess.run(
-            ["rhpkg", "prep"], cwd=downstream_path, capture_output=True
+@cli.command()
+@click.option(
+    "--address",
+    type=str,
+    help="Unix socket path or http://127.0.0.1:PORT to listen on "
+    "[default: daemon_address, or daemon.sock in the cache dir].",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Backport jobs to run at once [default: daemon_workers].",
+)
+@click.pass_context
+def serve(ctx, address: str | None, workers: int | None):
+    """
+    Runs a long-lived daemon that accepts backport jobs from `create --daemon`
+    and `jobs`, and runs them on a worker pool with warm caches.
+    """
+    configfile = ctx.obj["config"]
+    if not exists(configfile):
+        click.secho(
+            f"Config file {configfile} does not exist. Please create one first.",
+            fg="red",
         )
-        if prep_proc.returncode != 0:
-            click.secho(f"Error preparing the downstream source", fg="red")
-            if prep_proc.stderr:
-                click.secho(
-                    f"Error preparing the downstream source: {prep_proc.stderr}",
-                    fg="red",
-                )
-            if prep_proc.stdout:
-                click.secho(
-                    f"Error preparing the downstream source: {prep_proc.stdout}",
-                    fg="red",
-                )
-    
-        if extract_tarball_proc.returncode != 0:
-            click.secho(f"could not extract tarball {tarball_path}", color="red")
-            raise RuntimeError(
-                f"failed to extract tarball {tarball_path}: {extract_tarball_proc.stderr}"
-            )
+        return
 
-        downstream_source_dir = tarball_path.strip(".tar.gz")
-
-        # create a symlink to the downstream source directory
-        # ln_proc = subprocess.run(
-        #     ["ln", "-s", downstream_source_dir, "downstream"],
-        #     cwd=temp_dir,
-        #     capture_output=True,
-        # )
-        # if ln_proc.returncode != 0:
-        #     click.secho(f"Error creating symlink to downstream source", fg="red")
-        #     click.secho(ln_proc.stderr.decode("utf-8"), fg="red")
-        #     return
-        new_downstream_src_dir = shutil.move(
-            downstream_source_dir, os.path.join(temp_dir, "downstream")
-        )
+    conf = config_module.read_config(configfile)
+    use_container_engine(conf)
+    address = address or daemon_module.address(conf)
+    daemon = daemon_module.Daemon(conf, execute_run, workers or conf.daemon_workers)
+    try:
+        token_file = daemon_module.token_path(address, conf.cache_dir)
+        server = daemon_module.make_server(address, daemon, daemon_module.write_token(token_file))
+    except (OSError, ValueError) as e:
+        click.secho(f"Cannot listen on {address}: {e}", fg="red")
+        sys.exit(1)
+    daemon.start()
+    click.secho(f"Listening on {address} with {daemon.workers} workers", fg="green")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        click.secho("\nStopping; unfinished runs can be continued with backporter resume")
+    finally:
+        server.server_close()
 
-        """
-        Here's what needs to happen to get the actual downstream source:
-        - clone the distgit repo
-        - check out one of the rhel branches
-        - rhpkg sources to actaully get the archive
-        - extract the archive
-        - deduce which folder actually contains the source code based on the archive
-        """
-
-        # place the dockerfile in the repo
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-        dockerfile_path = os.path.join(current_dir, "dockerfiles", "Dockerfile.frr")
-        shutil.copy(dockerfile_path, os.path.join(temp_dir, "Dockerfile"))
-
-        dockerfile_contents = read_dockerfile()
-        click.secho(dockerfile_contents, fg="green")
-
-        # place the run-demo.sh script in the repo
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-        script_path = os.path.join(current_dir, "scripts", "run-demo.sh")
-        shutil.copy(script_path, os.path.join(temp_dir, "run-demo.sh"))
-
-        # list out local directory
-        ls_proc = subprocess.run(["ls", "-la"], cwd=temp_dir, capture_output=True)
-        print(ls_proc.stdout.decode("utf-8"))
-
-        click.secho("contents of the downstream directory:", fg="green")
-        for item in os.listdir(downstream_path):
-            print(item)
-
-        command = [
-            "docker",
-            "build",
-            temp_dir,
-            "--platform",
-            "linux/amd64",
-            "-t",
-            f"fixmorph-frr:{commit_id}",
-            "--build-arg",
-            f"PKG_NAME=frr",
-            "--build-arg",
-            f"--CONFIG_COMMAND_A={FRR_CONFIGURE}",
-            "--build-arg",
-            f"--CONFIG_COMMAND_B={FRR_CONFIGURE}",
-            "--build-arg",
-            f"--CONFIG_COMMAND_C={FRR_CONFIGURE}",
-            "--build-arg",
-            f"BUILD_COMMAND_A={FRR_BUILD}",
-            "--build-arg",
-            f"BUILD_COMMAND_B={FRR_BUILD}",
-            "--build-arg",
-            f"BUILD_COMMAND_C={FRR_BUILD}",
-            "--build-arg",
-            "GIT_EMAIL=user@example.com",
-            "--build-arg",
-            f"GIT_NAME=user",
-        ]
-        print(f"command being ran: '{command}'")
-        print(f"temp_dir: {temp_dir}")
 
-        # build & run the image
-        try:
-            # list out contents at repo
-            proc = subprocess.Popen(
-                command,
-                cwd=temp_dir,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                bufsize=1,
-                universal_newlines=True,
-            )
+@cli.group()
+@click.option(
+    "--address",
+    type=str,
+    help="Address of the daemon [default: daemon_address, or daemon.sock in the cache dir].",
+)
+@click.pass_context
+def jobs(ctx, address: str | None):
+    """
+    Inspects the jobs of a running `backporter serve`.
+    """
+    configfile = ctx.obj["config"]
+    if not address and not exists(configfile):
+        raise click.UsageError(f"Config file {configfile} does not exist; pass --address")
+    conf = config_module.read_config(configfile) if exists(configfile) else None
+    address = address or daemon_module.address(conf)
+    cache_dir = conf.cache_dir if conf else config_module.DEFAULT_CACHE_DIR
+    ctx.obj["client"] = daemon_module.Client(
+        address, daemon_module.token_path(address, cache_dir)
+    )
 
-            while True:
-                output = proc.stdout.readline()
-                if output == "" and proc.poll() is not None:
-                    break
-                if output:
-                    print(output.strip())
-
-            rc = proc.poll()
-
-            if rc != 0:
-                if proc.stderr:
-                    print(f"Error building the Docker image:\n{proc.stderr.read()}")
-                if proc.stdout:
-                    print(f"Error building the Docker image:\n{proc.stdout.read()}")
-                return
-            else:
-                print("Docker image built successfully 🥳")
-        except KeyboardInterrupt:
-            print("\nCtrl+C pressed, terminating subprocess...")
-            proc.terminate()
-            try:
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                print("Subprocess did not terminate in time, killing it.")
-                proc.kill()
-            sys.exit(1)
 
-        # if res.returncode != 0:
-        #     click.secho(f"Error building the docker image:", fg="red")
-        #     click.secho(res.stderr.decode("utf-8"), fg="red")
-        #     return
+@jobs.command("list")
+@click.pass_context
+def list_jobs(ctx):
+    """
+    Lists the daemon's jobs, oldest first.
+    """
+    try:
+        entries = ctx.obj["client"].jobs()
+    except RuntimeError as e:
+        click.secho(str(e), fg="red")
+        sys.exit(1)
+    for job in entries:
+        click.secho(f"{job['id']}  {job['status']:<8}  {','.join(job['branches'])}")
 
-        # run the image
-        try:
-            # list out contents at repo
-            proc = subprocess.Popen(
-                ["docker", "run", f"fixmorph-frr:{commit_id}"],
-                cwd=temp_dir,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                bufsize=1,
-                universal_newlines=True,
-            )
 
+@jobs.command("show")
+@click.argument("job-id", type=str)
+@click.pass_context
+def show_job(ctx, job_id: str):
+    """
+    Prints a job's status, run directory and patches.
+    """
+    try:
+        job = ctx.obj["client"].job(job_id)
+    except RuntimeError as e:
+        click.secho(str(e), fg="red")
+        sys.exit(1)
+    click.secho(yaml.dump(job, sort_keys=False))
+
+
+@jobs.command("log")
+@click.argument("job-id", type=str)
+@click.option("--follow", "-f", is_flag=True, help="Keep printing until the job finishes.")
+@click.pass_context
+def job_log(ctx, job_id: str, follow: bool):
+    """
+    Prints a job's run.log.
+    """
+    client = ctx.obj["client"]
+    try:
+        if follow:
+            client.follow(job_id, lambda data: click.echo(data, nl=False))
+        else:
+            offset = 0
             while True:
-                output = proc.stdout.readline()
-                if output == "" and proc.poll() is not None:
+                data, offset, _ = client.log(job_id, offset)
+                if not data:
                     break
-                if output:
-                    print(output.strip())
-
-            rc = proc.poll()
-
-            if rc != 0:
-                if proc.stderr:
-                    print(f"Error building the Docker image:\n{proc.stderr.read()}")
-                if proc.stdout:
-                    print(f"Error building the docker image:\n{proc.stdout.read()}")
-                return
-            else:
-                print("Docker image built successfully 🥳")
-        except KeyboardInterrupt:
-            print("\nCtrl+C pressed, terminating subprocess...")
-            proc.terminate()
-            try:
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                print("Subprocess did not terminate in time, killing it.")
-                proc.kill()
-            sys.exit(1)
+                click.echo(data, nl=False)
+    except RuntimeError as e:
+        click.secho(str(e), fg="red")
+        sys.exit(1)
 
-        # extract the file from the finished container. It will be located in /fixmorph/output/generated-patch
-        subprocess.run(
-            [
-                "docker",
-                "cp",
-                f"fixmorph-frr:{commit_id}:/fixmorph/output/generated-patch",
-                os.path.join(temp_dir, "generated-patch"),
-            ],
-            capture_output=True,
-            check=True,
-        )
-        # print out the generated patch
-        with open(os.path.join(temp_dir, "generated-patch", "patch.diff"), "r") as f:
-            print(f.read())
+
+@jobs.command("patch")
+@click.argument("job-id", type=str)
+@click.option("--branch", "-b", type=str, help="Branch of a job that targeted several.")
+@click.pass_context
+def job_patch(ctx, job_id: str, branch: str | None):
+    """
+    Prints the patch a finished job generated.
+    """
+    try:
+        print(ctx.obj["client"].patch(job_id, branch))
+    except RuntimeError as e:
+        click.secho(str(e), fg="red")
+        sys.exit(1)
 
 
 @config.command()
@@ -617,7 +1514,11 @@ def set(ctx, field: str, value: str):
         click.secho(f"Invalid field name: {field}", fg="red")
         return
 
-    # set the new value
+    # set the new value, keeping numeric fields numeric and lists comma-separated
+    if isinstance(getattr(conf, field), int):
+        value = int(value)
+    elif isinstance(getattr(conf, field), list):
+        value = [item.strip() for item in value.split(",") if item.strip()]
     setattr(conf, field, value)
 
     # save the updated config
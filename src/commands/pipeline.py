@@ -0,0 +1,362 @@
+import contextlib
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import typing
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+import click
+import yaml
+from . import logs
+from . import profiling
+
+
+DEFAULT_MAX_WORKERS = 2
+
+_local = threading.local()
+
+
+class Cancelled(RuntimeError):
+    """
+    Raised inside a stage when the pipeline it belongs to was cancelled.
+    """
+
+    # tells logs.stage not to report this as the stage's own failure
+    cancelled = True
+
+
+class StageError(RuntimeError):
+    """
+    Raised by run_stages when a stage fails; the original error is the cause.
+    """
+
+    def __init__(self, stage: str, error: BaseException):
+        super().__init__(f"stage '{stage}' failed: {error}")
+        self.stage = stage
+        self.error = error
+
+
+class Finish:
+    """
+    Returned by a stage to end the pipeline early: stages that haven't started
+    are skipped, running ones are cancelled, and value becomes the stage's
+    result.
+    """
+
+    def __init__(self, value: typing.Any = None):
+        self.value = value
+
+
+class CancelScope:
+    """
+    Tracks the child processes started by the stages of one pipeline so they
+    can be terminated together when a sibling stage fails or on Ctrl+C.
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self._procs: typing.Set[subprocess.Popen] = set()
+        self._lock = threading.Lock()
+
+    def add(self, proc: subprocess.Popen):
+        with self._lock:
+            self._procs.add(proc)
+        if self.cancelled.is_set():
+            proc.terminate()
+
+    def discard(self, proc: subprocess.Popen):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._lock:
+            procs = list(self._procs)
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def current_scope() -> typing.Optional[CancelScope]:
+    return getattr(_local, "scope", None)
+
+
+def track(proc: subprocess.Popen):
+    """
+    Registers a process started by a stage with the pipeline's cancel scope.
+    """
+    scope = current_scope()
+    if scope:
+        scope.add(proc)
+
+
+def untrack(proc: subprocess.Popen):
+    scope = current_scope()
+    if scope:
+        scope.discard(proc)
+
+
+def check_cancelled():
+    scope = current_scope()
+    if scope and scope.cancelled.is_set():
+        raise Cancelled("pipeline was cancelled")
+
+
+def reap(proc: subprocess.Popen) -> int:
+    """
+    Reaps proc with wait4(2) so its CPU time and peak RSS are attributed to
+    the stage running on this thread, and returns its exit code.
+    """
+    if proc.returncode is None:
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+        except ChildProcessError:
+            # already reaped by a concurrent poll(), e.g. from CancelScope.cancel
+            return proc.wait()
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        profiling.record_child_usage(usage)
+    return proc.returncode
+
+
+def _drain(proc: subprocess.Popen) -> typing.Tuple[typing.Any, typing.Any]:
+    output = {}
+
+    def read(name: str, stream):
+        output[name] = stream.read()
+        stream.close()
+
+    readers = [
+        threading.Thread(target=read, args=(name, stream))
+        for name, stream in (("stdout", proc.stdout), ("stderr", proc.stderr))
+        if stream is not None
+    ]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    return output.get("stdout"), output.get("stderr")
+
+
+def run_command(
+    args: typing.List[str],
+    check: bool = False,
+    capture_output: bool = False,
+    **kwargs,
+) -> subprocess.CompletedProcess:
+    """
+    Drop-in for subprocess.run that the surrounding pipeline can cancel.
+    """
+    check_cancelled()
+    if capture_output:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    with subprocess.Popen(args, **kwargs) as proc:
+        track(proc)
+        try:
+            stdout, stderr = _drain(proc)
+            reap(proc)
+        finally:
+            untrack(proc)
+    check_cancelled()
+    completed = subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+    if check:
+        completed.check_returncode()
+    return completed
+
+
+@dataclass
+class Stage:
+    """
+    A unit of pipeline work. run receives the results of the finished stages,
+    keyed by name, and may start once every stage in deps has finished.
+
+    For checkpointing, inputs lists whatever besides its deps determines the
+    stage's result, outputs the paths it creates (removed before it reruns),
+    and check, if given, tells whether a checkpointed result is still usable.
+    """
+
+    name: str
+    run: typing.Callable[[typing.Dict[str, typing.Any]], typing.Any]
+    deps: typing.Tuple[str, ...] = ()
+    inputs: typing.Tuple[typing.Any, ...] = ()
+    outputs: typing.Tuple[str, ...] = ()
+    check: typing.Optional[typing.Callable[[typing.Any], bool]] = None
+
+
+class Checkpoints:
+    """
+    Completion markers for the stages of a pipeline, one YAML file per stage
+    in directory. A marker records the stage's input digest and its result,
+    and gets a fresh id each time the stage runs, which feeds into the digest
+    of every stage depending on it, so rerunning a stage invalidates
+    everything downstream of it.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, re.sub(r"[^A-Za-z0-9._-]+", "_", name) + ".yaml")
+
+    @staticmethod
+    def digest(stage: Stage, dep_ids: typing.List[str]) -> str:
+        digest = hashlib.sha256(stage.name.encode("utf-8"))
+        for part in [repr(i) for i in stage.inputs] + dep_ids:
+            digest.update(b"\0" + part.encode("utf-8"))
+        return digest.hexdigest()
+
+    def load(self, stage: Stage, digest: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """
+        Returns the stage's marker if it is complete and still valid.
+        """
+        try:
+            with open(self._path(stage.name), "r", encoding="utf-8") as f:
+                marker = yaml.safe_load(f)
+        except OSError:
+            return None
+        if not marker or marker.get("digest") != digest:
+            return None
+        if not all(os.path.exists(path) for path in stage.outputs):
+            return None
+        if stage.check and not stage.check(marker["result"]):
+            return None
+        return marker
+
+    def clear(self, stage: Stage):
+        """
+        Forgets the stage's marker and removes its outputs before it reruns.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(stage.name))
+        for path in stage.outputs:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+    def save(self, stage: Stage, digest: str, result: typing.Any) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        marker = {
+            "id": uuid.uuid4().hex,
+            "digest": digest,
+            "result": result,
+            "completed": time.time(),
+        }
+        path = self._path(stage.name)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            yaml.safe_dump(marker, f)
+        os.replace(path + ".tmp", path)
+        return marker["id"]
+
+
+def _run_in_scope(
+    scope: CancelScope,
+    stage: Stage,
+    results: typing.Dict[str, typing.Any],
+    profiler: typing.Optional[profiling.Profiler],
+):
+    _local.scope = scope
+    try:
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(logs.stage(stage.name))
+            if profiler is not None:
+                stack.enter_context(profiler.measure(stage.name))
+            return stage.run(results)
+    finally:
+        _local.scope = None
+
+
+def run_stages(
+    stages: typing.List[Stage],
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    profiler: typing.Optional[profiling.Profiler] = None,
+    checkpoints: typing.Optional[Checkpoints] = None,
+) -> typing.Dict[str, typing.Any]:
+    """
+    Runs stages on a thread pool, starting each as soon as its dependencies are
+    done so that independent chains overlap. The first failure cancels the
+    stages that haven't started, terminates the child processes of the ones
+    that have, and is re-raised as a StageError; a stage returning Finish ends
+    the pipeline the same way, but successfully. When a profiler is given,
+    every stage is measured with it. When checkpoints are given, stages whose
+    marker is still valid are skipped and the others are recorded as they
+    finish, so a failed pipeline can be resumed.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"stage '{stage.name}' depends on unknown stage '{dep}'")
+
+    scope = CancelScope()
+    results: typing.Dict[str, typing.Any] = {}
+    ids: typing.Dict[str, str] = {}
+    digests: typing.Dict[str, str] = {}
+    pending = list(stages)
+    running: typing.Dict[Future, Stage] = {}
+    pool = ThreadPoolExecutor(
+        max_workers=max_workers, initializer=logs.attach, initargs=(logs.active(),)
+    )
+    try:
+        while pending or running:
+            ready = [s for s in pending if all(d in results for d in s.deps)]
+            for stage in ready:
+                pending.remove(stage)
+                if checkpoints:
+                    digests[stage.name] = checkpoints.digest(
+                        stage, [ids[d] for d in stage.deps]
+                    )
+                    marker = checkpoints.load(stage, digests[stage.name])
+                    if marker:
+                        click.secho(f"Reusing checkpoint of stage '{stage.name}'", fg="green")
+                        results[stage.name] = marker["result"]
+                        ids[stage.name] = marker["id"]
+                        continue
+                    checkpoints.clear(stage)
+                future = pool.submit(_run_in_scope, scope, stage, dict(results), profiler)
+                running[future] = stage
+            if any(s.name in results for s in ready):
+                # reused checkpoints may have made further stages ready
+                continue
+
+            if not running:
+                raise ValueError(
+                    f"stages {[s.name for s in pending]} have circular dependencies"
+                )
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    scope.cancel()
+                    wait(running)
+                    raise StageError(stage.name, error) from error
+                result = future.result()
+                if isinstance(result, Finish):
+                    results[stage.name] = result.value
+                    scope.cancel()
+                    wait(running)
+                    return results
+                results[stage.name] = result
+                ids[stage.name] = (
+                    checkpoints.save(stage, digests[stage.name], result)
+                    if checkpoints
+                    else uuid.uuid4().hex
+                )
+    except KeyboardInterrupt:
+        click.secho("\nCtrl+C pressed, cancelling running stages...", fg="red")
+        scope.cancel()
+        raise
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return results
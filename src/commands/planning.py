@@ -0,0 +1,172 @@
+import os
+import subprocess
+import tempfile
+import typing
+from dataclasses import dataclass
+from . import config as config_module
+from . import downstream as downstream_module
+from . import fixmorph as fixmorph_module
+from . import history as history_module
+from . import results as results_module
+from . import upstream as upstream_module
+
+
+@dataclass
+class StagePlan:
+    """
+    What a stage of a create run would do: hit is True when a cache answers
+    it, False when it does the work and None when that can't be told yet.
+    """
+
+    name: str
+    hit: typing.Optional[bool]
+    note: str
+    seconds: typing.Optional[float] = None
+
+
+@dataclass
+class Plan:
+    commit: str
+    branch: str
+    run_mode: str
+    outcome: str
+    outcome_basis: str
+    stages: typing.List[StagePlan]
+    estimate: typing.Optional[history_module.Estimate]
+
+
+def _plan_upstream(
+    conf: config_module.BackporterConfig, commit_id: str
+) -> typing.Tuple[StagePlan, typing.Optional[str]]:
+    if conf.upstream_fetch != "mirror":
+        return StagePlan("upstream", False, f"{conf.upstream_fetch} clone from upstream"), None
+    mirrors = upstream_module.MirrorStore.from_config(conf)
+    if not mirrors.has_commit(conf.upstream_url, commit_id):
+        return StagePlan("upstream", False, "fetch the mirror"), None
+    sha = upstream_module.resolve_commit(mirrors.path_for(conf.upstream_url), commit_id)
+    return StagePlan("upstream", True, "the mirror has the commit"), sha
+
+
+def _plan_downstream(
+    conf: config_module.BackporterConfig, branch_name: str
+) -> typing.Tuple[StagePlan, typing.Optional[str]]:
+    # the cache key needs the branch's HEAD and sources file; the clone is
+    # small next to `rhpkg sources` and is thrown away
+    with tempfile.TemporaryDirectory() as tmp:
+        distgit_path = os.path.join(tmp, "distgit")
+        try:
+            downstream_module.clone_distgit(conf, branch_name, distgit_path)
+            key = downstream_module.DistGitCache.key(conf.distgit_repo, distgit_path)
+        except (RuntimeError, ValueError, subprocess.CalledProcessError) as e:
+            return StagePlan("downstream", None, f"can't tell: {e}"), None
+    store = downstream_module.DistGitCache.from_config(conf)
+    if os.path.isdir(os.path.join(store.entry_path(key), "tree")):
+        return StagePlan("downstream", True, f"cached tree {key[:12]}"), key
+    return StagePlan("downstream", False, "rhpkg sources + prep"), key
+
+
+def plan_create(
+    conf: config_module.BackporterConfig,
+    commit_id: str,
+    branch_name: str,
+    history: history_module.History,
+    no_cache: bool = False,
+    refresh: bool = False,
+) -> Plan:
+    """
+    Works out which stages of `create commit_id branch_name` would be cache
+    hits, using only lookups (a dist-git clone at most), and estimates the
+    run's wall time from the history. Nothing is fetched, built or stored.
+    """
+    upstream, sha = _plan_upstream(conf, commit_id)
+    downstream, downstream_key = _plan_downstream(conf, branch_name)
+    tag = fixmorph_module.toolchain_tag(conf)
+    has_toolchain = fixmorph_module.image_exists(tag)
+    stages = [
+        upstream,
+        downstream,
+        StagePlan("toolchain", has_toolchain, tag if has_toolchain else f"build {tag}"),
+    ]
+
+    if no_cache or refresh:
+        lookup = StagePlan("lookup", False, "stored results are skipped")
+    elif sha and downstream_key and has_toolchain:
+        store = results_module.ResultStore.from_config(conf)
+        key = store.key(
+            sha,
+            downstream_key,
+            fixmorph_module.image_id(tag),
+            fixmorph_module.run_inputs_digest(conf.run_mode),
+        )
+        if store.get(key, touch=False):
+            lookup = StagePlan("lookup", True, f"stored FixMorph result {key[:12]}")
+        else:
+            lookup = StagePlan("lookup", False, "no stored FixMorph result")
+    else:
+        lookup = StagePlan("lookup", None, "can't tell before the trees are prepared")
+    stages.append(lookup)
+
+    package = history_module.package(conf)
+    if lookup.hit:
+        outcome, basis = history_module.STORED, "a stored result exists"
+    else:
+        outcome = history.last_outcome(package, branch_name, commit_id, conf.run_mode)
+        basis = "as in the last run of this backport"
+        if not outcome or outcome == history_module.STORED:
+            outcome, basis = history_module.FIXMORPH, "assumed without a stored result"
+
+    if outcome == history_module.FAST_PATH:
+        stages.append(StagePlan("apply", False, "carries the whole patch over"))
+    elif outcome == history_module.FIXMORPH:
+        stages.append(StagePlan("apply", False, "carries over what applies"))
+        if conf.run_mode == "mount":
+            stages += [
+                StagePlan("bootstrap-upstream", None, "stored output if the autotools inputs match"),
+                StagePlan("bootstrap-downstream", None, "stored output if the autotools inputs match"),
+                StagePlan("patched", False, "link B from A"),
+                StagePlan("slice", None, "stored compile database if A's build files match"),
+            ]
+        else:
+            stages += [
+                StagePlan("context", False, "assemble the build context"),
+                StagePlan("build", False, "build the per-run image"),
+            ]
+        stages.append(StagePlan("fixmorph", False, "run FixMorph"))
+
+    estimate = history.estimate(package, branch_name, commit_id, conf.run_mode, outcome)
+    if estimate:
+        for stage in stages:
+            stage.seconds = estimate.stages.get(stage.name)
+    return Plan(commit_id, branch_name, conf.run_mode, outcome, basis, stages, estimate)
+
+
+def format_plan(plan: Plan) -> str:
+    """
+    Renders a plan as a plain-text table with the expected outcome and wall
+    time below it.
+    """
+    rows = [("STAGE", "CACHE", "EST (s)", "NOTE")]
+    for stage in plan.stages:
+        rows.append(
+            (
+                stage.name,
+                {True: "hit", False: "miss", None: "?"}[stage.hit],
+                "-" if stage.seconds is None else f"{stage.seconds:.1f}",
+                stage.note,
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]) - 1)]
+    lines = [f"Plan for {plan.commit} onto {plan.branch} ({plan.run_mode} mode)"]
+    lines += [
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)) + "  " + row[-1]
+        for row in rows
+    ]
+    lines.append(f"Expected outcome: {plan.outcome} ({plan.outcome_basis})")
+    if plan.estimate:
+        lines.append(
+            f"Expected wall time: {plan.estimate.seconds:.0f}s, the median of "
+            f"{plan.estimate.samples} {plan.outcome} runs {plan.estimate.basis}"
+        )
+    else:
+        lines.append("Expected wall time: unknown, no past runs like this one")
+    return "\n".join(lines)
@@ -0,0 +1,187 @@
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+import typing
+from dataclasses import asdict, dataclass, field
+
+
+_local = threading.local()
+
+
+@dataclass
+class StageRecord:
+    """
+    Resource usage of one pipeline stage. CPU time and peak RSS cover the child
+    processes the stage ran (the docker CLI, not the container it drives).
+    bytes_written is the delta of this process's disk write counter, so it
+    includes what overlapping stages wrote meanwhile. bytes_downloaded is the
+    delta of the network namespace's receive counters, which also count other
+    processes and runs on the host, so it's approximate at best; it's left
+    out (None) when another measured stage overlapped this one.
+    """
+
+    name: str
+    start: float
+    wall_seconds: float = 0.0
+    child_user_seconds: float = 0.0
+    child_system_seconds: float = 0.0
+    child_max_rss_kb: int = 0
+    bytes_downloaded: typing.Optional[int] = 0
+    bytes_written: int = 0
+    thread: int = 0
+    # whether another measured stage ran at the same time
+    overlapped: bool = False
+    ok: bool = True
+    error: typing.Optional[str] = None
+    extra: typing.Dict[str, typing.Any] = field(default_factory=dict)
+
+    def add_child_usage(self, usage: resource.struct_rusage):
+        self.child_user_seconds += usage.ru_utime
+        self.child_system_seconds += usage.ru_stime
+        self.child_max_rss_kb = max(self.child_max_rss_kb, usage.ru_maxrss)
+
+
+def _proc_io_write_bytes() -> int:
+    try:
+        with open("/proc/self/io", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _net_rx_bytes() -> int:
+    """
+    Bytes received on every non-loopback interface of the network namespace.
+    """
+    total = 0
+    try:
+        with open("/proc/net/dev", "r", encoding="utf-8") as f:
+            for line in f.readlines()[2:]:
+                iface, data = line.split(":", 1)
+                if iface.strip() != "lo":
+                    total += int(data.split()[0])
+    except OSError:
+        pass
+    return total
+
+
+def current_record() -> typing.Optional[StageRecord]:
+    return getattr(_local, "record", None)
+
+
+def record_child_usage(usage: resource.struct_rusage):
+    """
+    Attributes a reaped child's rusage to the stage running on this thread.
+    """
+    record = current_record()
+    if record:
+        record.add_child_usage(usage)
+
+
+class Profiler:
+    """
+    Collects a StageRecord per measured stage and renders them as a JSONL run
+    report, a Chrome trace-event file or a ranked text summary.
+    """
+
+    def __init__(self):
+        self.records: typing.List[StageRecord] = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._active: typing.List[StageRecord] = []
+
+    @contextlib.contextmanager
+    def measure(self, name: str):
+        record = StageRecord(name=name, start=time.time(), thread=threading.get_ident())
+        previous = current_record()
+        _local.record = record
+        with self._lock:
+            if self._active:
+                record.overlapped = True
+                for active in self._active:
+                    active.overlapped = True
+            self._active.append(record)
+        written = _proc_io_write_bytes()
+        received = _net_rx_bytes()
+        start = time.monotonic()
+        try:
+            yield record
+        except BaseException as e:
+            record.ok = False
+            record.error = str(e)
+            raise
+        finally:
+            record.wall_seconds = time.monotonic() - start
+            record.bytes_written = max(0, _proc_io_write_bytes() - written)
+            received = max(0, _net_rx_bytes() - received)
+            _local.record = previous
+            with self._lock:
+                self._active.remove(record)
+                # a sibling stage's downloads can't be told apart from this one's
+                record.bytes_downloaded = None if record.overlapped else received
+                self.records.append(record)
+
+    def write_report(self, path: str, **run_info):
+        """
+        Writes one JSON object per line: a header describing the run, then
+        one line per stage.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            header = {"type": "run", "started": self.started, **run_info}
+            f.write(json.dumps(header) + "\n")
+            for record in self.records:
+                f.write(json.dumps({"type": "stage", **asdict(record)}) + "\n")
+
+    def write_trace(self, path: str):
+        """
+        Writes the stages as Chrome trace events (chrome://tracing, Perfetto).
+        """
+        threads = {}
+        events = []
+        for record in self.records:
+            tid = threads.setdefault(record.thread, len(threads) + 1)
+            events.append(
+                {
+                    "name": record.name,
+                    "ph": "X",
+                    "ts": int((record.start - self.started) * 1e6),
+                    "dur": int(record.wall_seconds * 1e6),
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {
+                        k: v
+                        for k, v in asdict(record).items()
+                        if k not in ("name", "start", "thread")
+                    },
+                }
+            )
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self) -> str:
+        """
+        Renders the stages ranked by wall time.
+        """
+        rows = [("STAGE", "WALL (s)", "CPU (s)", "MAX RSS (MB)", "DOWN (MB)", "WRITTEN (MB)")]
+        for r in sorted(self.records, key=lambda r: r.wall_seconds, reverse=True):
+            rows.append(
+                (
+                    r.name if r.ok else f"{r.name} (failed)",
+                    f"{r.wall_seconds:.2f}",
+                    f"{r.child_user_seconds + r.child_system_seconds:.2f}",
+                    f"{r.child_max_rss_kb / 1024:.1f}",
+                    "-" if r.bytes_downloaded is None else f"{r.bytes_downloaded / 1e6:.1f}",
+                    f"{r.bytes_written / 1e6:.1f}",
+                )
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join(
+            "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+            for row in rows
+        )
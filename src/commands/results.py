@@ -0,0 +1,144 @@
+import hashlib
+import os
+import shutil
+import time
+import typing
+from dataclasses import dataclass
+import yaml
+from . import cache
+from . import config as config_module
+
+
+@dataclass
+class StoredResult:
+    key: str
+    exit_code: int
+    patch_path: str
+    log_dir: str
+    created: float
+
+
+class ResultStore:
+    """
+    Finished FixMorph runs keyed by (upstream commit, prepped downstream tree,
+    toolchain image, run inputs). Each entry keeps the generated patch, the
+    run's logs and its exit status, so asking for the same backport again is
+    answered without running FixMorph.
+    """
+
+    def __init__(self, root: str, max_size: int, max_age_days: int):
+        self.root = root
+        self.max_size = max_size
+        self.max_age_days = max_age_days
+
+    @classmethod
+    def from_config(cls, conf: config_module.BackporterConfig) -> "ResultStore":
+        return cls(
+            conf.cache_path("results"),
+            conf.result_cache_max_size,
+            conf.result_cache_max_age_days,
+        )
+
+    @staticmethod
+    def key(commit_sha: str, downstream_key: str, image_id: str, inputs_digest: str) -> str:
+        digest = hashlib.sha256()
+        for part in (commit_sha, downstream_key, image_id, inputs_digest):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def lock(self, key: str) -> cache.FileLock:
+        return cache.FileLock(self.entry_path(key) + ".lock")
+
+    def get(self, key: str, touch: bool = True) -> typing.Optional[StoredResult]:
+        """
+        Returns the stored result for key, or None on a miss. An entry whose
+        patch is missing counts as a miss and is evicted. Pass touch=False to
+        look without counting it as a use.
+        """
+        entry = self.entry_path(key)
+        try:
+            with open(os.path.join(entry, "meta.yaml"), "r", encoding="utf-8") as f:
+                meta = yaml.safe_load(f)
+        except OSError:
+            return None
+        if self.max_age_days and time.time() - meta["created"] > self.max_age_days * 86400:
+            return None
+        patch_path = os.path.join(entry, "patch.diff")
+        if not os.path.isfile(patch_path):
+            # only runs that produced a patch are stored, so the entry is
+            # damaged; drop it unless a put replaced it meanwhile
+            with self.lock(key):
+                if not os.path.isfile(patch_path):
+                    shutil.rmtree(entry, ignore_errors=True)
+                    return None
+        if touch:
+            cache.touch(entry)
+        return StoredResult(
+            key=key,
+            exit_code=meta["exit_code"],
+            patch_path=patch_path,
+            log_dir=os.path.join(entry, "logs"),
+            created=meta["created"],
+        )
+
+    def put(
+        self,
+        key: str,
+        exit_code: int,
+        patch_path: typing.Optional[str],
+        log_paths: typing.List[str],
+        meta: typing.Dict[str, str],
+    ) -> StoredResult:
+        """
+        Stores the outcome of a FixMorph run under key, replacing any older one.
+        """
+        entry = self.entry_path(key)
+        with self.lock(key):
+            staging = entry + ".tmp"
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(os.path.join(staging, "logs"))
+            if patch_path:
+                shutil.copy(patch_path, os.path.join(staging, "patch.diff"))
+            for path in log_paths:
+                if os.path.isfile(path):
+                    shutil.copy(path, os.path.join(staging, "logs"))
+            with open(os.path.join(staging, "meta.yaml"), "w", encoding="utf-8") as f:
+                yaml.dump({**meta, "exit_code": exit_code, "created": time.time()}, f)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(staging, entry)
+            cache.touch(entry)
+        return self.get(key)
+
+    def entries(self) -> typing.List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            os.path.join(self.root, name)
+            for name in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, name)) and not name.endswith(".tmp")
+        ]
+
+    def gc(self) -> typing.List[str]:
+        """
+        Drops results created more than max_age_days ago, then evicts least
+        recently used ones until the store fits in max_size.
+        """
+        removed = []
+        entries = self.entries()
+        if self.max_age_days:
+            cutoff = time.time() - self.max_age_days * 86400
+            for entry in entries:
+                meta_path = os.path.join(entry, "meta.yaml")
+                if not os.path.exists(meta_path) or os.path.getmtime(meta_path) < cutoff:
+                    shutil.rmtree(entry, ignore_errors=True)
+                    removed.append(entry)
+        removed += cache.evict(
+            [e for e in entries if e not in removed],
+            self.max_size,
+            lock_for=lambda e: e + ".lock",
+        )
+        return removed
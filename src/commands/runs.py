@@ -0,0 +1,195 @@
+import os
+import re
+import shutil
+import time
+import typing
+import uuid
+import yaml
+from . import config as config_module
+
+
+# run directories kept under the runs root
+RUN_RETENTION = 50
+
+RUN_MANIFEST = "run.yaml"
+
+# a daemon job's run until a worker picks it up
+QUEUED = "queued"
+# statuses a run ends in; only runs in one of them are pruned
+FINISHED = ("done", "failed", "interrupted")
+
+
+class RunDir:
+    """
+    The persistent directory of one `create` run:
+
+    - run.yaml: what was asked for and how far the run got
+    - work/: the trees and build context the stages operate on
+    - stages/: a checkpoint per finished stage
+    - logs/: run.log and the per-stage logs
+    - output/: the generated patch
+
+    work/ is removed once the run succeeds; everything else is kept.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @property
+    def id(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def work_dir(self) -> str:
+        return os.path.join(self.path, "work")
+
+    @property
+    def stages_dir(self) -> str:
+        return os.path.join(self.path, "stages")
+
+    @property
+    def log_dir(self) -> str:
+        return os.path.join(self.path, "logs")
+
+    @property
+    def output_dir(self) -> str:
+        return os.path.join(self.path, "output")
+
+    def read_manifest(self) -> typing.Dict[str, typing.Any]:
+        with open(os.path.join(self.path, RUN_MANIFEST), "r", encoding="utf-8") as f:
+            return yaml.safe_load(f)
+
+    def update_manifest(self, **fields):
+        manifest_path = os.path.join(self.path, RUN_MANIFEST)
+        manifest = self.read_manifest() if os.path.exists(manifest_path) else {}
+        manifest.update(fields, updated=time.time())
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            yaml.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def finish(self, status: str, **fields):
+        """
+        Records the run's final status; a successful run's trees are removed.
+        """
+        self.update_manifest(status=status, **fields)
+        if status == "done":
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def resumable(self, manifest: typing.Dict[str, typing.Any]) -> bool:
+        """
+        Whether `backporter resume` can still pick the run up: its trees are
+        there and it backported to a single branch.
+        """
+        return os.path.isdir(self.work_dir) and "branches" not in manifest
+
+
+def run_id(commit_id: str, branch_name: str) -> str:
+    """
+    Returns a sortable, unique, filesystem-safe id for a new run.
+    """
+    parts = [
+        time.strftime("%Y%m%d-%H%M%S"),
+        commit_id[:12],
+        branch_name,
+        uuid.uuid4().hex[:6],
+    ]
+    return "-".join(re.sub(r"[^A-Za-z0-9._-]+", "_", p) for p in parts)
+
+
+def runs_root(conf: config_module.BackporterConfig) -> str:
+    return conf.cache_path("runs")
+
+
+def new_run(
+    conf: config_module.BackporterConfig,
+    commit_id: str,
+    branch_name: str,
+    status: str = "running",
+) -> RunDir:
+    """
+    Creates the directory for a fresh run of commit_id onto branch_name.
+    """
+    prune(runs_root(conf), RUN_RETENTION - 1)
+    run = RunDir(os.path.join(runs_root(conf), run_id(commit_id, branch_name)))
+    os.makedirs(run.work_dir)
+    run.update_manifest(
+        commit=commit_id,
+        branch=branch_name,
+        run_mode=conf.run_mode,
+        status=status,
+        created=time.time(),
+    )
+    return run
+
+
+def start_run(
+    conf: config_module.BackporterConfig,
+    commit_id: str,
+    branches: typing.Sequence[str],
+    status: str = "running",
+) -> RunDir:
+    """
+    Creates the directory for a fresh run of commit_id onto one branch, or
+    onto several at once.
+    """
+    if len(branches) == 1:
+        return new_run(conf, commit_id, branches[0], status)
+    run = new_run(conf, commit_id, ",".join(branches), status)
+    run.update_manifest(branches=list(branches))
+    return run
+
+
+def find_run(conf: config_module.BackporterConfig, run_id: str) -> RunDir:
+    run = RunDir(os.path.join(runs_root(conf), run_id))
+    if not os.path.exists(os.path.join(run.path, RUN_MANIFEST)):
+        raise ValueError(f"no run with id '{run_id}' in {runs_root(conf)}")
+    return run
+
+
+def latest_unfinished(
+    conf: config_module.BackporterConfig, commit_id: str, branch_name: str
+) -> typing.Optional[RunDir]:
+    """
+    Returns the newest run of commit_id onto branch_name that didn't succeed.
+    """
+    root = runs_root(conf)
+    if not os.path.isdir(root):
+        return None
+    for name in sorted(os.listdir(root), reverse=True):
+        run = RunDir(os.path.join(root, name))
+        try:
+            manifest = run.read_manifest()
+        except OSError:
+            continue
+        if (
+            manifest.get("commit") == commit_id
+            and manifest.get("branch") == branch_name
+            and manifest.get("status") != "done"
+            and os.path.isdir(run.work_dir)
+        ):
+            return run
+    return None
+
+
+def prune(root: str, keep: int = RUN_RETENTION):
+    """
+    Removes all but the newest `keep` finished run directories under root.
+    Queued and running runs are never removed, and neither are failed or
+    interrupted ones that can still be resumed.
+    """
+    if not os.path.isdir(root):
+        return
+    finished = []
+    for entry in os.scandir(root):
+        if not entry.is_dir():
+            continue
+        run = RunDir(entry.path)
+        try:
+            manifest = run.read_manifest()
+        except (OSError, yaml.YAMLError):
+            # a run being created right now, or not a run at all
+            continue
+        if manifest.get("status") in FINISHED and not run.resumable(manifest):
+            finished.append((manifest.get("updated", entry.stat().st_mtime), entry.path))
+    for _, path in sorted(finished, reverse=True)[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,336 @@
+import contextlib
+import heapq
+import itertools
+import os
+import re
+import threading
+import time
+import typing
+import uuid
+from dataclasses import dataclass
+import click
+from . import cache
+from . import config as config_module
+from . import fixmorph as fixmorph_module
+from . import pipeline
+
+
+# share of the host's memory the containers may use when max_memory isn't set;
+# the rest is left to the docker daemon, the CLI and whatever else runs there
+DETECTED_MEMORY_FRACTION = 0.9
+
+# estimated peak memory of a FixMorph run by package, when job_memory isn't
+# set: a fixed part for FixMorph's own analysis plus one per compile job
+PACKAGE_MEMORY = {
+    "frr": (2 * 1024 * 1024 * 1024, 512 * 1024 * 1024),
+}
+DEFAULT_PACKAGE_MEMORY = (2 * 1024 * 1024 * 1024, 512 * 1024 * 1024)
+
+# lower goes first; short jobs that unblock others jump the queue
+PRIORITY_BOOTSTRAP = 0
+PRIORITY_BUILD = 1
+PRIORITY_FIXMORPH = 2
+
+# how often queued jobs check whether their pipeline was cancelled
+WAIT_INTERVAL = 0.5
+
+# held while a process counts the slots of every process sharing the budget
+ADMISSION_LOCK = "admission.lock"
+SLOT_SUFFIX = ".slot"
+
+SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+@dataclass(frozen=True)
+class Cost:
+    cpus: int
+    # bytes; 0 leaves the container's memory unlimited
+    memory: int = 0
+
+
+# ./bootstrap.sh and the image build, which only bootstraps: one process
+BOOTSTRAP_COST = Cost(cpus=1, memory=1024 * 1024 * 1024)
+
+
+def parse_size(text: typing.Union[str, int]) -> int:
+    """
+    Parses a byte count such as 4294967296, "4G" or "512MiB".
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*", str(text), re.I)
+    if not match:
+        raise ValueError(f"invalid size {text!r}, expected e.g. 4G or 512M")
+    return int(float(match.group(1)) * SIZE_SUFFIXES[match.group(2).upper()])
+
+
+def format_size(size: int) -> str:
+    return f"{size / 1024**3:.1f}G"
+
+
+def detect_cpus() -> int:
+    return os.cpu_count() or 1
+
+
+def detect_memory() -> int:
+    """
+    Returns the host's physical memory in bytes, or 0 if it can't be told.
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        return 0
+
+
+def limit_args(cost: Cost) -> typing.List[str]:
+    """
+    docker run arguments holding a container to cost. Swap is capped at the
+    memory limit, so a job over its estimate is OOM-killed alone instead of
+    dragging the host into swap.
+    """
+    args = ["--cpus", str(cost.cpus)]
+    if cost.memory:
+        args += ["--memory", str(cost.memory), "--memory-swap", str(cost.memory)]
+    return args
+
+
+class Scheduler:
+    """
+    Admits container jobs while their estimated cost fits in a CPU and memory
+    budget and queues the rest. The queue is ordered by priority, then
+    arrival, and only its head is admitted, so a large job isn't starved by a
+    stream of smaller ones. A job costing more than the whole budget is
+    clamped to it and runs alone.
+
+    With slots_dir, the budget is shared with every other process using the
+    same directory: an admitted job holds an flock'd slot file there that
+    records its cost, and is only admitted while the slots of all processes
+    leave room for it. Queues are per process, so priorities only order a
+    process's own jobs.
+    """
+
+    def __init__(
+        self,
+        cpus: int,
+        memory: int = 0,
+        build_jobs: int = 0,
+        job_memory: int = 0,
+        package: str = fixmorph_module.PKG_NAME,
+        slots_dir: typing.Optional[str] = None,
+    ):
+        self.cpus = cpus
+        # 0: memory isn't budgeted
+        self.memory = memory
+        self.build_jobs = build_jobs
+        self.job_memory = job_memory
+        self.package = package
+        self.slots_dir = slots_dir
+        self._cond = threading.Condition()
+        self._queue: typing.List[typing.Tuple[int, int]] = []
+        self._tickets = itertools.count()
+        self.running = 0
+        self.used_cpus = 0
+        self.used_memory = 0
+        self.admitted = 0
+        self.peak_queued = 0
+        self.peak_cpus = 0
+        self.peak_memory = 0
+        self.wait_seconds = 0.0
+
+    @classmethod
+    def from_config(cls, conf: config_module.BackporterConfig) -> "Scheduler":
+        memory = parse_size(conf.max_memory) if conf.max_memory else 0
+        if not memory:
+            memory = int(detect_memory() * DETECTED_MEMORY_FRACTION)
+        return cls(
+            conf.max_cpus or detect_cpus(),
+            memory,
+            conf.build_jobs,
+            parse_size(conf.job_memory) if conf.job_memory else 0,
+            slots_dir=conf.cache_path("scheduler"),
+        )
+
+    def clamp(self, cost: Cost) -> Cost:
+        cpus = max(1, min(cost.cpus, self.cpus))
+        memory = min(cost.memory, self.memory) if self.memory else cost.memory
+        return Cost(cpus, memory)
+
+    def job_cost(self, parallel: int = 1) -> Cost:
+        """
+        Estimates what one FixMorph run (or a full build of its trees) costs
+        when `parallel` of them are meant to run at once: build_jobs CPUs, or
+        an even share of the budget, and job_memory or the package's
+        estimate for that many compile jobs.
+        """
+        cpus = self.build_jobs or max(1, self.cpus // max(1, parallel))
+        memory = self.job_memory
+        if not memory:
+            base, per_cpu = PACKAGE_MEMORY.get(self.package, DEFAULT_PACKAGE_MEMORY)
+            memory = base + per_cpu * cpus
+        return self.clamp(Cost(cpus, memory))
+
+    def _fits(self, cost: Cost, used_cpus: int, used_memory: int) -> bool:
+        if used_cpus + cost.cpus > self.cpus:
+            return False
+        return not self.memory or used_memory + cost.memory <= self.memory
+
+    def _admissible(self, ticket: typing.Tuple[int, int], cost: Cost) -> bool:
+        return self._queue[0] == ticket and (
+            self.running == 0 or self._fits(cost, self.used_cpus, self.used_memory)
+        )
+
+    def _claim(self, cost: Cost) -> typing.Optional[cache.FileLock]:
+        """
+        Takes a slot for cost in slots_dir if it fits next to the slots other
+        processes hold, and returns it held. A slot file nobody holds a lock
+        on was left by a process that exited, and is removed.
+        """
+        with cache.FileLock(os.path.join(self.slots_dir, ADMISSION_LOCK)):
+            running = used_cpus = used_memory = 0
+            for name in os.listdir(self.slots_dir):
+                if not name.endswith(SLOT_SUFFIX):
+                    continue
+                path = os.path.join(self.slots_dir, name)
+                probe = cache.FileLock(path, shared=True, blocking=False)
+                if probe.acquire():
+                    probe.release()
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                    continue
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        cpus, memory = (int(field) for field in f.read().split())
+                except (OSError, ValueError):
+                    continue
+                running += 1
+                used_cpus += cpus
+                used_memory += memory
+            if running and not self._fits(cost, used_cpus, used_memory):
+                return None
+            slot = cache.FileLock(
+                os.path.join(self.slots_dir, f"{os.getpid()}-{uuid.uuid4().hex}{SLOT_SUFFIX}")
+            )
+            slot.acquire()
+            with open(slot.path, "w", encoding="utf-8") as f:
+                f.write(f"{cost.cpus} {cost.memory}\n")
+            return slot
+
+    @contextlib.contextmanager
+    def slot(
+        self, cost: Cost, priority: int = PRIORITY_FIXMORPH, name: str = "job"
+    ) -> typing.Iterator[Cost]:
+        """
+        Blocks until cost is admitted and holds it for the duration of the
+        block. Yields the admitted (possibly clamped) cost.
+        """
+        cost = self.clamp(cost)
+        ticket = (priority, next(self._tickets))
+        started = time.monotonic()
+        slot = None
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            try:
+                queued = False
+                while True:
+                    if self._admissible(ticket, cost):
+                        if not self.slots_dir:
+                            break
+                        slot = self._claim(cost)
+                        if slot:
+                            break
+                    if not queued:
+                        queued = True
+                        self.peak_queued = max(self.peak_queued, len(self._queue))
+                        click.secho(f"[{name}] queued: {self.format_status()}")
+                    self._cond.wait(WAIT_INTERVAL)
+                    pipeline.check_cancelled()
+            except BaseException:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._queue)
+            self.running += 1
+            self.used_cpus += cost.cpus
+            self.used_memory += cost.memory
+            self.admitted += 1
+            self.peak_cpus = max(self.peak_cpus, self.used_cpus)
+            self.peak_memory = max(self.peak_memory, self.used_memory)
+            self.wait_seconds += time.monotonic() - started
+            # the next job in line may fit as well
+            self._cond.notify_all()
+        try:
+            yield cost
+        finally:
+            if slot:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(slot.path)
+                slot.release()
+            with self._cond:
+                self.running -= 1
+                self.used_cpus -= cost.cpus
+                self.used_memory -= cost.memory
+                self._cond.notify_all()
+
+    def format_status(self) -> str:
+        memory = (
+            f", memory {format_size(self.used_memory)}/{format_size(self.memory)}"
+            if self.memory
+            else ""
+        )
+        return (
+            f"{self.running} running, {len(self._queue)} queued,"
+            f" CPUs {self.used_cpus}/{self.cpus}{memory}"
+        )
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        Queue depth and utilisation, now and at their peak, for reports.
+        """
+        with self._cond:
+            return {
+                "cpus": self.cpus,
+                "memory": self.memory,
+                "running": self.running,
+                "queued": len(self._queue),
+                "used_cpus": self.used_cpus,
+                "used_memory": self.used_memory,
+                "admitted": self.admitted,
+                "peak_queued": self.peak_queued,
+                "peak_cpu_utilisation": round(self.peak_cpus / self.cpus, 3),
+                "peak_memory_utilisation": (
+                    round(self.peak_memory / self.memory, 3) if self.memory else None
+                ),
+                "wait_seconds": round(self.wait_seconds, 3),
+            }
+
+    def format_stats(self) -> str:
+        stats = self.stats()
+        memory = stats["peak_memory_utilisation"]
+        return (
+            f"Scheduler: {stats['admitted']} jobs, peak queue {stats['peak_queued']},"
+            f" peak CPU {stats['peak_cpu_utilisation']:.0%}"
+            + (f", peak memory {memory:.0%}" if memory is not None else "")
+            + f", {stats['wait_seconds']:.1f}s queued"
+        )
+
+
+_schedulers: typing.Dict[typing.Tuple[typing.Any, ...], Scheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def for_config(conf: config_module.BackporterConfig) -> Scheduler:
+    """
+    Returns the process-wide scheduler for conf's budget, so every run in the
+    process draws from the same one; other processes with the same cache
+    directory share it through slot files.
+    """
+    key = (
+        conf.max_cpus,
+        conf.max_memory,
+        conf.build_jobs,
+        conf.job_memory,
+        conf.cache_path("scheduler"),
+    )
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = Scheduler.from_config(conf)
+        return _schedulers[key]
@@ -0,0 +1,32 @@
+#!/bin/bash
+
+set -e -o pipefail
+
+# Entry point for bind-mounted runs. The host provides:
+#   ${SRC_PATH_A}, ${SRC_PATH_B}, ${SRC_PATH_C}  the three source trees
+#   /workspace/repair.conf                       FixMorph configuration
+#   /workspace/output                            receives fixmorph.diff
+
+# hand everything we wrote back to the invoking user
+function cleanup() {
+    chown -R "${HOST_UID}:${HOST_GID}" /dirs /workspace/output 2> /dev/null || true
+}
+trap cleanup EXIT
+
+function run() {
+    # trees the host already bootstrapped (or copied from one that was) are skipped
+    for dir in "${SRC_PATH_A}" "${SRC_PATH_B}" "${SRC_PATH_C}"; do
+        if [ ! -f "${dir}/.backporter-bootstrapped" ]; then
+            (cd "${dir}" && ./bootstrap.sh && touch .backporter-bootstrapped)
+        fi
+    done
+
+    cd /FixMorph
+    python3.11 FixMorph.py --conf=/workspace/repair.conf --format=unified
+
+    # retrieve the patch
+    local patch=$(find output/ -type f -name "*-generated-patch" | head -n 1)
+    cp "${patch}" /workspace/output/fixmorph.diff
+}
+
+run
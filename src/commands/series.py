@@ -0,0 +1,206 @@
+import hashlib
+import os
+import typing
+from dataclasses import dataclass
+import click
+from . import config as config_module
+from . import pipeline
+from . import upstream as upstream_module
+from . import workspace as workspace_module
+
+
+# what create takes besides a single commit: BASE..TIP, the commits after
+# BASE up to and including TIP, or SHA,SHA,... in the order to backport them
+RANGE_SEPARATOR = ".."
+LIST_SEPARATOR = ","
+
+# the whole series as one mbox, `git am`-able downstream
+SERIES_PATCH = "series.patch"
+# the patch file names in order, as quilt reads them
+SERIES_FILE = "series"
+
+
+@dataclass
+class Step:
+    """
+    One commit of a series: its position, its SHA and the cache key of the
+    downstream tree it's backported onto, which holds every earlier step's
+    patch.
+    """
+
+    index: int
+    commit: str
+    downstream_key: typing.Optional[str]
+
+    @property
+    def name(self) -> str:
+        return f"{self.index + 1:04d}-{self.commit[:12]}"
+
+
+def is_series(commit_spec: str) -> bool:
+    return RANGE_SEPARATOR in commit_spec or LIST_SEPARATOR in commit_spec
+
+
+def tip(commit_spec: str) -> str:
+    """
+    Returns the commit of the spec the upstream clone has to reach.
+    """
+    if RANGE_SEPARATOR in commit_spec:
+        return commit_spec.split(RANGE_SEPARATOR, 1)[1]
+    return commit_spec.split(LIST_SEPARATOR)[-1]
+
+
+def resolve(upstream_path: str, commit_spec: str) -> typing.List[str]:
+    """
+    Expands a BASE..TIP range or a SHA,SHA,... list to full SHAs in the order
+    they're backported.
+    """
+    if RANGE_SEPARATOR in commit_spec:
+        base, end = commit_spec.split(RANGE_SEPARATOR, 1)
+        commits = upstream_module.list_commits(upstream_path, base, end)
+    else:
+        commits = [
+            upstream_module.resolve_commit(upstream_path, c.strip())
+            for c in commit_spec.split(LIST_SEPARATOR)
+            if c.strip()
+        ]
+    if not commits:
+        raise RuntimeError(f"'{commit_spec}' does not name any commits")
+    return list(dict.fromkeys(commits))
+
+
+def prepare_upstream(
+    conf: config_module.BackporterConfig, commit_spec: str, upstream_path: str
+) -> typing.List[str]:
+    """
+    Clones the upstream repo once for the whole series and returns its
+    commits. The checkout is left for advance_upstream to position.
+    """
+    if conf.upstream_fetch == "shallow":
+        # a range is only resolvable with the history in between
+        click.secho("A commit series needs upstream history, cloning partially instead")
+        upstream_module.partial_checkout(conf.upstream_url, upstream_path)
+    else:
+        upstream_module.clone_upstream(conf, upstream_path, tip(commit_spec))
+    return resolve(upstream_path, commit_spec)
+
+
+def _head(upstream_path: str) -> typing.Optional[str]:
+    proc = pipeline.run_command(
+        ["git", "-C", upstream_path, "rev-parse", "--verify", "HEAD"], capture_output=True
+    )
+    return proc.stdout.decode("utf-8").strip() if proc.returncode == 0 else None
+
+
+def at_parent(upstream_path: str, commit_id: str) -> bool:
+    """
+    Whether the upstream checkout is at commit_id's parent, where
+    advance_upstream left it for that step.
+    """
+    return _head(upstream_path) == upstream_module.resolve_commit(
+        upstream_path, f"{commit_id}~1"
+    )
+
+
+def advance_upstream(upstream_path: str, commit_id: str) -> str:
+    """
+    Moves the upstream checkout to commit_id's parent in place and returns the
+    commit's patch. Only the files that differ get rewritten, so build output
+    left in the tree by earlier steps stays valid for the rest; bootstrap
+    output is only redone when autotools inputs changed on the way.
+    """
+    head = _head(upstream_path)
+    if head and any(
+        workspace_module.BUILD_FILE_PATTERN.search(path)
+        for path in upstream_module.changed_files(upstream_path, head, f"{commit_id}~1")
+    ):
+        click.secho("Build files changed since the last step, upstream will be bootstrapped again")
+        unmark_bootstrapped(upstream_path)
+    return upstream_module.checkout_parent(upstream_path, commit_id)
+
+
+def unmark_bootstrapped(tree: str):
+    marker = os.path.join(tree, workspace_module.BOOTSTRAP_MARKER)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+
+def downstream_key(
+    base_key: typing.Optional[str], patches: typing.Sequence[str]
+) -> typing.Optional[str]:
+    """
+    Keys the prepped downstream tree with patches applied on top, so stored
+    FixMorph results of a step are only reused for the same earlier steps.
+    """
+    if base_key is None:
+        return None
+    if not patches:
+        return base_key
+    digest = hashlib.sha256(base_key.encode("utf-8"))
+    for patch in patches:
+        digest.update(b"\0" + patch.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def apply_to_tree(tree: str, patch: str, step: Step):
+    """
+    Applies a step's generated patch to the downstream tree in place, for the
+    next step to backport onto. Only the files it touches are rewritten.
+    """
+    if not patch.strip():
+        return
+    files = workspace_module.patched_files(patch)
+    # the tree may be linked from the dist-git cache
+    workspace_module.break_links(tree, files)
+    patch_path = os.path.join(os.path.abspath(tree), ".backporter-step.patch")
+    with open(patch_path, "w", encoding="utf-8") as f:
+        f.write(patch)
+    try:
+        # outside of any repository, so git apply works like patch(1) on tree
+        env = dict(os.environ, GIT_CEILING_DIRECTORIES=os.path.dirname(os.path.abspath(tree)))
+        proc = pipeline.run_command(
+            ["git", "apply", patch_path], cwd=tree, env=env, capture_output=True
+        )
+    finally:
+        os.remove(patch_path)
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"the patch of step {step.name} does not apply to the downstream tree: {proc.stderr.decode('utf-8')}"
+        )
+    if workspace_module.touches_build_files(patch):
+        unmark_bootstrapped(tree)
+
+
+def write_series(
+    output_dir: str, upstream_path: str, steps: typing.Sequence[Step], patches: typing.Sequence[str]
+) -> str:
+    """
+    Writes each step's patch as NNNN-<sha>.patch with its upstream commit
+    message, the series file listing them in order and all of them as one
+    mbox. Returns the mbox's path.
+    """
+    names = []
+    mbox = []
+    for step, patch in zip(steps, patches):
+        proc = pipeline.run_command(
+            ["git", "-C", upstream_path, "log", "-1", "--format=email", step.commit],
+            check=True,
+            capture_output=True,
+        )
+        header = proc.stdout.decode("utf-8").replace(
+            "Subject: [PATCH]", f"Subject: [PATCH {step.index + 1}/{len(steps)}]", 1
+        )
+        text = f"{header.rstrip()}\n\n(backported from commit {step.commit})\n---\n{patch}"
+        if not text.endswith("\n"):
+            text += "\n"
+        name = f"{step.name}.patch"
+        with open(os.path.join(output_dir, name), "w", encoding="utf-8") as f:
+            f.write(text)
+        names.append(name)
+        mbox.append(text)
+    with open(os.path.join(output_dir, SERIES_FILE), "w", encoding="utf-8") as f:
+        f.write("".join(f"{name}\n" for name in names))
+    series_path = os.path.join(output_dir, SERIES_PATCH)
+    with open(series_path, "w", encoding="utf-8") as f:
+        f.write("".join(mbox))
+    return series_path
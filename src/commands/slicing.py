@@ -0,0 +1,340 @@
+import json
+import os
+import re
+import shlex
+import shutil
+import typing
+import click
+from . import cache
+from . import config as config_module
+from . import containers
+from . import fixmorph as fixmorph_module
+from . import scheduler as scheduler_module
+from . import workspace as workspace_module
+
+
+COMPILE_DB = "compile_commands.json"
+
+# patches touching anything else (build files, scripts, ...) get the full trees
+SOURCE_SUFFIXES = (".c", ".h")
+
+INCLUDE_PATTERN = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"]+)[>"]', re.M)
+
+
+class CompileDbCache:
+    """
+    compile_commands.json of a full build, with paths relative to the tree,
+    keyed by the toolchain image, the configure flags and the tree's autotools
+    inputs. Which translation units exist and how they're compiled only
+    changes with those, so one index serves every commit in between.
+    """
+
+    def __init__(self, root: str, max_size: int):
+        self.root = root
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, conf: config_module.BackporterConfig) -> "CompileDbCache":
+        return cls(conf.cache_path("compile-db"), conf.compile_db_cache_max_size)
+
+    @staticmethod
+    def key(toolchain_image: str, tree: str) -> str:
+        return workspace_module.build_inputs_digest(
+            tree, toolchain_image, fixmorph_module.configure_command()
+        )
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def lock(self, key: str) -> cache.FileLock:
+        return cache.FileLock(self.entry_path(key) + ".lock")
+
+    def get(self, key: str) -> typing.Optional[typing.List[typing.Dict[str, typing.Any]]]:
+        try:
+            with open(os.path.join(self.entry_path(key), COMPILE_DB), "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except OSError:
+            return None
+        cache.touch(self.entry_path(key))
+        return entries
+
+    def put(self, key: str, entries: typing.List[typing.Dict[str, typing.Any]]):
+        """
+        Stores a compile database under key. Callers hold self.lock(key).
+        """
+        entry = self.entry_path(key)
+        os.makedirs(entry, exist_ok=True)
+        with open(os.path.join(entry, COMPILE_DB + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(os.path.join(entry, COMPILE_DB + ".tmp"), os.path.join(entry, COMPILE_DB))
+        cache.touch(entry)
+
+    def entries(self) -> typing.List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            os.path.join(self.root, name)
+            for name in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, name))
+        ]
+
+    def gc(self) -> typing.List[str]:
+        """
+        Evicts least recently used compile databases until the cache fits in
+        max_size.
+        """
+        return cache.evict(
+            self.entries(), self.max_size, lock_for=lambda e: e + ".lock"
+        )
+
+
+def _relative(path: str, directory: str, root: str) -> str:
+    return os.path.relpath(os.path.join(directory, path), root)
+
+
+def _normalise(
+    entry: typing.Dict[str, typing.Any], root: str
+) -> typing.Dict[str, typing.Any]:
+    """
+    Rewrites a bear entry recorded under root to paths relative to the tree.
+    """
+    directory = entry["directory"]
+    arguments = entry.get("arguments") or shlex.split(entry["command"])
+    normalised = {
+        "directory": os.path.relpath(directory, root),
+        "file": _relative(entry["file"], directory, root),
+        "arguments": arguments,
+    }
+    if entry.get("output"):
+        normalised["output"] = _relative(entry["output"], directory, root)
+    return normalised
+
+
+def index_tree(
+    toolchain_image: str,
+    tree: str,
+    scratch_dir: str,
+    jobs: int = 1,
+    log_path: typing.Optional[str] = None,
+    docker_args: typing.Sequence[str] = (),
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Configures and builds a copy of the bootstrapped tree under bear in the
+    toolchain image and returns its compile database. The copy is mounted
+    next to the FixMorph trees, so the build also warms ccache for them.
+    """
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    cache.copy_tree(tree, scratch_dir)
+    src = f"/dirs/{fixmorph_module.PKG_NAME}-index"
+    script = (
+        f"{fixmorph_module.configure_command(cached=True)}"
+        f" && bear --output {COMPILE_DB} -- {fixmorph_module.make_command(jobs)};"
+        f" rc=$?; chown -R {os.getuid()}:{os.getgid()} {src}; exit $rc"
+    )
+    command = [
+        "--rm",
+        "--platform",
+        containers.PLATFORM,
+        *docker_args,
+        "-v",
+        f"{os.path.abspath(scratch_dir)}:{src}:rw,z",
+        "-w",
+        src,
+        toolchain_image,
+        "bash",
+        "-c",
+        script,
+    ]
+    try:
+        if containers.engine().run(command, log_path=log_path) != 0:
+            raise RuntimeError(f"indexing build failed in {tree}")
+        try:
+            with open(os.path.join(scratch_dir, COMPILE_DB), "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"indexing build left no usable {COMPILE_DB}: {e}") from e
+        return [_normalise(e, src) for e in entries]
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def _include_dirs(entry: typing.Dict[str, typing.Any]) -> typing.List[str]:
+    """
+    Returns the entry's -I and -iquote directories that are inside the tree.
+    """
+    dirs = []
+    arguments = entry["arguments"]
+    for i, arg in enumerate(arguments):
+        value = None
+        for flag in ("-I", "-iquote"):
+            if arg == flag and i + 1 < len(arguments):
+                value = arguments[i + 1]
+            elif arg.startswith(flag) and len(arg) > len(flag):
+                value = arg[len(flag) :]
+        if value is None or os.path.isabs(value):
+            continue
+        path = os.path.normpath(os.path.join(entry["directory"], value))
+        if not path.startswith(".."):
+            dirs.append(path)
+    return dirs
+
+
+def _includes(tree: str, path: str) -> typing.List[typing.Tuple[bytes, bytes]]:
+    try:
+        with open(os.path.join(tree, path), "rb") as f:
+            return INCLUDE_PATTERN.findall(f.read())
+    except OSError:
+        return []
+
+
+def header_closure(
+    tree: str,
+    source: str,
+    include_dirs: typing.Sequence[str],
+    parsed: typing.Optional[typing.Dict[str, typing.List[typing.Tuple[bytes, bytes]]]] = None,
+) -> typing.Set[str]:
+    """
+    Returns the tree's headers that source includes, directly or not, by
+    following #include directives through include_dirs. Headers outside the
+    tree or not generated yet are skipped. Pass the same `parsed` dict to
+    calls on one tree to read each file once.
+    """
+    if parsed is None:
+        parsed = {}
+    seen: typing.Set[str] = set()
+    pending = [source]
+    while pending:
+        path = pending.pop()
+        if path not in parsed:
+            parsed[path] = _includes(tree, path)
+        for kind, name in parsed[path]:
+            name = name.decode("utf-8", errors="replace")
+            candidates = list(include_dirs)
+            if kind == b'"':
+                candidates.insert(0, os.path.dirname(path))
+            for directory in candidates:
+                header = os.path.normpath(os.path.join(directory, name))
+                if os.path.isfile(os.path.join(tree, header)):
+                    if header not in seen:
+                        seen.add(header)
+                        pending.append(header)
+                    break
+    return seen
+
+
+def _make_targets(outputs: typing.Iterable[str]) -> typing.List[str]:
+    """
+    Turns compiler outputs into make targets: libtool's .libs/x.o is built
+    by the x.lo rule, which also produces the non-PIC x.o next to it.
+    """
+    targets = set()
+    for output in outputs:
+        directory, name = os.path.split(output)
+        if os.path.basename(directory) == ".libs" and name.endswith(".o"):
+            targets.add(os.path.join(os.path.dirname(directory), name[:-2] + ".lo"))
+        else:
+            targets.add(output)
+    return sorted(
+        t for t in targets if not (t.endswith(".o") and t[:-2] + ".lo" in targets)
+    )
+
+
+def slice_targets(
+    entries: typing.List[typing.Dict[str, typing.Any]],
+    tree: str,
+    touched: typing.Sequence[str],
+) -> typing.Optional[typing.List[str]]:
+    """
+    Returns the make targets of the translation units that are, or include,
+    one of the touched files. Returns None when that slice can't cover the
+    patch: a touched source isn't compiled, a touched header isn't included
+    anywhere, or the database doesn't record outputs.
+    """
+    sources = {e["file"] for e in entries}
+    affected = [e for e in entries if e["file"] in touched]
+    covered = {e["file"] for e in affected}
+    headers = {f for f in touched if f.endswith(".h")}
+    if headers:
+        parsed: typing.Dict[str, typing.List[typing.Tuple[bytes, bytes]]] = {}
+        for entry in entries:
+            if entry["file"] in covered:
+                continue
+            closure = header_closure(tree, entry["file"], _include_dirs(entry), parsed)
+            hit = headers & closure
+            if hit:
+                affected.append(entry)
+                covered |= hit
+    if any(f.endswith(".c") and f not in sources for f in touched):
+        return None
+    if not headers <= covered or not affected:
+        return None
+    if any("output" not in e for e in affected):
+        return None
+    return _make_targets(e["output"] for e in affected)
+
+
+def ensure_index(
+    conf: config_module.BackporterConfig,
+    toolchain_image: str,
+    tree: str,
+    scratch_dir: str,
+    log_path: typing.Optional[str] = None,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Returns the compile database of the bootstrapped tree, indexing it unless
+    one for the same build configuration is stored.
+    """
+    store = CompileDbCache.from_config(conf)
+    key = store.key(toolchain_image, tree)
+    with store.lock(key):
+        entries = store.get(key)
+        if entries is None:
+            click.secho(f"Indexing the build of {os.path.basename(tree)}")
+            scheduler = scheduler_module.for_config(conf)
+            with scheduler.slot(
+                scheduler.job_cost(), scheduler_module.PRIORITY_BUILD, "index"
+            ) as cost:
+                entries = index_tree(
+                    toolchain_image,
+                    tree,
+                    scratch_dir,
+                    cost.cpus,
+                    log_path,
+                    fixmorph_module.build_cache_args(conf, stats=False)
+                    + scheduler_module.limit_args(cost),
+                )
+            store.put(key, entries)
+    return entries
+
+
+def plan(
+    conf: config_module.BackporterConfig,
+    toolchain_image: str,
+    tree: str,
+    upstream_patch: str,
+    scratch_dir: str,
+    log_path: typing.Optional[str] = None,
+) -> typing.Optional[typing.List[str]]:
+    """
+    Returns the make targets FixMorph needs to build in A and B for
+    upstream_patch, indexing the bootstrapped tree A once per build
+    configuration. Returns None when the full trees have to be built.
+    """
+    touched = workspace_module.patched_files(upstream_patch)
+    if not touched or not all(f.endswith(SOURCE_SUFFIXES) for f in touched):
+        click.secho("upstream.patch touches more than C sources, building the full trees")
+        return None
+    try:
+        entries = ensure_index(conf, toolchain_image, tree, scratch_dir, log_path)
+    except RuntimeError as e:
+        click.secho(f"{e}, building the full trees", fg="yellow")
+        return None
+    targets = slice_targets(entries, tree, touched)
+    if targets is None:
+        click.secho("The patch's translation units can't be sliced out, building the full trees")
+        return None
+    click.secho(
+        f"Restricting FixMorph to {len(targets)} of {len(entries)} translation units",
+        fg="green",
+    )
+    return targets
@@ -0,0 +1,288 @@
+import hashlib
+import os
+import re
+import shutil
+import typing
+import click
+from . import cache
+from . import config as config_module
+from . import pipeline
+
+
+# mirrors used this recently are never evicted; job checkouts borrow their objects
+MIRROR_GRACE_SECONDS = 24 * 60 * 60
+
+
+class MirrorStore:
+    """
+    A set of bare `git clone --mirror` repositories keyed by upstream URL.
+    Mirrors are fetched incrementally and jobs get cheap local clones that
+    borrow objects from them instead of cloning over the network.
+    """
+
+    def __init__(self, root: str, max_size: int):
+        self.root = root
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, conf: config_module.BackporterConfig) -> "MirrorStore":
+        return cls(os.path.join(conf.cache_path(), "mirrors"), conf.mirror_max_size)
+
+    def path_for(self, url: str) -> str:
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+        name = re.sub(r"[^A-Za-z0-9._-]", "_", url.rstrip("/").split("/")[-1])
+        if name.endswith(".git"):
+            name = name[: -len(".git")]
+        return os.path.join(self.root, f"{name}-{digest}.git")
+
+    @staticmethod
+    def lock_path(mirror_path: str) -> str:
+        return mirror_path + ".lock"
+
+    def update(self, url: str) -> str:
+        """
+        Creates the mirror for url or fetches whatever is new, and returns its path.
+        """
+        path = self.path_for(url)
+        with cache.FileLock(self.lock_path(path)):
+            if not os.path.isdir(path):
+                click.secho(f"Creating mirror of '{url}' in {path}")
+                proc = pipeline.run_command(
+                    ["git", "clone", "--mirror", url, path], capture_output=True
+                )
+                # objects are shared with job checkouts; never prune them behind their back
+                if proc.returncode == 0:
+                    pipeline.run_command(
+                        ["git", "-C", path, "config", "gc.auto", "0"], check=True
+                    )
+            else:
+                click.secho(f"Fetching updates for mirror of '{url}'")
+                proc = pipeline.run_command(
+                    ["git", "-C", path, "fetch", "--prune", "origin"],
+                    capture_output=True,
+                )
+            if proc.returncode != 0:
+                raise RuntimeError(
+                    f"failed to update mirror of '{url}': {proc.stderr.decode('utf-8')}"
+                )
+            cache.touch(path)
+        return path
+
+    def has_commit(self, url: str, commit_id: str) -> bool:
+        path = self.path_for(url)
+        if not os.path.isdir(path):
+            return False
+        proc = pipeline.run_command(
+            ["git", "-C", path, "cat-file", "-e", f"{commit_id}^{{commit}}"],
+            capture_output=True,
+        )
+        return proc.returncode == 0
+
+    def checkout(self, url: str, dest: str, commit_id: typing.Optional[str] = None):
+        """
+        Makes a local clone of the mirror for url at dest. Only fetches from the
+        network when the mirror is missing or doesn't have commit_id yet.
+        """
+        if commit_id is None or not self.has_commit(url, commit_id):
+            path = self.update(url)
+        else:
+            path = self.path_for(url)
+            cache.touch(path)
+        with cache.FileLock(self.lock_path(path), shared=True):
+            pipeline.run_command(
+                ["git", "clone", "--shared", "--no-checkout", path, dest],
+                check=True,
+                capture_output=True,
+            )
+        pipeline.run_command(
+            ["git", "-C", dest, "remote", "set-url", "origin", url],
+            check=True,
+            capture_output=True,
+        )
+
+    def mirrors(self) -> typing.List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            os.path.join(self.root, name)
+            for name in os.listdir(self.root)
+            if name.endswith(".git")
+        ]
+
+    def gc(self) -> typing.List[str]:
+        """
+        Evicts least recently used mirrors until the store fits in max_size.
+        """
+        return cache.evict(
+            self.mirrors(),
+            self.max_size,
+            grace_seconds=MIRROR_GRACE_SECONDS,
+            lock_for=self.lock_path,
+        )
+
+
+def partial_checkout(url: str, dest: str):
+    """
+    Clones url into dest without any file contents; blobs are fetched lazily
+    as the diff and checkout need them.
+    """
+    proc = pipeline.run_command(
+        ["git", "clone", "--filter=blob:none", "--no-checkout", url, dest],
+        capture_output=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"failed to clone '{url}': {proc.stderr.decode('utf-8')}"
+        )
+
+
+def shallow_checkout(url: str, dest: str, commit_id: str):
+    """
+    Fetches only commit_id and its parent into dest. Falls back to a partial
+    clone when the server refuses to serve the commit by SHA (which is always
+    the case for abbreviated SHAs).
+    """
+    pipeline.run_command(["git", "init", "-q", dest], check=True, capture_output=True)
+    pipeline.run_command(
+        ["git", "-C", dest, "remote", "add", "origin", url],
+        check=True,
+        capture_output=True,
+    )
+    fetch_proc = pipeline.run_command(
+        ["git", "-C", dest, "fetch", "--depth=2", "origin", commit_id],
+        capture_output=True,
+    )
+    if fetch_proc.returncode == 0:
+        return
+    click.secho(
+        f"Server refused fetching '{commit_id}' by SHA, falling back to a blobless partial clone",
+        fg="yellow",
+    )
+    shutil.rmtree(dest)
+    partial_checkout(url, dest)
+
+
+def clone_upstream(
+    conf: config_module.BackporterConfig, upstream_path: str, commit_id: str
+):
+    """
+    Clones the upstream repo into upstream_path, fetched as conf.upstream_fetch
+    says, with at least commit_id and its parent available.
+    """
+    click.secho(f"Cloning upstream repo '{conf.upstream_url}' ({conf.upstream_fetch})")
+    if conf.upstream_fetch == "mirror":
+        MirrorStore.from_config(conf).checkout(
+            conf.upstream_url, upstream_path, commit_id
+        )
+    elif conf.upstream_fetch == "shallow":
+        shallow_checkout(conf.upstream_url, upstream_path, commit_id)
+    elif conf.upstream_fetch == "partial":
+        partial_checkout(conf.upstream_url, upstream_path)
+    else:
+        raise ValueError(
+            f"unknown upstream_fetch mode '{conf.upstream_fetch}', expected one of {config_module.UPSTREAM_FETCH_MODES}"
+        )
+
+
+def checkout_parent(upstream_path: str, commit_id: str) -> str:
+    """
+    Checks out the parent of commit_id in the existing clone at upstream_path
+    and returns the upstream patch introduced by commit_id.
+    """
+    upstream_diff_proc = pipeline.run_command(
+        ["git", "-C", upstream_path, "diff", f"{commit_id}~1", commit_id],
+        capture_output=True,
+    )
+    if upstream_diff_proc.returncode != 0:
+        raise RuntimeError(
+            f"Error getting the diff from the upstream repo: {upstream_diff_proc.stderr.decode('utf-8')}"
+        )
+    upstream_patch = upstream_diff_proc.stdout.decode("utf-8")
+    if not upstream_patch:
+        raise RuntimeError("No patch found in the upstream repo")
+
+    # leave the upstream tree at 1 commit before
+    pipeline.run_command(
+        ["git", "-C", upstream_path, "checkout", "--detach", f"{commit_id}~1"],
+        check=True,
+        capture_output=True,
+    )
+    return upstream_patch
+
+
+def prepare_upstream(
+    conf: config_module.BackporterConfig, commit_id: str, upstream_path: str
+) -> str:
+    """
+    Checks out the parent of commit_id into upstream_path and returns the
+    upstream patch introduced by commit_id.
+    """
+    clone_upstream(conf, upstream_path, commit_id)
+    return checkout_parent(upstream_path, commit_id)
+
+
+def checkout_head(conf: config_module.BackporterConfig, upstream_path: str) -> str:
+    """
+    Clones the upstream repo into upstream_path, fetched as conf.upstream_fetch
+    says, with its HEAD checked out, and returns HEAD's SHA. A mirror is
+    updated first, so it holds whatever is new upstream.
+    """
+    if conf.upstream_fetch == "mirror":
+        mirror_path = MirrorStore.from_config(conf).update(conf.upstream_url)
+        sha = resolve_commit(mirror_path, "HEAD")
+    else:
+        proc = pipeline.run_command(
+            ["git", "ls-remote", conf.upstream_url, "HEAD"], capture_output=True
+        )
+        if proc.returncode != 0 or not proc.stdout.strip():
+            raise RuntimeError(
+                f"failed to look up HEAD of '{conf.upstream_url}': {proc.stderr.decode('utf-8')}"
+            )
+        sha = proc.stdout.decode("utf-8").split()[0]
+    clone_upstream(conf, upstream_path, sha)
+    # clones come without a checkout
+    pipeline.run_command(
+        ["git", "-C", upstream_path, "checkout", "--force", "--detach", sha],
+        check=True,
+        capture_output=True,
+    )
+    return sha
+
+
+def list_commits(upstream_path: str, base: str, tip: str) -> typing.List[str]:
+    """
+    Returns the full SHAs of the non-merge commits in base..tip, oldest first.
+    """
+    proc = pipeline.run_command(
+        ["git", "-C", upstream_path, "rev-list", "--reverse", "--no-merges", f"{base}..{tip}"],
+        capture_output=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"Error listing the commits in {base}..{tip}: {proc.stderr.decode('utf-8')}"
+        )
+    return proc.stdout.decode("utf-8").split()
+
+
+def changed_files(upstream_path: str, old: str, new: str) -> typing.List[str]:
+    """
+    Returns the paths that differ between two commits.
+    """
+    proc = pipeline.run_command(
+        ["git", "-C", upstream_path, "diff", "--name-only", old, new],
+        check=True,
+        capture_output=True,
+    )
+    return proc.stdout.decode("utf-8").splitlines()
+
+
+def resolve_commit(upstream_path: str, commit_id: str) -> str:
+    """
+    Expands commit_id, which may be abbreviated or a ref, to a full SHA.
+    """
+    proc = pipeline.run_command(
+        ["git", "-C", upstream_path, "rev-parse", "--verify", f"{commit_id}^{{commit}}"],
+        check=True,
+        capture_output=True,
+    )
+    return proc.stdout.decode("utf-8").strip()
@@ -0,0 +1,110 @@
+import os
+import typing
+from . import config as config_module
+from . import downstream as downstream_module
+from . import fixmorph as fixmorph_module
+from . import pipeline
+from . import scheduler as scheduler_module
+from . import slicing as slicing_module
+from . import upstream as upstream_module
+from . import workspace as workspace_module
+
+
+def warm_stages(
+    conf: config_module.BackporterConfig,
+    branches: typing.Sequence[str],
+    work_dir: str,
+) -> typing.List[pipeline.Stage]:
+    """
+    Builds the stage graph of `backporter warm`: fetch upstream and check out
+    its HEAD, prep every branch's downstream tree into the dist-git cache,
+    ensure the toolchain image, then bootstrap and index (configure and build
+    under bear) each tree into the bootstrap and compile database caches,
+    which also fills the shared configure cache and ccache. Every step is
+    answered from its cache when its inputs haven't changed.
+    """
+    upstream_path = os.path.join(work_dir, "upstream")
+    bootstrap_store = workspace_module.BootstrapCache.from_config(conf)
+    scheduler = scheduler_module.for_config(conf)
+
+    def downstream_dir(branch: str) -> str:
+        return os.path.join(work_dir, "downstream", branch)
+
+    def bootstrap(tree: str):
+        return lambda results: workspace_module.bootstrap_tree(
+            results["toolchain"], tree, store=bootstrap_store, scheduler=scheduler
+        )
+
+    def index(tree: str, name: str):
+        return lambda results: len(
+            slicing_module.ensure_index(
+                conf, results["toolchain"], tree, os.path.join(work_dir, "index", name)
+            )
+        )
+
+    stages = [
+        pipeline.Stage(
+            "upstream", lambda results: upstream_module.checkout_head(conf, upstream_path)
+        ),
+        pipeline.Stage("toolchain", lambda results: fixmorph_module.ensure_toolchain(conf)),
+        pipeline.Stage(
+            "bootstrap:upstream", bootstrap(upstream_path), deps=("upstream", "toolchain")
+        ),
+        pipeline.Stage(
+            "index:upstream",
+            index(upstream_path, "upstream"),
+            deps=("bootstrap:upstream", "toolchain"),
+        ),
+    ]
+    for branch in branches:
+        stages += [
+            pipeline.Stage(
+                f"downstream:{branch}",
+                # bootstrapped and built in place, so it gets its own copy
+                lambda results, branch=branch: downstream_module.prepare_downstream(
+                    conf,
+                    branch,
+                    os.path.join(work_dir, "distgit", branch),
+                    downstream_dir(branch),
+                    writable=True,
+                ),
+            ),
+            pipeline.Stage(
+                f"bootstrap:{branch}",
+                bootstrap(downstream_dir(branch)),
+                deps=(f"downstream:{branch}", "toolchain"),
+            ),
+            pipeline.Stage(
+                f"index:{branch}",
+                index(downstream_dir(branch), branch),
+                deps=(f"bootstrap:{branch}", "toolchain"),
+            ),
+        ]
+    return stages
+
+
+def format_warmed(
+    branches: typing.Sequence[str], results: typing.Dict[str, typing.Any]
+) -> str:
+    """
+    Renders what a warm run left in the caches as a plain-text table.
+    """
+    rows = [
+        ("TREE", "REVISION", "TRANSLATION UNITS"),
+        ("upstream", results["upstream"][:12], str(results["index:upstream"])),
+    ]
+    for branch in branches:
+        key = results[f"downstream:{branch}"]
+        rows.append(
+            (
+                branch,
+                key[:12] if key else "prep failed, not cached",
+                str(results[f"index:{branch}"]),
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]) - 1)]
+    lines = [
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)) + "  " + row[-1]
+        for row in rows
+    ]
+    return "\n".join([f"Toolchain image {results['toolchain']}", *lines])
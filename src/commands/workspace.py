@@ -0,0 +1,306 @@
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+import time
+import typing
+import click
+from . import cache
+from . import config as config_module
+from . import containers
+from . import pipeline
+from . import scheduler as scheduler_module
+
+
+# left in a tree once ./bootstrap.sh ran in it; copies made from that tree
+# inherit it, so their bootstrap is skipped
+BOOTSTRAP_MARKER = ".backporter-bootstrapped"
+
+# files whose change invalidates bootstrap output shared between A and B, and
+# that key the bootstrap cache; FRR includes its per-directory subdir.am files
+# from the top-level Makefile.am
+BUILD_FILE_PATTERN = re.compile(
+    r"(^|/)(configure\.(ac|in)|[^/]*\.am|[^/]*\.m4|bootstrap\.sh|autogen\.sh)$"
+)
+
+# what ./bootstrap.sh writes that BUILD_FILE_PATTERN matches: aclocal's output
+# and the macros libtoolize copies in. They aren't inputs, and a bootstrapped
+# tree has to key the same as a clean one
+GENERATED_BUILD_FILE_PATTERN = re.compile(
+    r"(^|/)(aclocal\.m4|libtool\.m4|ltoptions\.m4|ltsugar\.m4|ltversion\.m4|lt~obsolete\.m4)$"
+)
+
+# what bootstrap_tree saves of a tree's bootstrap output
+BOOTSTRAP_ARCHIVE = "bootstrap.tar"
+
+
+def patched_files(upstream_patch: str) -> typing.List[str]:
+    """
+    Returns the paths, relative to the tree root, that a git-style patch
+    modifies, creates, deletes or renames.
+    """
+    files = []
+    for line in upstream_patch.splitlines():
+        if line.startswith("--- a/") or line.startswith("+++ b/"):
+            files.append(line[len("--- a/") :].split("\t")[0])
+        elif line.startswith("rename from ") or line.startswith("rename to "):
+            files.append(line.split(" ", 2)[2])
+    return list(dict.fromkeys(files))
+
+
+def touches_build_files(upstream_patch: str) -> bool:
+    return any(BUILD_FILE_PATTERN.search(f) for f in patched_files(upstream_patch))
+
+
+def break_links(root: str, files: typing.List[str]):
+    """
+    Gives each of files its own inode so that modifying it in root doesn't
+    leak into the tree it was hardlinked from.
+    """
+    for name in files:
+        path = os.path.join(root, name)
+        if not os.path.isfile(path) or os.path.islink(path):
+            continue
+        if os.stat(path).st_nlink <= 1:
+            continue
+        tmp_path = path + ".backporter-tmp"
+        shutil.copy2(path, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def create_patched_tree(a_dir: str, upstream_patch: str, dest: str):
+    """
+    Creates the B tree at dest from the A tree at a_dir. Every file is shared
+    with A (reflinked or hardlinked) except the ones upstream.patch touches,
+    so B costs about as much as the patch. Bootstrap output is shared too
+    unless the patch touches build files.
+    """
+    cache.link_tree(a_dir, dest)
+    files = patched_files(upstream_patch)
+    break_links(dest, files)
+
+    patch_path = os.path.join(dest, "upstream.patch")
+    with open(patch_path, "w", encoding="utf-8") as f:
+        f.write(upstream_patch)
+    apply_proc = pipeline.run_command(
+        ["git", "apply", "upstream.patch"], cwd=dest, capture_output=True
+    )
+    if apply_proc.returncode != 0:
+        raise RuntimeError(
+            f"upstream.patch does not apply to its own pre-image: {apply_proc.stderr.decode('utf-8')}"
+        )
+
+    if touches_build_files(upstream_patch):
+        click.secho("upstream.patch touches build files, B will be bootstrapped again")
+        marker = os.path.join(dest, BOOTSTRAP_MARKER)
+        if os.path.exists(marker):
+            os.remove(marker)
+
+
+def is_bootstrapped(tree: str) -> bool:
+    return os.path.exists(os.path.join(tree, BOOTSTRAP_MARKER))
+
+
+def _snapshot(tree: str) -> typing.Dict[str, typing.Tuple[int, int]]:
+    """
+    Returns (mtime, size) of every file in tree outside .git, by relative path.
+    """
+    files = {}
+    for root, dirs, names in os.walk(tree):
+        dirs[:] = [d for d in dirs if d != ".git"]
+        for name in names:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            files[os.path.relpath(path, tree)] = (st.st_mtime_ns, st.st_size)
+    return files
+
+
+def build_inputs_digest(tree: str, *parts: str) -> str:
+    """
+    Hashes parts and the paths and contents of tree's autotools inputs,
+    leaving out what bootstrapping generates.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8") + b"\0")
+    inputs = [
+        path
+        for path in _snapshot(tree)
+        if BUILD_FILE_PATTERN.search(path) and not GENERATED_BUILD_FILE_PATTERN.search(path)
+    ]
+    for path in sorted(inputs):
+        with open(os.path.join(tree, path), "rb") as f:
+            digest.update(b"\0" + path.encode("utf-8") + b"\0" + f.read())
+    return digest.hexdigest()
+
+
+class BootstrapCache:
+    """
+    ./bootstrap.sh output (configure, Makefile.in, aclocal.m4, ...) keyed by
+    the toolchain image and the contents of the tree's autotools inputs, so a
+    tree whose configure.ac, *.am and *.m4 files match an earlier run's skips
+    autoreconf.
+    """
+
+    def __init__(self, root: str, max_size: int):
+        self.root = root
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, conf: config_module.BackporterConfig) -> "BootstrapCache":
+        return cls(conf.cache_path("bootstrap"), conf.bootstrap_cache_max_size)
+
+    @staticmethod
+    def key(toolchain_image: str, tree: str) -> str:
+        return build_inputs_digest(tree, toolchain_image)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def lock(self, key: str) -> cache.FileLock:
+        return cache.FileLock(self.entry_path(key) + ".lock")
+
+    def restore(self, key: str, tree: str) -> bool:
+        """
+        Unpacks the bootstrap output stored for key into tree and marks it
+        bootstrapped. Returns False on a miss.
+        """
+        archive_path = os.path.join(self.entry_path(key), BOOTSTRAP_ARCHIVE)
+        now = time.time()
+        # a concurrent save replaces the entry under the exclusive lock
+        with cache.FileLock(self.entry_path(key) + ".lock", shared=True):
+            if not os.path.isfile(archive_path):
+                return False
+            with tarfile.open(archive_path, "r") as archive:
+                for member in archive.getmembers():
+                    path = os.path.join(tree, member.name)
+                    # tree may be hardlinked from a cache; replace files, never
+                    # write through them
+                    if os.path.lexists(path) and not os.path.isdir(path):
+                        os.remove(path)
+                    archive.extract(member, tree)
+                    # newer than the inputs, or make would rerun autoreconf
+                    if member.isfile():
+                        os.utime(path, (now, now))
+            cache.touch(self.entry_path(key))
+        open(os.path.join(tree, BOOTSTRAP_MARKER), "w").close()
+        return True
+
+    def save(self, key: str, tree: str, before: typing.Dict[str, typing.Tuple[int, int]]):
+        """
+        Stores the files bootstrap created or changed in tree since `before`
+        was taken.
+        """
+        changed = [
+            path
+            for path, stat in _snapshot(tree).items()
+            if before.get(path) != stat and path != BOOTSTRAP_MARKER
+        ]
+        entry = self.entry_path(key)
+        with self.lock(key):
+            staging = entry + ".tmp"
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            with tarfile.open(os.path.join(staging, BOOTSTRAP_ARCHIVE), "w") as archive:
+                for path in sorted(changed):
+                    archive.add(os.path.join(tree, path), path, recursive=False)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(staging, entry)
+            cache.touch(entry)
+
+    def entries(self) -> typing.List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            os.path.join(self.root, name)
+            for name in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, name)) and not name.endswith(".tmp")
+        ]
+
+    def gc(self) -> typing.List[str]:
+        """
+        Evicts least recently used bootstrap output until the cache fits in
+        max_size.
+        """
+        return cache.evict(
+            self.entries(), self.max_size, lock_for=lambda e: e + ".lock"
+        )
+
+
+def bootstrap_tree(
+    toolchain_image: str,
+    tree: str,
+    log_path: typing.Optional[str] = None,
+    store: typing.Optional[BootstrapCache] = None,
+    scheduler: typing.Optional[scheduler_module.Scheduler] = None,
+):
+    """
+    Runs ./bootstrap.sh in tree inside the toolchain image, as the invoking
+    user, unless it already ran there. With a store, output saved by an
+    earlier run with the same autotools inputs is reused instead. With a
+    scheduler, the container waits for a bootstrap's share of its budget
+    and is limited to it.
+    """
+    if is_bootstrapped(tree):
+        return
+    key = before = None
+    if store:
+        key = store.key(toolchain_image, tree)
+        if store.restore(key, tree):
+            click.secho(f"Reusing bootstrap output {key[:12]} in {tree}", fg="green")
+            return
+        before = _snapshot(tree)
+    if scheduler:
+        with scheduler.slot(
+            scheduler_module.BOOTSTRAP_COST,
+            scheduler_module.PRIORITY_BOOTSTRAP,
+            f"bootstrap {os.path.basename(tree)}",
+        ) as cost:
+            _run_bootstrap(
+                toolchain_image, tree, log_path, scheduler_module.limit_args(cost)
+            )
+    else:
+        _run_bootstrap(toolchain_image, tree, log_path)
+    if store:
+        store.save(key, tree, before)
+
+
+def _run_bootstrap(
+    toolchain_image: str,
+    tree: str,
+    log_path: typing.Optional[str] = None,
+    docker_args: typing.Sequence[str] = (),
+):
+    command = [
+        "--rm",
+        "--platform",
+        containers.PLATFORM,
+        *docker_args,
+        "--user",
+        f"{os.getuid()}:{os.getgid()}",
+        "-v",
+        f"{os.path.abspath(tree)}:/src:rw,z",
+        "-w",
+        "/src",
+        toolchain_image,
+        "bash",
+        "-c",
+        f"./bootstrap.sh && touch {BOOTSTRAP_MARKER}",
+    ]
+    if containers.engine().run(command, log_path=log_path) != 0:
+        raise RuntimeError(f"./bootstrap.sh failed in {tree}")
+
+
+def restore_bootstrap(store: BootstrapCache, toolchain_image: str, tree: str) -> bool:
+    """
+    Marks tree bootstrapped with stored output if there is any, so the image
+    build skips ./bootstrap.sh for it.
+    """
+    if is_bootstrapped(tree):
+        return True
+    key = store.key(toolchain_image, tree)
+    if not store.restore(key, tree):
+        return False
+    click.secho(f"Reusing bootstrap output {key[:12]} in {tree}", fg="green")
+    return True
@@ -0,0 +1,55 @@
+import os
+import time
+from src.commands import cache
+
+
+def _entry(root, name, size, used):
+    entry = os.path.join(root, name)
+    os.makedirs(entry)
+    with open(os.path.join(entry, "data"), "wb") as f:
+        f.write(b"x" * size)
+    cache.touch(entry)
+    marker = os.path.join(entry, cache.LAST_USED_MARKER)
+    os.utime(marker, (used, used))
+    return entry
+
+
+def test_evict_removes_least_recently_used_first(tmp_path):
+    now = time.time()
+    old = _entry(tmp_path, "old", 64 * 1024, now - 300)
+    mid = _entry(tmp_path, "mid", 64 * 1024, now - 200)
+    new = _entry(tmp_path, "new", 64 * 1024, now - 100)
+    max_size = cache.dir_size(mid) + cache.dir_size(new)
+
+    assert cache.evict([new, old, mid], max_size) == [old]
+    assert not os.path.exists(old)
+    assert os.path.isdir(mid) and os.path.isdir(new)
+
+
+def test_evict_keeps_entries_within_grace(tmp_path):
+    now = time.time()
+    old = _entry(tmp_path, "old", 4096, now - 300)
+    new = _entry(tmp_path, "new", 4096, now - 10)
+
+    assert cache.evict([old, new], 0, grace_seconds=60) == [old]
+    assert os.path.isdir(new)
+
+
+def test_evict_skips_locked_entries(tmp_path):
+    now = time.time()
+    old = _entry(tmp_path, "old", 4096, now - 300)
+    new = _entry(tmp_path, "new", 4096, now - 100)
+
+    with cache.FileLock(old + ".lock", shared=True):
+        removed = cache.evict([old, new], 0, lock_for=lambda e: e + ".lock")
+    assert removed == [new]
+    assert os.path.isdir(old)
+
+
+def test_dir_size_counts_hardlinks_once(tmp_path):
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    (tree / "a").write_bytes(b"x" * 8192)
+    single = cache.dir_size(str(tree))
+    os.link(tree / "a", tree / "b")
+    assert cache.dir_size(str(tree)) == single
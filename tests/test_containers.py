@@ -0,0 +1,70 @@
+import pytest
+from src.commands import containers
+
+
+def test_parse_run_args():
+    spec = containers.parse_run_args(
+        [
+            "--rm",
+            "--name", "job",
+            "--platform", "linux/amd64",
+            "-e", "A=1",
+            "-v", "/src:/src:rw,z",
+            "-w", "/src",
+            "--user", "1000:1000",
+            "--cpus", "1.5",
+            "image:tag",
+            "bash", "-c", "true",
+        ]
+    )
+    assert spec["name"] == "job"
+    assert spec["remove"] is True
+    assert spec["platform"] == "linux/amd64"
+    assert spec["body"] == {
+        "WorkingDir": "/src",
+        "User": "1000:1000",
+        "Image": "image:tag",
+        "Cmd": ["bash", "-c", "true"],
+        "Env": ["A=1"],
+        "HostConfig": {"NanoCpus": 1500000000, "Binds": ["/src:/src:rw,z"]},
+    }
+
+
+def test_parse_run_args_without_command():
+    spec = containers.parse_run_args(["image:tag"])
+    assert spec["body"]["Cmd"] is None
+    assert spec["remove"] is False
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("4294967296", 4 * 1024**3),
+        ("4g", 4 * 1024**3),
+        ("512M", 512 * 1024**2),
+        ("64k", 64 * 1024),
+        ("100b", 100),
+        ("1.5g", 3 * 512 * 1024**2),
+        ("4GiB", 4 * 1024**3),
+        ("2gb", 2 * 1024**3),
+    ],
+)
+def test_parse_run_args_memory(value, expected):
+    spec = containers.parse_run_args(["--memory", value, "--memory-swap", "-1", "image"])
+    assert spec["body"]["HostConfig"]["Memory"] == expected
+    assert spec["body"]["HostConfig"]["MemorySwap"] == -1
+
+
+@pytest.mark.parametrize("value", ["lots", "4x", "-2g"])
+def test_parse_run_args_rejects_bad_memory(value):
+    with pytest.raises(ValueError, match="--memory"):
+        containers.parse_run_args(["--memory", value, "image"])
+
+
+@pytest.mark.parametrize(
+    "args",
+    [["--privileged", "image"], ["--rm"]],
+)
+def test_parse_run_args_rejects_unsupported(args):
+    with pytest.raises(ValueError):
+        containers.parse_run_args(args)
@@ -0,0 +1,103 @@
+import json
+import os
+import stat
+import threading
+import pytest
+from src.commands import config as config_module
+from src.commands import containers
+from src.commands import daemon
+
+
+def _conf(tmp_path, **fields):
+    return config_module.parse_config(
+        {
+            "upstream_url": "https://example.com/frr.git",
+            "distgit_repo": "frr",
+            "cache_dir": str(tmp_path / "cache"),
+            **fields,
+        }
+    )
+
+
+def test_job_config_applies_job_settings(tmp_path):
+    conf = daemon.job_config(_conf(tmp_path), {"run_mode": "mount", "build_jobs": "4"})
+    assert conf.run_mode == "mount"
+    assert conf.build_jobs == 4
+    assert conf.cache_dir == str(tmp_path / "cache")
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {"fixmorph_base_image": "evil:latest"},
+        {"cache_dir": "/"},
+        {"upstream_url": "https://example.org/other.git"},
+        {"container_backend": "cli"},
+        {"run_mode": "host"},
+        {"job_memory": "lots"},
+    ],
+)
+def test_job_config_refuses_other_settings(tmp_path, settings):
+    with pytest.raises(ValueError):
+        daemon.job_config(_conf(tmp_path), settings)
+
+
+@pytest.fixture
+def server(tmp_path):
+    addr = str(tmp_path / "daemon.sock")
+    token = daemon.write_token(daemon.token_path(addr, str(tmp_path)))
+    srv = daemon.make_server(addr, daemon.Daemon(_conf(tmp_path), lambda *a, **k: None, 1), token)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield addr, token
+    srv.shutdown()
+    srv.server_close()
+
+
+def _get(addr, headers):
+    connection = containers.UnixHTTPConnection(addr)
+    try:
+        connection.request("GET", "/jobs", headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def test_token_is_private(server):
+    addr, _ = server
+    assert stat.S_IMODE(os.stat(addr + daemon.TOKEN_SUFFIX).st_mode) == 0o600
+
+
+def test_client_sends_the_token(server):
+    addr, _ = server
+    assert daemon.Client(addr, addr + daemon.TOKEN_SUFFIX).jobs() == []
+
+
+def test_requests_without_the_token_are_refused(server):
+    addr, _ = server
+    assert _get(addr, {}) == 401
+    assert _get(addr, {"Authorization": "Bearer nope"}) == 401
+
+
+def test_requests_for_other_hosts_are_refused(server):
+    addr, token = server
+    assert _get(addr, {"Host": "attacker.example", "Authorization": f"Bearer {token}"}) == 403
+
+
+def test_jobs_must_be_json(server):
+    addr, token = server
+    connection = containers.UnixHTTPConnection(addr)
+    try:
+        connection.request(
+            "POST",
+            "/jobs",
+            json.dumps({"commit": "abc", "branches": ["rhel-9"]}),
+            {"Authorization": f"Bearer {token}", "Content-Type": "text/plain"},
+        )
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 415
+    finally:
+        connection.close()
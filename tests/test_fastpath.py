@@ -0,0 +1,100 @@
+import difflib
+import os
+import subprocess
+from src.commands import fastpath
+
+
+UPSTREAM = "".join(f"line {i}\n" for i in range(1, 21))
+
+
+def _diff(path, before, after):
+    """
+    Returns a git-style patch changing path from before to after.
+    """
+    diff = difflib.unified_diff(
+        before.splitlines(keepends=True), after.splitlines(keepends=True), f"a/{path}", f"b/{path}"
+    )
+    return f"diff --git a/{path} b/{path}\n" + "".join(diff)
+
+
+def _trees(tmp_path, downstream_text):
+    upstream = tmp_path / "upstream"
+    downstream = tmp_path / "downstream"
+    for root, text in ((upstream, UPSTREAM), (downstream, downstream_text)):
+        (root / "lib").mkdir(parents=True)
+        (root / "lib" / "a.c").write_text(text)
+    return str(upstream), str(downstream)
+
+
+def _apply(tmp_path, downstream_text, patch):
+    upstream, downstream = _trees(tmp_path, downstream_text)
+    result = fastpath.apply(upstream, downstream, patch, str(tmp_path / "scratch"))
+    with open(os.path.join(downstream, "lib", "a.c"), encoding="utf-8") as f:
+        assert f.read() == downstream_text, "the downstream tree must not change"
+    return result
+
+
+def _patched(tmp_path, downstream_text, result):
+    tree = tmp_path / "check"
+    (tree / "lib").mkdir(parents=True)
+    (tree / "lib" / "a.c").write_text(downstream_text)
+    (tree / "fast.patch").write_text(result.patch)
+    subprocess.run(["patch", "-p1", "-s", "-i", "fast.patch"], cwd=tree, check=True)
+    return (tree / "lib" / "a.c").read_text()
+
+
+def test_split_patch_keeps_header_and_sections():
+    patch = "From abc\nSubject: x\n\ndiff --git a/a b/a\n-1\ndiff --git a/b b/b\n+2\n"
+    header, sections = fastpath.split_patch(patch)
+    assert header == "From abc\nSubject: x\n\n"
+    assert sections == ["diff --git a/a b/a\n-1\n", "diff --git a/b b/b\n+2\n"]
+    assert header + "".join(sections) == patch
+
+
+def test_clean_apply(tmp_path):
+    after = UPSTREAM.replace("line 10\n", "line ten\n")
+    result = _apply(tmp_path, UPSTREAM, _diff("lib/a.c", UPSTREAM, after))
+    assert result.methods == {"lib/a.c": fastpath.CLEAN}
+    assert result.remaining == ""
+    assert _patched(tmp_path, UPSTREAM, result) == after
+
+
+def test_three_way_merge(tmp_path):
+    after = UPSTREAM.replace("line 10\n", "line ten\n")
+    # downstream changed the context of the hunk
+    downstream = UPSTREAM.replace("line 8\n", "line eight\n").replace("line 12\n", "line twelve\n")
+    result = _apply(tmp_path, downstream, _diff("lib/a.c", UPSTREAM, after))
+    assert result.methods == {"lib/a.c": fastpath.THREE_WAY}
+    assert "line ten" in _patched(tmp_path, downstream, result)
+
+
+def test_conflicting_file_is_left_to_fixmorph(tmp_path):
+    after = UPSTREAM.replace("line 10\n", "line ten\n")
+    downstream = UPSTREAM.replace("line 10\n", "line X\n")
+    patch = "Subject: x\n\n" + _diff("lib/a.c", UPSTREAM, after)
+    result = _apply(tmp_path, downstream, patch)
+    assert result.methods == {}
+    assert result.patch == ""
+    assert result.remaining == patch
+
+
+def test_binary_file_is_left_to_fixmorph(tmp_path):
+    section = (
+        "diff --git a/logo.png b/logo.png\n"
+        "index 1111111..2222222 100644\n"
+        "Binary files a/logo.png and b/logo.png differ\n"
+    )
+    result = _apply(tmp_path, UPSTREAM, section)
+    assert result.remaining == section
+
+
+def test_write_patch_leaves_fixmorph_output_alone(tmp_path):
+    fixmorph_patch = tmp_path / "fixmorph.diff"
+    fixmorph_patch.write_text("diff --git a/x b/x\n")
+    dest = str(tmp_path / "patch.diff")
+    for _ in range(2):
+        # a resumed run writes the patch again
+        fastpath.write_patch(dest, str(fixmorph_patch), "diff --git a/y b/y\n")
+    assert fixmorph_patch.read_text() == "diff --git a/x b/x\n"
+    with open(dest, encoding="utf-8") as f:
+        assert f.read() == "diff --git a/x b/x\ndiff --git a/y b/y\n"
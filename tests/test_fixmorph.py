@@ -0,0 +1,23 @@
+import pytest
+from src.commands import containers
+from src.commands import fixmorph
+
+
+class _FailingEngine:
+    def __init__(self):
+        self.removed = []
+
+    def run(self, args, log_path=None):
+        raise containers.EngineError("cancelled")
+
+    def remove(self, container):
+        self.removed.append(container)
+
+
+def test_run_image_removes_the_container_when_running_fails(tmp_path, monkeypatch):
+    engine = _FailingEngine()
+    monkeypatch.setattr(containers, "engine", lambda: engine)
+    with pytest.raises(containers.EngineError):
+        fixmorph.run_image("fixmorph-frr:run", str(tmp_path))
+    assert len(engine.removed) == 1
+    assert engine.removed[0].startswith("fixmorph-")
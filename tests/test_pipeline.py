@@ -0,0 +1,107 @@
+import os
+import pytest
+from src.commands import pipeline
+
+
+def _stages(calls, tmp_path, upstream_input="a"):
+    output = str(tmp_path / "built")
+
+    def build(results):
+        calls.append("build")
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(results["fetch"])
+        return output
+
+    def fetch(results):
+        calls.append("fetch")
+        return upstream_input
+
+    def report(results):
+        calls.append("report")
+        return f"report of {results['build']}"
+
+    return [
+        pipeline.Stage("fetch", fetch, inputs=(upstream_input,)),
+        pipeline.Stage("build", build, deps=("fetch",), outputs=(output,)),
+        pipeline.Stage("report", report, deps=("build",)),
+    ]
+
+
+def _run(stages, tmp_path):
+    checkpoints = pipeline.Checkpoints(str(tmp_path / "checkpoints"))
+    return pipeline.run_stages(stages, checkpoints=checkpoints)
+
+
+def test_checkpoints_are_reused(tmp_path):
+    calls = []
+    first = _run(_stages(calls, tmp_path), tmp_path)
+    assert calls == ["fetch", "build", "report"]
+
+    calls.clear()
+    assert _run(_stages(calls, tmp_path), tmp_path) == first
+    assert calls == []
+
+
+def test_changed_inputs_rerun_the_stage_and_its_dependents(tmp_path):
+    calls = []
+    _run(_stages(calls, tmp_path), tmp_path)
+
+    calls.clear()
+    results = _run(_stages(calls, tmp_path, upstream_input="b"), tmp_path)
+    assert calls == ["fetch", "build", "report"]
+    with open(results["build"], encoding="utf-8") as f:
+        assert f.read() == "b"
+
+
+def test_missing_output_reruns_the_stage_and_its_dependents(tmp_path):
+    calls = []
+    _run(_stages(calls, tmp_path), tmp_path)
+    os.remove(tmp_path / "built")
+
+    calls.clear()
+    _run(_stages(calls, tmp_path), tmp_path)
+    assert calls == ["build", "report"]
+
+
+def test_failed_check_reruns_the_stage(tmp_path):
+    calls = []
+    _run(_stages(calls, tmp_path), tmp_path)
+
+    calls.clear()
+    stages = _stages(calls, tmp_path)
+    stages[2].check = lambda result: False
+    _run(stages, tmp_path)
+    assert calls == ["report"]
+
+
+def test_failure_is_resumed_from_the_failed_stage(tmp_path):
+    calls = []
+    stages = _stages(calls, tmp_path)
+
+    def broken(results):
+        raise RuntimeError("boom")
+
+    stages[2].run = broken
+    with pytest.raises(pipeline.StageError) as excinfo:
+        _run(stages, tmp_path)
+    assert excinfo.value.stage == "report"
+
+    calls.clear()
+    _run(_stages(calls, tmp_path), tmp_path)
+    assert calls == ["report"]
+
+
+def test_rerun_stage_clears_its_outputs(tmp_path):
+    stale = tmp_path / "stale"
+    stale.mkdir()
+    (stale / "leftover").write_text("x")
+    seen = []
+
+    def build(results):
+        seen.append(os.path.exists(stale))
+        stale.mkdir()
+        return str(stale)
+
+    stage = pipeline.Stage("build", build, outputs=(str(stale),))
+    _run([stage], tmp_path)
+    assert seen == [False]
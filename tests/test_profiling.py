@@ -0,0 +1,31 @@
+import threading
+from src.commands import profiling
+
+
+def test_downloads_are_left_out_of_overlapping_stages():
+    profiler = profiling.Profiler()
+    with profiler.measure("alone"):
+        pass
+    inner_started = threading.Event()
+    outer_done = threading.Event()
+
+    def sibling():
+        with profiler.measure("sibling"):
+            inner_started.set()
+            outer_done.wait(5)
+
+    thread = threading.Thread(target=sibling)
+    thread.start()
+    inner_started.wait(5)
+    with profiler.measure("overlapping"):
+        pass
+    outer_done.set()
+    thread.join()
+
+    records = {r.name: r for r in profiler.records}
+    assert not records["alone"].overlapped
+    assert records["alone"].bytes_downloaded is not None
+    for name in ("sibling", "overlapping"):
+        assert records[name].overlapped
+        assert records[name].bytes_downloaded is None
+    assert "-" in profiler.summary()
@@ -0,0 +1,58 @@
+import os
+import yaml
+from src.commands import results as results_module
+
+
+def _store(tmp_path, max_size=0, max_age_days=0):
+    return results_module.ResultStore(str(tmp_path / "results"), max_size, max_age_days)
+
+
+def _put(store, tmp_path, key, patch="--- a/f\n+++ b/f\n"):
+    patch_path = tmp_path / f"{key}.diff"
+    patch_path.write_text(patch)
+    log_path = tmp_path / "run.log"
+    log_path.write_text("log\n")
+    return store.put(key, 0, str(patch_path), [str(log_path)], {"commit": "c"})
+
+
+def test_key_depends_on_every_input():
+    key = results_module.ResultStore.key("a", "b", "c", "d")
+    assert key == results_module.ResultStore.key("a", "b", "c", "d")
+    assert key != results_module.ResultStore.key("a", "b", "c", "e")
+    assert key != results_module.ResultStore.key("ab", "", "c", "d")
+
+
+def test_put_then_get(tmp_path):
+    store = _store(tmp_path)
+    assert store.get("k") is None
+    stored = _put(store, tmp_path, "k")
+    assert stored.exit_code == 0
+    with open(stored.patch_path, encoding="utf-8") as f:
+        assert f.read() == "--- a/f\n+++ b/f\n"
+    assert os.listdir(stored.log_dir) == ["run.log"]
+    assert store.get("k") == stored
+
+
+def test_entry_without_patch_is_evicted(tmp_path):
+    store = _store(tmp_path)
+    stored = _put(store, tmp_path, "k")
+    os.remove(stored.patch_path)
+    assert store.get("k") is None
+    assert not os.path.exists(store.entry_path("k"))
+
+
+def test_expired_entry_is_a_miss_and_collected(tmp_path):
+    store = _store(tmp_path, max_size=1 << 30, max_age_days=1)
+    _put(store, tmp_path, "old")
+    _put(store, tmp_path, "new")
+    meta_path = os.path.join(store.entry_path("old"), "meta.yaml")
+    with open(meta_path, encoding="utf-8") as f:
+        meta = yaml.safe_load(f)
+    meta["created"] -= 2 * 86400
+    with open(meta_path, "w", encoding="utf-8") as f:
+        yaml.dump(meta, f)
+    os.utime(meta_path, (meta["created"], meta["created"]))
+
+    assert store.get("old") is None
+    assert store.gc() == [store.entry_path("old")]
+    assert store.get("new") is not None
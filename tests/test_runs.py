@@ -0,0 +1,48 @@
+import os
+import shutil
+from src.commands import runs
+
+
+def _run(root, name, status, updated, resumable=False, branches=None):
+    run = runs.RunDir(os.path.join(root, name))
+    os.makedirs(run.work_dir)
+    fields = {"commit": "abc", "branch": "rhel-9", "status": status}
+    if branches:
+        fields["branches"] = branches
+    run.update_manifest(**fields)
+    if not resumable:
+        shutil.rmtree(run.work_dir)
+    # update_manifest stamps the current time
+    manifest_path = os.path.join(run.path, runs.RUN_MANIFEST)
+    with open(manifest_path, encoding="utf-8") as f:
+        text = f.read()
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(line for line in text.splitlines() if not line.startswith("updated:")))
+        f.write(f"\nupdated: {updated}\n")
+    return run
+
+
+def test_prune_keeps_the_newest_finished_runs(tmp_path):
+    root = str(tmp_path)
+    for i, status in enumerate(("done", "failed", "done", "interrupted")):
+        _run(root, f"run-{i}", status, updated=i)
+    runs.prune(root, keep=2)
+    assert sorted(os.listdir(root)) == ["run-2", "run-3"]
+
+
+def test_prune_leaves_unfinished_and_resumable_runs(tmp_path):
+    root = str(tmp_path)
+    _run(root, "queued", runs.QUEUED, updated=0)
+    _run(root, "running", "running", updated=1)
+    _run(root, "failed-resumable", "failed", updated=2, resumable=True)
+    # a multi-target run can't be resumed even with its work dir left
+    _run(root, "failed-multi", "failed", updated=3, resumable=True, branches=["a", "b"])
+    _run(root, "done", "done", updated=4)
+    os.makedirs(os.path.join(root, "being-created"))
+    runs.prune(root, keep=0)
+    assert sorted(os.listdir(root)) == [
+        "being-created",
+        "failed-resumable",
+        "queued",
+        "running",
+    ]
@@ -0,0 +1,38 @@
+import os
+import threading
+import time
+from src.commands import scheduler as scheduler_module
+
+
+def test_parse_size():
+    assert scheduler_module.parse_size(4096) == 4096
+    assert scheduler_module.parse_size("4G") == 4 * 1024**3
+    assert scheduler_module.parse_size("512MiB") == 512 * 1024**2
+
+
+def test_processes_share_the_budget_through_slot_files(tmp_path):
+    # two schedulers on one directory stand in for two backporter processes
+    first = scheduler_module.Scheduler(4, slots_dir=str(tmp_path))
+    second = scheduler_module.Scheduler(4, slots_dir=str(tmp_path))
+    admitted = threading.Event()
+
+    def run_second():
+        with second.slot(scheduler_module.Cost(cpus=2), name="second"):
+            admitted.set()
+
+    with first.slot(scheduler_module.Cost(cpus=3), name="first"):
+        thread = threading.Thread(target=run_second)
+        thread.start()
+        assert not admitted.wait(scheduler_module.WAIT_INTERVAL * 2)
+    thread.join(timeout=10)
+    assert admitted.is_set()
+    assert [n for n in os.listdir(tmp_path) if n.endswith(".slot")] == []
+
+
+def test_slot_of_an_exited_process_is_reclaimed(tmp_path):
+    (tmp_path / f"1-stale{scheduler_module.SLOT_SUFFIX}").write_text("4 0\n")
+    scheduler = scheduler_module.Scheduler(4, slots_dir=str(tmp_path))
+    started = time.monotonic()
+    with scheduler.slot(scheduler_module.Cost(cpus=4)):
+        assert time.monotonic() - started < scheduler_module.WAIT_INTERVAL
+    assert not os.path.exists(tmp_path / f"1-stale{scheduler_module.SLOT_SUFFIX}")
@@ -0,0 +1,62 @@
+import subprocess
+import pytest
+from src.commands import series
+
+
+def _git(repo, *args):
+    return subprocess.run(
+        ["git", "-C", str(repo), *args], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = tmp_path / "upstream"
+    repo.mkdir()
+    _git(repo, "init", "-q")
+    _git(repo, "config", "user.email", "user@example.com")
+    _git(repo, "config", "user.name", "user")
+    for i in range(4):
+        (repo / "file.c").write_text(f"int x = {i};\n")
+        _git(repo, "add", "file.c")
+        _git(repo, "commit", "-q", "-m", f"commit {i}")
+    return repo
+
+
+def _shas(repo):
+    return _git(repo, "rev-list", "--reverse", "HEAD").split()
+
+
+def test_is_series_and_tip():
+    assert not series.is_series("abc123")
+    assert series.is_series("a..b") and series.tip("a..b") == "b"
+    assert series.is_series("a,b,c") and series.tip("a,b,c") == "c"
+
+
+def test_resolve_range_is_oldest_first_and_excludes_base(repo):
+    shas = _shas(repo)
+    assert series.resolve(str(repo), f"{shas[0][:8]}..HEAD") == shas[1:]
+
+
+def test_resolve_list_keeps_order_and_drops_repeats(repo):
+    shas = _shas(repo)
+    spec = f"{shas[2][:8]}, {shas[1]},{shas[2]},"
+    assert series.resolve(str(repo), spec) == [shas[2], shas[1]]
+
+
+def test_resolve_empty_range(repo):
+    with pytest.raises(RuntimeError, match="does not name any commits"):
+        series.resolve(str(repo), "HEAD..HEAD")
+
+
+def test_downstream_key():
+    assert series.downstream_key(None, ["patch"]) is None
+    assert series.downstream_key("base", []) == "base"
+    first = series.downstream_key("base", ["one"])
+    assert first != "base"
+    assert series.downstream_key("base", ["one"]) == first
+    assert series.downstream_key("other", ["one"]) != first
+    assert series.downstream_key("base", ["one", "two"]) != first
+    assert series.downstream_key("base", ["two", "one"]) != series.downstream_key(
+        "base", ["one", "two"]
+    )
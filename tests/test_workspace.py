@@ -0,0 +1,37 @@
+from src.commands import workspace
+
+
+def _tree(tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "m4").mkdir(parents=True)
+    (tree / "configure.ac").write_text("AC_INIT([pkg], [1.0])\n")
+    (tree / "Makefile.am").write_text("SUBDIRS = lib\n")
+    (tree / "m4" / "ax_check.m4").write_text("AC_DEFUN([AX_CHECK])\n")
+    (tree / "lib.c").write_text("int x;\n")
+    return tree
+
+
+def test_build_inputs_digest_ignores_bootstrap_output(tmp_path):
+    tree = _tree(tmp_path)
+    clean = workspace.build_inputs_digest(str(tree), "toolchain")
+    for path in ("aclocal.m4", "m4/libtool.m4", "m4/ltoptions.m4", "m4/lt~obsolete.m4"):
+        (tree / path).write_text("# generated\n")
+    (tree / "configure").write_text("#!/bin/sh\n")
+    (tree / "Makefile.in").write_text("all:\n")
+    assert workspace.build_inputs_digest(str(tree), "toolchain") == clean
+
+
+def test_build_inputs_digest_follows_inputs(tmp_path):
+    tree = _tree(tmp_path)
+    clean = workspace.build_inputs_digest(str(tree), "toolchain")
+    assert workspace.build_inputs_digest(str(tree), "other toolchain") != clean
+    (tree / "lib.c").write_text("int y;\n")
+    assert workspace.build_inputs_digest(str(tree), "toolchain") == clean
+    (tree / "m4" / "ax_check.m4").write_text("AC_DEFUN([AX_CHECK], [:])\n")
+    assert workspace.build_inputs_digest(str(tree), "toolchain") != clean
+
+
+def test_touches_build_files():
+    patch = "--- a/lib/a.c\n+++ b/lib/a.c\n"
+    assert not workspace.touches_build_files(patch)
+    assert workspace.touches_build_files(patch + "--- a/lib/Makefile.am\n+++ b/lib/Makefile.am\n")